@@ -1,35 +1,23 @@
 #!/bin/python3
 import os, sys, subprocess, time, logging
-from datetime import datetime
+from datetime import datetime, timedelta
 import numpy as np
 
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtCore import *
 
-from picamera2 import Picamera2
-from picamera2.previews.qt import QGlPicamera2
 from resources.FotoPi_GUI import Ui_FotoPi
-
-log_dir = "logs"
-
-if not os.path.exists(log_dir):
-    try:
-        os.makedirs(log_dir)
-        print(f"dir: '{log_dir}' successfully created")
-    except Exception as e:
-        print(f"error creating dir: '{log_dir}': {e}")
-        sys.exit(1)
-
-log_filename = os.path.join(log_dir, time.strftime("FotoPi_%H-%M_%d-%m-%Y.log"))
-
-logging.basicConfig(
-    filename=log_filename,
-    level=logging.DEBUG,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S"
-)
-
+from resources.FotoPi_thumbs import ThumbnailCache, ThumbnailWorkers, GalleryLoader, PreviewLoader, probe_size
+from resources.FotoPi_catalog import ImageCatalog
+from resources.FotoPi_calib import CalibrationLibrary
+from resources.FotoPi_analysis import LiveAnalyzer, PEAKING_COLOURS, PEAKING_LEVELS, ZEBRA_LEVELS
+from resources.FotoPi_overlay import OverlayCompositor
+from resources.FotoPi_aec import ExposureController, METERING_MODES, EV_STEPS
+from resources.FotoPi_gallery import GalleryPanel, GALLERY_FORMATS
+from resources.FotoPi_capture import BurstResult, StackResult
+from resources.FotoPi_files import RAW_PLUS_JPEG
+from resources.FotoPi_engine import CaptureEngine, Picamera2Backend, create_backend
 
 def handle_exception(exc_type, exc_value, exc_tb):
     if issubclass(exc_type, KeyboardInterrupt):
@@ -38,7 +26,26 @@ def handle_exception(exc_type, exc_value, exc_tb):
     logging.error("Uncaught exception: %s", str(exc_value))
 
 
-sys.excepthook = handle_exception
+def setup_logging(log_dir="logs"):
+    # called from __main__ only, so benchmarks can import MainWindow without creating log files
+    if not os.path.exists(log_dir):
+        try:
+            os.makedirs(log_dir)
+            print(f"dir: '{log_dir}' successfully created")
+        except Exception as e:
+            print(f"error creating dir: '{log_dir}': {e}")
+            sys.exit(1)
+
+    log_filename = os.path.join(log_dir, time.strftime("FotoPi_%H-%M_%d-%m-%Y.log"))
+
+    logging.basicConfig(
+        filename=log_filename,
+        level=logging.DEBUG,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    sys.excepthook = handle_exception
 
 
 def shutdown_raspi():
@@ -48,7 +55,68 @@ def shutdown_raspi():
         print(f"Error processing command: {e}")
 
 
+# drive mode -> (kind, value); burst value = frames per press (0 = until stopped),
+# interval value = seconds between shots, precapture value = keep the whole pre-roll,
+# stack value = raw frames combined into one image, master value = the calibration master to capture
+DRIVE_MODES = {
+    "Single": ("single", None),
+    "Burst 5": ("burst", 5),
+    "Burst 10": ("burst", 10),
+    "Burst 25": ("burst", 25),
+    "Burst ∞": ("burst", 0),
+    "Interval 5s": ("interval", 5),
+    "Interval 10s": ("interval", 10),
+    "Interval 30s": ("interval", 30),
+    "Interval 60s": ("interval", 60),
+    "Stack 10": ("stack", 10),
+    "Stack 25": ("stack", 25),
+    "Stack 50": ("stack", 50),
+    "Master dark": ("master", "dark"),
+    "Master flat": ("master", "flat"),
+    "Zero lag": ("precapture", False),
+    "Pre-roll": ("precapture", True),
+}
+
+# resolution of the live view overlay (stretched over the preview), and where the histogram goes on it
+OVERLAY_SIZE = (720, 540)
+OVERLAY_MARGIN = 12
+
+ISO_VALUES = ["100", "200", "320", "400", "640", "800", "1600", "3200", "6400"]
+
+
+def format_shutter(exposure_us):
+    """Shutter speed label for an exposure time, "1/125" or "2"."""
+    if exposure_us >= 500_000:
+        return f"{exposure_us / 1e6:.2g}"
+    return f"1/{round(1e6 / exposure_us)}"
+
+
+class SimulatedPreview(QLabel):
+    """Stand-in for QGlPicamera2 when running on the simulated backend."""
+
+    done_signal = pyqtSignal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setStyleSheet("background-color: rgb(30, 30, 30);")
+
+    def set_overlay(self, overlay):
+        if overlay is None:
+            self.clear()
+            return
+        h, w = overlay.shape[:2]
+        image = QImage(np.ascontiguousarray(overlay).data, w, h, w * 4, QImage.Format_RGBA8888).copy()
+        self.setPixmap(QPixmap.fromImage(image).scaled(self.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation))
+
+
 class MainWindow(QWidget, Ui_FotoPi):
+    file_written = pyqtSignal(str, object, object)
+    write_failed = pyqtSignal(str, object)
+    frame_captured = pyqtSignal(str)
+    capture_failed = pyqtSignal(object, object)
+    drive_finished = pyqtSignal(object)
+    analysis_ready = pyqtSignal(object)
+
     def __init__(self):
         super().__init__()
         self.setupUi(self)
@@ -60,11 +128,25 @@ class MainWindow(QWidget, Ui_FotoPi):
         self.image_folder = self.settings.value("image_folder", default_folder)
         if not os.path.exists(self.image_folder):
             os.makedirs(self.image_folder)
+        self.catalog = ImageCatalog(self.image_folder)
+        self.catalog.reconcile(probe=probe_size)
+        # master darks / flats belong to the camera, not to an image folder; a flat only fits
+        # the lens and aperture it was taken with, so applying it is opt-in
+        self.calibration = CalibrationLibrary(self.settings.value("calibration_folder",
+                                                                  os.path.join(script_dir, "calibration")),
+                                              apply_flat=self.settings.value("calibration_apply_flat", False,
+                                                                             type=bool))
+        self.thumb_cache_mb = int(self.settings.value("thumbnail_cache_mb", 64))
+        self.thumbnails = ThumbnailCache(self.image_folder, self.thumb_cache_mb * 1024 * 1024)
+        self.thumb_workers = ThumbnailWorkers(self.thumbnails,
+                                              max_threads=int(self.settings.value("thumbnail_threads", 2)),
+                                              max_pending=int(self.settings.value("thumbnail_queue", 32)))
+        self.gallery_loader = GalleryLoader(self.thumbnails)
+        self.preview_loader = PreviewLoader(self.thumbnails)
+        self.gallery_panel = None
 
         self.setCursor(Qt.BlankCursor)
 
-        self.current_page = 0
-        self.images_per_page = 9
         self.cur_iso = "1600"  # default picamera2 = 400
         self.cur_shutter = "1/30"  # default picamera2 = 1/30
         self.saturation_value = 1.00
@@ -73,6 +155,11 @@ class MainWindow(QWidget, Ui_FotoPi):
         self.brightness_value = 1.00
         self.awb_value = "Auto"
         self.output_format = self.settings.value("capture_format", ".jpg")
+        self.drive_mode = self.settings.value("drive_mode", "Single")
+        if self.drive_mode not in DRIVE_MODES:
+            self.drive_mode = "Single"
+        self.capture_in_progress = False
+        self.press_ns = None
 
         self.shutter_speeds = {
             "1": 1_000_000,
@@ -90,28 +177,70 @@ class MainWindow(QWidget, Ui_FotoPi):
 
         # init picamera2
         self.app = QApplication([])
-        self.picam2 = Picamera2()
-        preview_config = self.picam2.create_preview_configuration(main={"size": (1440, 1080)})
-        self.picam2.configure(preview_config)
-        self.qpicamera2 = QGlPicamera2(self.picam2, keep_ar=True)
+        # capture, encode and write live in the engine; FOTOPI_BACKEND=simulated runs without a camera
+        self.engine = CaptureEngine(create_backend(), self.image_folder,
+                                    writer_threads=int(self.settings.value("writer_threads", 2)),
+                                    writer_queue=int(self.settings.value("writer_queue", 4)),
+                                    on_written=self.file_written.emit,
+                                    on_failed=self.write_failed.emit,
+                                    still_preview=self.settings.value("still_preview", False, type=bool),
+                                    calibration=self.calibration)
+        self.picam2 = self.engine.backend
+        self.engine.configure()
+        self.qpicamera2 = self.create_preview_widget()
         # (w, h) = self.picam2.stream_configuration("main")["size"]
         # set default iso & shutter to easily match with gui
-        self.picam2.set_controls({
+        self.engine.start({
             "AeEnable": False,
             "AnalogueGain": float(self.cur_iso) / 100,
             "ExposureTime": self.shutter_speeds.get(self.cur_shutter)
         })
-        self.picam2.start()
+        if DRIVE_MODES[self.drive_mode][0] == "precapture":
+            self.start_pre_capture()
         self.shutter_label.setText(QCoreApplication.translate("FotoPi", self.cur_shutter, None))
         self.iso_label.setText(QCoreApplication.translate("FotoPi", self.cur_iso, None))
 
-        self.overlay_blk = np.zeros((300, 400, 4), dtype=np.uint8)
-        self.overlay_blk[::] = (0, 0, 0, 100)
+        # grid, dimming and the live analysis layers, drawn by the preview itself
+        self.overlay = OverlayCompositor(OVERLAY_SIZE, margin=OVERLAY_MARGIN)
+        self.histogram_enabled = self.settings.value("histogram", False, type=bool)
+        self.peaking = self.settings.value("peaking", "Off")
+        if self.peaking not in PEAKING_COLOURS:
+            self.peaking = "Off"
+        self.peaking_level = self.settings.value("peaking_level", "Medium")
+        if self.peaking_level not in PEAKING_LEVELS:
+            self.peaking_level = "Medium"
+        self.analyzer = LiveAnalyzer(rate=float(self.settings.value("analysis_rate", 5)),
+                                     budget=float(self.settings.value("analysis_budget", 0.25)),
+                                     overlay_size=OVERLAY_SIZE, on_result=self.analysis_ready.emit)
+        self.analyzer.set_layer("histogram", self.histogram_enabled)
+        self.set_peaking(self.peaking, self.peaking_level)
+        self.zebra = self.settings.value("zebra", "Off")
+        if self.zebra not in ZEBRA_LEVELS:
+            self.zebra = "Off"
+        self.set_zebra(self.zebra)
+        self.metering = self.settings.value("metering", "Matrix")
+        if self.metering not in METERING_MODES:
+            self.metering = "Matrix"
+        self.ev_compensation = self.settings.value("ev_compensation", "0")
+        if self.ev_compensation not in EV_STEPS:
+            self.ev_compensation = "0"
+        # the exposure program keeps the preview fluid up to aec_max_shutter before raising the ISO
+        self.aec = ExposureController(
+            iso_range=(int(ISO_VALUES[0]), int(ISO_VALUES[-1])),
+            shutter_range=(min(self.shutter_speeds.values()), max(self.shutter_speeds.values())),
+            max_auto_shutter=self.shutter_speeds.get(self.settings.value("aec_max_shutter", "1/30"), 33_333),
+            metering=METERING_MODES[self.metering], ev=float(self.ev_compensation))
+        self.analyzer.aec = self.aec
+        self.auto_exposure = False
+        if self.settings.value("auto_exposure", False, type=bool):
+            self.set_auto_exposure(True)
+        self.analyzer.start()
+        # runs on the camera thread, only copies the lores buffer now and then
+        self.picam2.set_post_callback(self.analyzer.submit)
 
         self.viewport_grid.addWidget(self.qpicamera2, 100)
 
         self.grid_overlay_enabled = False
-        self.grid_lines = []
 
         QFontDatabase.addApplicationFont("resources/fonts/Vegur-Regular.otf")
         QFontDatabase.addApplicationFont("resources/fonts/Vegur-Bold.otf")
@@ -163,11 +292,17 @@ class MainWindow(QWidget, Ui_FotoPi):
         self.timer.start(1000)
 
         self.exit_button.clicked.connect(self.close)
+        self.capture_button.pressed.connect(self.capture_pressed)
         self.capture_button.clicked.connect(self.capture_clicked)
         self.gallery_button.clicked.connect(self.open_gallery)
         self.options_button.clicked.connect(self.open_options)
         self.settings_button.clicked.connect(self.open_settings)
-        self.qpicamera2.done_signal.connect(self.capture_finished)
+        self.frame_captured.connect(self.capture_finished)
+        self.capture_failed.connect(self.capture_error)
+        self.file_written.connect(self.file_saved)
+        self.write_failed.connect(self.file_failed)
+        self.drive_finished.connect(self.drive_done)
+        self.analysis_ready.connect(self.analysis_done)
 
         self.iso_menu = QMenu()
         self.iso_menu.setFont(self.font3)
@@ -198,7 +333,8 @@ class MainWindow(QWidget, Ui_FotoPi):
         self.iso_button.setMenu(self.iso_menu)
         self.iso_button.setLayoutDirection(Qt.RightToLeft)
 
-        for isos in ["100", "200", "320", "400", "640", "800", "1600", "3200", "6400"]:
+        self.iso_menu.addAction("Auto")
+        for isos in ISO_VALUES:
             self.iso_menu.addAction(isos)
 
         self.iso_menu.triggered.connect(self.iso_selected)
@@ -283,21 +419,112 @@ class MainWindow(QWidget, Ui_FotoPi):
                     border-radius: 5px;
                 }
             """)
-        self.output_dropdown.addItems([".jpg", ".png", ".dng"])
+        self.output_dropdown.addItems([".jpg", ".png", ".dng", RAW_PLUS_JPEG])
         self.output_dropdown.setFixedHeight(50)
         self.output_dropdown.setFixedWidth(200)
         self.output_dropdown.setCurrentText(self.output_format)
         self.output_dropdown.currentTextChanged.connect(self.output_update)
 
+        self.drive_dropdown = QComboBox()
+        self.drive_dropdown.setLayoutDirection(Qt.LeftToRight)
+        self.drive_dropdown.setStyleSheet(self.output_dropdown.styleSheet())
+        self.drive_dropdown.addItems(list(DRIVE_MODES))
+        self.drive_dropdown.setFixedHeight(50)
+        self.drive_dropdown.setFixedWidth(200)
+        self.drive_dropdown.setCurrentText(self.drive_mode)
+        self.drive_dropdown.currentTextChanged.connect(self.drive_update)
+
+        self.peaking_dropdown = QComboBox()
+        self.peaking_dropdown.setLayoutDirection(Qt.LeftToRight)
+        self.peaking_dropdown.setStyleSheet(self.output_dropdown.styleSheet())
+        self.peaking_dropdown.addItems(["Off"] + list(PEAKING_COLOURS))
+        self.peaking_dropdown.setFixedHeight(50)
+        self.peaking_dropdown.setFixedWidth(200)
+        self.peaking_dropdown.setCurrentText(self.peaking)
+        self.peaking_dropdown.currentTextChanged.connect(self.peaking_update)
+
+        self.peaking_level_dropdown = QComboBox()
+        self.peaking_level_dropdown.setLayoutDirection(Qt.LeftToRight)
+        self.peaking_level_dropdown.setStyleSheet(self.output_dropdown.styleSheet())
+        self.peaking_level_dropdown.addItems(list(PEAKING_LEVELS))
+        self.peaking_level_dropdown.setFixedHeight(50)
+        self.peaking_level_dropdown.setFixedWidth(200)
+        self.peaking_level_dropdown.setCurrentText(self.peaking_level)
+        self.peaking_level_dropdown.currentTextChanged.connect(self.peaking_level_update)
+
+        self.zebra_dropdown = QComboBox()
+        self.zebra_dropdown.setLayoutDirection(Qt.LeftToRight)
+        self.zebra_dropdown.setStyleSheet(self.output_dropdown.styleSheet())
+        self.zebra_dropdown.addItems(["Off"] + list(ZEBRA_LEVELS))
+        self.zebra_dropdown.setFixedHeight(50)
+        self.zebra_dropdown.setFixedWidth(200)
+        self.zebra_dropdown.setCurrentText(self.zebra)
+        self.zebra_dropdown.currentTextChanged.connect(self.zebra_update)
+
+        self.metering_dropdown = QComboBox()
+        self.metering_dropdown.setLayoutDirection(Qt.LeftToRight)
+        self.metering_dropdown.setStyleSheet(self.output_dropdown.styleSheet())
+        self.metering_dropdown.addItems(list(METERING_MODES))
+        self.metering_dropdown.setFixedHeight(50)
+        self.metering_dropdown.setFixedWidth(200)
+        self.metering_dropdown.setCurrentText(self.metering)
+        self.metering_dropdown.currentTextChanged.connect(self.metering_update)
+
+        self.ev_dropdown = QComboBox()
+        self.ev_dropdown.setLayoutDirection(Qt.LeftToRight)
+        self.ev_dropdown.setStyleSheet(self.output_dropdown.styleSheet())
+        self.ev_dropdown.addItems(EV_STEPS)
+        self.ev_dropdown.setFixedHeight(50)
+        self.ev_dropdown.setFixedWidth(200)
+        self.ev_dropdown.setCurrentText(self.ev_compensation)
+        self.ev_dropdown.currentTextChanged.connect(self.ev_update)
+
+    def create_preview_widget(self):
+        if isinstance(self.picam2, Picamera2Backend):
+            from picamera2.previews.qt import QGlPicamera2
+            return QGlPicamera2(self.picam2.picam2, keep_ar=True)
+        return SimulatedPreview()
+
     def darkOverlayShow(self):
         self.left_overlay_blk.show()
         self.right_overlay_blk.show()
-        self.qpicamera2.set_overlay(self.overlay_blk)
+        self.overlay.set_dimmed(True)
+        self.update_overlay()
 
     def darkOverlayHide(self):
         self.left_overlay_blk.hide()
         self.right_overlay_blk.hide()
-        self.qpicamera2.set_overlay(None)
+        self.overlay.set_dimmed(False)
+        self.update_overlay()
+
+    def update_overlay(self):
+        # every texture upload repaints the GL preview, so only when something on it changed
+        if self.overlay.changed:
+            self.qpicamera2.set_overlay(self.overlay.render())
+
+    def analysis_done(self, layers):
+        controls = layers.pop("aec", None)
+        if controls and self.auto_exposure:
+            self.picam2.set_controls(controls)
+            self.update_exposure_labels()
+        if not layers:
+            return
+        for name, layer in layers.items():
+            self.overlay.set_layer(name, layer)
+        # a result may still arrive just after its layer was switched off
+        self.overlay.keep_layers(self.analyzer.layers)
+        self.update_overlay()
+
+    def closeEvent(self, event):
+        self.picam2.set_post_callback(None)
+        self.analyzer.stop()
+        self.engine.close(timeout=30)
+        self.cancel_gallery_loading()
+        dropped, unfinished = self.thumb_workers.shutdown()
+        if dropped or unfinished:
+            logging.info(f"Thumbnail workers stopped: {dropped} dropped, {unfinished} unfinished")
+        self.catalog.close()
+        super().closeEvent(event)
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Escape:
@@ -311,11 +538,43 @@ class MainWindow(QWidget, Ui_FotoPi):
         self.date_label.setText(now.strftime("%d.%m.%Y"))
 
     def iso_selected(self, action):
+        if action.text() == "Auto":
+            self.set_auto_exposure(True)
+            self.show_toast(f"Auto exposure: {self.metering}, {self.ev_compensation} EV", duration=2000)
+            return
         self.cur_iso = action.text()
+        if self.auto_exposure:
+            self.set_auto_exposure(False)
         self.iso_label.setText(self.cur_iso)
         iso_value = int(self.cur_iso)
         self.set_iso(iso_value)
 
+    def set_auto_exposure(self, enabled):
+        self.auto_exposure = enabled
+        self.settings.setValue("auto_exposure", enabled)
+        if enabled:
+            # start from wherever the manual exposure left off
+            self.aec.reset(self.current_exposure_us(), float(self.cur_iso) / 100)
+        self.analyzer.set_layer("aec", enabled, rate=float(self.settings.value("aec_rate", 10)))
+        if not enabled:
+            # back to the manual ISO and shutter speed
+            self.picam2.set_controls(self.exposure_controls())
+        self.update_exposure_labels()
+
+    def update_exposure_labels(self):
+        if self.auto_exposure:
+            self.iso_label.setText(f"A {round(self.aec.gain * 100)}")
+            self.shutter_label.setText(format_shutter(self.aec.exposure_us) + "s")
+        else:
+            self.iso_label.setText(self.cur_iso)
+            self.shutter_label.setText(self.cur_shutter + "s")
+
+    def exposure_settings(self):
+        """ISO, shutter speed label and exposure time in µs the next shot is taken with."""
+        if self.auto_exposure:
+            return str(round(self.aec.gain * 100)), format_shutter(self.aec.exposure_us), int(self.aec.exposure_us)
+        return self.cur_iso, self.cur_shutter, self.current_exposure_us()
+
     def set_iso(self, iso_value):
         self.picam2.set_controls({
             "AeEnable": False,
@@ -329,6 +588,8 @@ class MainWindow(QWidget, Ui_FotoPi):
         if action.text() == "Custom...":
             return
         self.cur_shutter = action.text()
+        if self.auto_exposure:
+            self.set_auto_exposure(False)
         self.shutter_label.setText(self.cur_shutter + "s")
 
         exposure_us = self.shutter_speeds.get(self.cur_shutter)
@@ -338,6 +599,13 @@ class MainWindow(QWidget, Ui_FotoPi):
         else:
             print(f"Shutter Speed {self.cur_shutter} not in list.")
 
+    def current_exposure_us(self):
+        exposure_us = self.shutter_speeds.get(self.cur_shutter)
+        if exposure_us is None:
+            # custom shutter speed, typed in seconds
+            exposure_us = int(float(self.cur_shutter) * 1_000_000)
+        return exposure_us
+
     def custom_shutter_selected(self):
         self.darkOverlayShow()
         panel = QWidget(self)
@@ -406,6 +674,8 @@ class MainWindow(QWidget, Ui_FotoPi):
                 seconds = float(value)
                 exposure_us = int(seconds * 1_000_000)
                 self.cur_shutter = value
+                if self.auto_exposure:
+                    self.set_auto_exposure(False)
                 self.shutter_label.setText(self.cur_shutter + "s")
                 self.picam2.set_controls({"ExposureTime": exposure_us})
                 self.show_toast(f"Shutter Speed set to: {self.cur_shutter}s", duration=2000)
@@ -473,295 +743,187 @@ class MainWindow(QWidget, Ui_FotoPi):
         panel.show()
         input_field.setFocus()
 
+    def capture_pressed(self):
+        # same clock as SensorTimestamp; zero lag commits the frame that was on the sensor now
+        self.press_ns = time.monotonic_ns()
+
     def capture_clicked(self):
+        if self.engine.drive_job is not None:
+            # second tap stops a running burst / interval series
+            self.engine.stop_drive()
+            return
         print(self.picam2.camera_controls)
-        self.capture_button.setEnabled(False)
         selected_format = self.settings.value("capture_format", ".jpg")
+        kind, value = DRIVE_MODES[self.drive_mode]
+        if kind == "burst":
+            self.start_burst(selected_format, value)
+            return
+        if kind == "interval":
+            self.start_interval(selected_format, value)
+            return
+        if kind == "stack":
+            self.start_stack(value)
+            return
+        if kind == "master":
+            self.start_master(value)
+            return
+        self.capture_button.setEnabled(False)
+        self.capture_in_progress = True
         # logging.error(f"Format: :{selected_format}:")
-        filename = self.get_next_filename(selected_format)
-        # sf = self.qpicamera2.signal_done
-        signal_with_filename = lambda job: self.capture_finished(job, filename)
-
-        if selected_format == ".dng":
-            cfg = self.picam2.create_still_configuration(raw={})
-            self.picam2.switch_mode_and_capture_file(cfg, filename, name="raw", signal_function=signal_with_filename)
-        else:
-            cfg = self.picam2.create_still_configuration(main={})
-            self.picam2.switch_mode_and_capture_file(cfg, filename, signal_function=signal_with_filename)
-
-        # cfg = self.picam2.create_still_configuration()
-        # filename = self.get_next_filename()
-
-    # def create_thumbnail(image_path, thumb_folder="images/thumbnails", size=(350, 250)):
-    #     if not os.path.exists(thumb_folder):
-    #         os.makedirs(thumb_folder)
-    #
-    #     with Image.open(image_path) as img:
-    #         img.thumbnail(size, Image.ANTIALIAS)
-    #         base_name = os.path.basename(image_path)
-    #         thumb_path = os.path.join(thumb_folder, base_name)
-    #         img.save(thumb_path, format="JPEG", quality=50)
-    #
-    #     return thumb_path
-
-    def capture_finished(self, job, filename):
-        self.picam2.wait(job)
-        # if job is not None:
-        #     self.picam2.wait(job)
-        # image_folder_path = self.settings.value("image_folder")
-        base_filename = os.path.basename(filename)
-        self.show_toast(f"Photo saved as: {base_filename}", duration=3000)
-        self.capture_button.setEnabled(True)
-
-    def get_next_filename(self, file_extension):
         if not os.path.exists(self.image_folder):
             os.makedirs(self.image_folder)
+        # the button is only enabled while the writer has room, so queuing the frame doesn't block
+        if kind == "precapture":
+            self.engine.commit_pre_capture(selected_format, self.press_ns, pre_roll=value,
+                                           on_captured=self.frame_captured.emit,
+                                           on_failed=self.capture_failed.emit)
+            return
+        self.engine.capture(selected_format, self.exposure_controls(), on_captured=self.frame_captured.emit,
+                            on_failed=self.capture_failed.emit)
 
-        supported_extensions = ('.jpg', '.jpeg', '.png', '.dng')
-        existing_files = [f for f in os.listdir(self.image_folder) if f.lower().endswith(supported_extensions)]
-
-        numbers = []
-        for f in existing_files:
-            parts = f.split("-")
-            if len(parts) > 0 and parts[0].isdigit():
-                numbers.append(int(parts[0]))
-
-        next_number = max(numbers) + 1 if numbers else 1
-        next_number_str = f"{next_number:03d}"
-
-        now = datetime.now()
-        timestamp = now.strftime("%d-%m-%Y-%H-%M")
+    def capture_finished(self, filename):
+        self.capture_in_progress = False
+        base_filename = os.path.basename(filename)
+        if self.output_format == RAW_PLUS_JPEG:
+            base_filename = os.path.splitext(base_filename)[0] + RAW_PLUS_JPEG
+        # only in memory so far, the writer reports when it is on the card (or why not)
+        self.show_toast(f"Photo captured: {base_filename}", duration=3000)
+        self.capture_button.setEnabled(self.engine.has_room(self.output_format))
+
+    def capture_error(self, filename, error):
+        # nothing was taken, so the shutter has to come back by itself
+        self.capture_in_progress = False
+        self.show_toast(f"Capture failed: {error}", duration=4000)
+        self.capture_button.setEnabled(self.engine.has_room(self.output_format))
+
+    def file_saved(self, filename, size=None, metadata=None):
+        self.catalog_capture(filename, size, metadata)
+        if filename.lower().endswith(GALLERY_FORMATS):
+            self.thumb_workers.submit(filename)
+        if not self.capture_in_progress and self.engine.has_room(self.output_format):
+            self.capture_button.setEnabled(True)
+
+    def file_failed(self, filename, error):
+        self.show_toast(f"Could not save {os.path.basename(filename)}: {error}", duration=5000)
+        if not self.capture_in_progress and self.engine.has_room(self.output_format):
+            self.capture_button.setEnabled(True)
+
+    def exposure_controls(self):
+        if self.auto_exposure:
+            # whatever the live auto exposure last settled on
+            return {"AeEnable": False, "AnalogueGain": self.aec.gain, "ExposureTime": int(self.aec.exposure_us)}
+        return {
+            "AeEnable": False,
+            "AnalogueGain": float(self.cur_iso) / 100,
+            "ExposureTime": self.current_exposure_us()
+        }
 
-        filename = f"{next_number_str}-{timestamp}{file_extension}"
-        filepath = os.path.join(self.image_folder, filename)
+    def start_burst(self, selected_format, frames):
+        # carry the manual ISO/shutter over into the still mode
+        self.engine.start_burst(selected_format, frames, self.exposure_controls(),
+                                on_finished=self.drive_finished.emit)
+        if frames:
+            self.show_toast(f"Burst: {frames} frames", duration=2000)
+        else:
+            self.show_toast("Burst running, tap again to stop", duration=3000)
 
-        return filepath
+    def start_interval(self, selected_format, interval):
+        frames = int(self.settings.value("interval_frames", 0))
+        stop_at = None
+        stop_time = self.settings.value("interval_stop", "")
+        if stop_time:
+            try:
+                hours, minutes = (int(v) for v in stop_time.split(":"))
+                stop = datetime.now().replace(hour=hours, minute=minutes, second=0, microsecond=0)
+                if stop <= datetime.now():
+                    stop += timedelta(days=1)
+                stop_at = stop.timestamp()
+            except ValueError:
+                logging.error(f"Ignoring invalid interval_stop setting: {stop_time}")
+        self.engine.start_interval(selected_format, interval, frames=frames, stop_at=stop_at,
+                                   controls_fn=self.exposure_controls,
+                                   on_finished=self.drive_finished.emit)
+        self.show_toast(f"Interval: every {interval}s, tap again to stop", duration=3000)
+
+    def start_stack(self, frames):
+        method = self.settings.value("stack_method", "sigma-clip")
+        output = self.settings.value("stack_output", ".dng")
+        dark_path = self.settings.value("stack_dark", "") or None
+        self.engine.start_stack(frames, method=method, output=output, dark_path=dark_path,
+                                controls=self.exposure_controls(), on_finished=self.drive_finished.emit)
+        self.show_toast(f"Stack: {frames} frames ({method}), tap again to stop early", duration=3000)
+
+    def start_master(self, kind):
+        frames = int(self.settings.value("calibration_frames", 16))
+        self.engine.start_master(kind, frames, method=self.settings.value("stack_method", "sigma-clip"),
+                                 controls=self.exposure_controls(), on_finished=self.drive_finished.emit)
+        hint = "lens capped" if kind == "dark" else "even light, about half exposure"
+        iso, shutter, _ = self.exposure_settings()
+        self.show_toast(f"Master {kind}: {frames} frames at ISO {iso}, {shutter}s ({hint})",
+                        duration=3000)
+
+    def drive_done(self, result):
+        self.engine.end_drive()
+        if result.error is not None:
+            self.show_toast(f"Capture failed: {result.error}", duration=4000)
+            return
+        if isinstance(result, BurstResult):
+            self.show_toast(f"Burst: {result.queued} frames, {result.fps:.1f} fps, {result.dropped} dropped",
+                            duration=4000)
+        elif isinstance(result, StackResult) and result.master == "flat" and not self.calibration.apply_flat:
+            self.show_toast(f"Master flat saved from {result.captured} frames, "
+                            f"applied once calibration_apply_flat is on", duration=4000)
+        elif isinstance(result, StackResult) and result.master:
+            self.show_toast(f"Master {result.master} saved from {result.captured} frames", duration=4000)
+        elif isinstance(result, StackResult):
+            self.show_toast(f"Stack: {result.captured} frames saved as {os.path.basename(result.filename)}",
+                            duration=4000)
+        else:
+            self.show_toast(f"Interval: {result.captured} shots, {len(result.overruns)} overruns",
+                            duration=4000)
+
+    def catalog_capture(self, filename, size=None, metadata=None):
+        width, height = size or (None, None)
+        metadata = metadata or {}
+        if metadata.get("ExposureTime") and metadata.get("AnalogueGain"):
+            # what this frame was taken with; the GUI may have moved on while it was queued
+            exposure_us = int(metadata["ExposureTime"])
+            iso, shutter = str(round(metadata["AnalogueGain"] * 100)), format_shutter(exposure_us)
+        else:
+            iso, shutter, exposure_us = self.exposure_settings()
+        try:
+            self.catalog.add(filename, width, height,
+                             iso=iso,
+                             shutter=shutter,
+                             exposure_us=exposure_us,
+                             awb=self.awb_value,
+                             saturation=self.saturation_value,
+                             contrast=self.contrast_value,
+                             sharpness=self.sharpness_value,
+                             brightness=self.brightness_value)
+        except Exception as e:
+            logging.error(f"Failed to catalog {filename}: {e}")
 
     def open_gallery(self):
-        self.current_page = 0
+        # picks up files copied in or deleted outside FotoPi, no-op if the folder didn't change
+        self.catalog.reconcile(probe=probe_size)
         # self.show_toast("Loading gallery, please wait...", duration=6000)
         # time.sleep(1)
         self.darkOverlayShow()
         self.show_gallery()
 
-    def show_gallery(self):
-        panel = QWidget(self)
-        panel.setStyleSheet("""
-            background-color: rgb(34, 47, 62);
-            border-radius: 15px;
-        """)
-        panel.setFixedSize(1620, 1080)
-
-        layout = QVBoxLayout()
-        layout.setContentsMargins(10, 5, 10, 5)
-
-        grid_widget = QWidget()
-        grid_layout = QGridLayout()
-        grid_layout.setSpacing(24)
-        panel.setLayoutDirection(Qt.LeftToRight)
-
-        folder = self.image_folder
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        image_files = sorted(
-            [f for f in os.listdir(folder) if f.lower().endswith(('.jpg', '.jpeg', '.png'))],
-            reverse=True
-        )
-
-        def closeBlkOverlay():
-            self.darkOverlayHide()
-            panel.hide()
-
-        start_idx = self.current_page * self.images_per_page
-        end_idx = start_idx + self.images_per_page
-        page_images = image_files[start_idx:end_idx]
-
-        def show_previous_page():
-            if self.current_page > 0:
-                self.current_page -= 1
-                panel.hide()
-                closeBlkOverlay()
-                self.show_gallery()
-
-        def show_next_page():
-            self.current_page += 1
-            panel.hide()
-            self.show_gallery()
-
-        def show_fullscreen_image(img_path, display_name):
-            grid_widget.hide()
-            fullscreen_widget.show()
-            pixmap = QPixmap(img_path)
-            fullscreen_name_label.setText(display_name)
-            fullscreen_image.setPixmap(pixmap.scaled(1200, 960, Qt.KeepAspectRatio, Qt.FastTransformation))
-            fullscreen_image.setAlignment(Qt.AlignCenter)
-            back_close_button.setText("Back")
-            next_button.hide()
-            prev_button.hide()
-
-        for idx, img_file in enumerate(page_images):
-            img_path = os.path.join(folder, img_file)
-            pixmap = QPixmap(img_path)
-
-            if not pixmap.isNull():
-                image_height = pixmap.height()
-                font_size = int(image_height * 0.085)
-
-                painter_pixmap = pixmap.copy()
-                painter = QPainter(painter_pixmap)
-                painter.setFont(QFont('Arial', font_size, QFont.Bold))
-
-                base_name = os.path.splitext(img_file)[0]
-                parts = base_name.split("-")
-                if len(parts) >= 6:
-                    num = parts[0]
-                    time_str = f"{parts[4]}:{parts[5]}"
-                    date_str = f"{parts[1]}.{parts[2]}.{parts[3]}"
-                    display_name = f"{num} | {time_str} | {date_str}"
-                else:
-                    display_name = base_name
-
-                padding = 15
-                rec_height = font_size + 8 * padding
-                text_rect = QRect(0, painter_pixmap.height() - rec_height, painter_pixmap.width(), rec_height)
-
-                painter.setBrush(QColor(0, 0, 0, 127))
-                painter.drawRect(text_rect)
-                painter.setPen(QColor(255, 255, 255))
-                painter.drawText(text_rect, Qt.AlignHCenter | Qt.AlignBottom, display_name)
-                painter.end()
-
-                img_container = QWidget()
-                img_layout = QVBoxLayout()
-                img_layout.setContentsMargins(5, 5, 5, 5)
-                img_layout.setSpacing(5)
-
-                img_label = QLabel()
-                img_label.setPixmap(painter_pixmap.scaled(400, 286, Qt.KeepAspectRatio, Qt.FastTransformation))
-                img_label.setAlignment(Qt.AlignCenter)
-                img_label.setCursor(Qt.PointingHandCursor)
-
-                img_label.mousePressEvent = lambda event, path=img_path, name=display_name: show_fullscreen_image(path,
-                                                                                                                  name)
-                img_layout.addWidget(img_label)
-                img_container.setLayout(img_layout)
-
-                row = idx // 3
-                col = idx % 3
-                grid_layout.addWidget(img_container, row, col)
-
-        grid_widget.setLayout(grid_layout)
-
-        fullscreen_widget = QWidget()
-        fullscreen_layout = QVBoxLayout()
-        fullscreen_layout.setContentsMargins(5, 15, 5, 5)
-        fullscreen_layout.setSpacing(10)
-
-        fullscreen_image = QLabel()
-        fullscreen_name_label = QLabel()
-        fullscreen_name_label.setAlignment(Qt.AlignCenter)
-        fullscreen_name_label.setStyleSheet("color: white; font-size: 32px; font-weight: bold;")
-        fullscreen_layout.addWidget(fullscreen_name_label)
-        fullscreen_layout.addWidget(fullscreen_image)
-
-        fullscreen_widget.setLayout(fullscreen_layout)
-        fullscreen_widget.hide()
-
-        nav_layout = QHBoxLayout()
-        nav_layout.setAlignment(Qt.AlignCenter)
-        nav_layout.setContentsMargins(35, 10, 35, 35)
-        nav_layout.setSpacing(125)
-        # Previous Button
-        prev_icon = QIcon()
-        prev_icon.addFile("resources/icons/left.png", QSize(), QIcon.Normal, QIcon.Off)
-        prev_button = QPushButton("")
-        prev_button.setIcon(prev_icon)
-        prev_size = QSize(127, 73)
-        prev_button.setIconSize(prev_size)
-        prev_button.setFixedWidth(156)
-        prev_button.setFixedHeight(73)
-        prev_button.setStyleSheet("""
-            QPushButton {
-                background-color: rgb(21, 29, 38);
-                color: white;
-                padding: 10px;
-                border: none;
-                border-radius: 5px;
-            }
-            QPushButton:hover {
-                background-color: #466180;
-            }
-        """)
-        prev_button.setFixedSize(184, 85)
-        prev_button.clicked.connect(show_previous_page)
-        nav_layout.addWidget(prev_button)
-
-        back_close_button = QPushButton("Close")
-        back_close_button.setFont(self.font4)
-        back_close_button.setStyleSheet("""
-            QPushButton {
-                background-color: #f44336;
-                color: white;
-                padding: 10px;
-                border: none;
-                border-radius: 5px;
-            }
-            QPushButton:hover {
-                background-color: #da190b;
-            }
-        """)
-        back_close_button.setFixedSize(184, 73)
-        nav_layout.addWidget(back_close_button)
-
-        # Next Button
-        next_icon = QIcon()
-        next_icon.addFile("resources/icons/right.png", QSize(), QIcon.Normal, QIcon.Off)
-        next_button = QPushButton("")
-        next_button.setIcon(next_icon)
-        next_size = QSize(127, 73)
-        next_button.setIconSize(next_size)
-        next_button.setFixedWidth(156)
-        next_button.setFixedHeight(73)
-        next_button.setStyleSheet("""
-            QPushButton {
-                background-color: rgb(21, 29, 38);
-                color: white;
-                padding: 10px;
-                border: none;
-                border-radius: 5px;
-            }
-            QPushButton:hover {
-                background-color: #466180;
-            }
-        """)
-        next_button.setFixedSize(184, 85)
-        next_button.clicked.connect(show_next_page)
-        nav_layout.addWidget(next_button)
-
-        def back_or_close():
-            if fullscreen_widget.isVisible():
-                fullscreen_widget.hide()
-                grid_widget.show()
-                back_close_button.setText("Close")
-                next_button.show()
-                prev_button.show()
-            else:
-                closeBlkOverlay()
-                panel.hide()
-
-        back_close_button.clicked.connect(back_or_close)
-
-        layout.addWidget(grid_widget)
-        layout.addWidget(fullscreen_widget)
-        layout.addLayout(nav_layout)
-
-        panel.setLayout(layout)
-        panel.move(
-            (1920 - panel.width()) // 2,
-            (1080 - panel.height()) // 2
-        )
+    def show_gallery(self, row=0):
+        if self.gallery_panel is None:
+            # built on first use and kept; only the rows on screen are ever loaded
+            self.gallery_panel = GalleryPanel(self, self.gallery_loader, self.preview_loader, self.font4)
+            self.gallery_panel.closed.connect(self.darkOverlayHide)
+        if not os.path.exists(self.image_folder):
+            os.makedirs(self.image_folder)
+        self.gallery_panel.open(self.catalog, self.image_folder, row)
 
-        panel.show()
+    def cancel_gallery_loading(self):
+        self.gallery_loader.cancel()
+        self.preview_loader.cancel()
 
     def open_options(self):
         self.darkOverlayShow()
@@ -770,7 +932,7 @@ class MainWindow(QWidget, Ui_FotoPi):
             background-color: rgb(21, 29, 38);
         """)
         panel.setLayoutDirection(Qt.LeftToRight)
-        panel.setFixedSize(900, 900)
+        panel.setFixedSize(900, 1000)
 
         layout = QVBoxLayout()
         layout.setContentsMargins(35, 35, 35, 35)
@@ -864,6 +1026,16 @@ class MainWindow(QWidget, Ui_FotoPi):
         toggle1.setChecked(self.grid_overlay_enabled)
         toggle1.stateChanged.connect(self.toggle_grid_overlay)
 
+        histogram_toggle = QCheckBox("Live histogram")
+        histogram_toggle.setStyleSheet(toggle1.styleSheet())
+        histogram_toggle.setChecked(self.histogram_enabled)
+        histogram_toggle.stateChanged.connect(self.toggle_histogram)
+
+        still_preview_toggle = QCheckBox("Still-resolution preview")
+        still_preview_toggle.setStyleSheet(toggle1.styleSheet())
+        still_preview_toggle.setChecked(self.engine.still_preview)
+        still_preview_toggle.stateChanged.connect(self.toggle_still_preview)
+
         output_label = QLabel("Output format", self)
         output_label.setStyleSheet("color: white; font-size: 28px;")
         output_spacer = QLabel("")
@@ -873,6 +1045,32 @@ class MainWindow(QWidget, Ui_FotoPi):
         output_layout.addWidget(output_label)
         # output_layout.addWidget(output_spacer)
 
+        peaking_label = QLabel("Focus peaking", self)
+        peaking_label.setStyleSheet("color: white; font-size: 28px;")
+        peaking_layout = QHBoxLayout()
+        peaking_layout.addWidget(self.peaking_dropdown)
+        peaking_layout.addWidget(self.peaking_level_dropdown)
+        peaking_layout.addWidget(peaking_label)
+
+        zebra_label = QLabel("Zebra", self)
+        zebra_label.setStyleSheet("color: white; font-size: 28px;")
+        zebra_layout = QHBoxLayout()
+        zebra_layout.addWidget(self.zebra_dropdown)
+        zebra_layout.addWidget(zebra_label)
+
+        aec_label = QLabel("Auto exposure", self)
+        aec_label.setStyleSheet("color: white; font-size: 28px;")
+        aec_layout = QHBoxLayout()
+        aec_layout.addWidget(self.metering_dropdown)
+        aec_layout.addWidget(self.ev_dropdown)
+        aec_layout.addWidget(aec_label)
+
+        drive_label = QLabel("Drive mode", self)
+        drive_label.setStyleSheet("color: white; font-size: 28px;")
+        drive_layout = QHBoxLayout()
+        drive_layout.addWidget(self.drive_dropdown)
+        drive_layout.addWidget(drive_label)
+
         # self.output_dropdown.currentIndexChanged.connect(self.output_update)
 
         # self.toggle2 = QCheckBox("YAPO - Yet Another Placeholder Option")
@@ -905,8 +1103,20 @@ class MainWindow(QWidget, Ui_FotoPi):
         toggles_layout.addStretch()
         toggles_layout.addWidget(toggle1)
         toggles_layout.addStretch()
+        toggles_layout.addWidget(histogram_toggle)
+        toggles_layout.addStretch()
+        toggles_layout.addWidget(still_preview_toggle)
+        toggles_layout.addStretch()
         toggles_layout.addLayout(output_layout)
         toggles_layout.addStretch()
+        toggles_layout.addLayout(drive_layout)
+        toggles_layout.addStretch()
+        toggles_layout.addLayout(peaking_layout)
+        toggles_layout.addStretch()
+        toggles_layout.addLayout(zebra_layout)
+        toggles_layout.addStretch()
+        toggles_layout.addLayout(aec_layout)
+        toggles_layout.addStretch()
         # toggles_layout.addWidget(self.toggle2)
 
         layout.addLayout(toggles_layout)
@@ -1008,10 +1218,25 @@ class MainWindow(QWidget, Ui_FotoPi):
         panel.show()
 
     def select_image_folder(self):
+        if self.capture_in_progress or self.engine.busy():
+            self.show_toast("Wait for the captures to finish \nbefore changing the folder", duration=4000)
+            return
         folder = QFileDialog.getExistingDirectory(self, "Select save path", self.image_folder)
         if folder:
+            try:
+                self.engine.set_folder(folder)
+            except RuntimeError as e:
+                self.show_toast(f"Folder not changed: {e}", duration=4000)
+                return
             self.image_folder = folder
             self.settings.setValue("image_folder", self.image_folder)
+            self.catalog.close()
+            self.catalog = ImageCatalog(self.image_folder)
+            self.catalog.reconcile(probe=probe_size)
+            self.thumbnails = ThumbnailCache(self.image_folder, self.thumb_cache_mb * 1024 * 1024)
+            self.thumb_workers.cache = self.thumbnails
+            self.gallery_loader.cache = self.thumbnails
+            self.preview_loader.cache = self.thumbnails
             self.folder_path_label.setText(self.image_folder)
             self.show_toast(f"New image folder set to: \n{self.image_folder} ", duration=4000)
 
@@ -1293,41 +1518,106 @@ class MainWindow(QWidget, Ui_FotoPi):
         except Exception as e:
             print(f"Failed to set output format: {e}")
 
-    def toggle_grid_overlay(self, state):
-        if state == Qt.Checked:
-            self.grid_overlay_enabled = True
-            self.add_grid_overlay()
-            self.show_toast("Grid Overlay enabled", duration=2000)
+    def drive_update(self, selected_text):
+        was_pre_capture = DRIVE_MODES[self.drive_mode][0] == "precapture"
+        self.settings.setValue("drive_mode", selected_text)
+        self.drive_mode = selected_text
+        self.show_toast(f"Drive mode set to: {self.drive_mode}", duration=3000)
+        is_pre_capture = DRIVE_MODES[self.drive_mode][0] == "precapture"
+        if is_pre_capture and not was_pre_capture:
+            self.start_pre_capture()
+        elif was_pre_capture and not is_pre_capture:
+            self.engine.stop_pre_capture()
+
+    def start_pre_capture(self):
+        try:
+            self.engine.start_pre_capture(int(self.settings.value("pre_capture_frames", 5)),
+                                          int(self.settings.value("pre_capture_memory_mb", 512)))
+        except Exception as e:
+            logging.error(f"Failed to start pre-capture: {e}")
+            self.show_toast("Pre-capture not available", duration=3000)
+
+    def toggle_still_preview(self, state):
+        enabled = state == Qt.Checked
+        try:
+            self.engine.set_still_preview(enabled)
+        except Exception as e:
+            logging.error(f"Failed to switch the preview mode: {e}")
+            self.show_toast("Could not switch the preview mode", duration=3000)
+            return
+        self.settings.setValue("still_preview", enabled)
+        if enabled:
+            self.show_toast("Still-resolution preview: shutter lag of one frame", duration=3000)
         else:
-            self.grid_overlay_enabled = False
-            self.remove_grid_overlay()
-            self.show_toast("Grid Overlay disabled", duration=2000)
-
-    def add_grid_overlay(self):
-        self.remove_grid_overlay()
-
-        for i in range(1, 4):
-            h_line = QFrame(self.qpicamera2)
-            h_line.setFrameShape(QFrame.HLine)
-            h_line.setFrameShadow(QFrame.Sunken)
-            h_line.setStyleSheet("background-color: rgba(255,255,255,1);")
-            h_line.setGeometry(0, i * self.height() // 4, self.width(), 2)
-            h_line.show()
-            self.grid_lines.append(h_line)
-
-        for i in range(1, 4):
-            v_line = QFrame(self.qpicamera2)
-            v_line.setFrameShape(QFrame.VLine)
-            v_line.setFrameShadow(QFrame.Sunken)
-            v_line.setStyleSheet("background-color: rgba(255,255,255,1);")
-            v_line.setGeometry(i * self.width() // 5, 0, 2, self.height())
-            v_line.show()
-            self.grid_lines.append(v_line)
-
-    def remove_grid_overlay(self):
-        for line in self.grid_lines:
-            line.deleteLater()
-        self.grid_lines.clear()
+            self.show_toast("Still-resolution preview disabled", duration=2000)
+
+    def toggle_histogram(self, state):
+        self.histogram_enabled = state == Qt.Checked
+        self.settings.setValue("histogram", self.histogram_enabled)
+        self.analyzer.set_layer("histogram", self.histogram_enabled)
+        if not self.histogram_enabled:
+            self.overlay.set_layer("histogram", None)
+            self.update_overlay()
+        self.show_toast(f"Live histogram {'enabled' if self.histogram_enabled else 'disabled'}", duration=2000)
+
+    def set_peaking(self, colour, level):
+        if colour in PEAKING_COLOURS:
+            self.analyzer.peaking_colour = PEAKING_COLOURS[colour]
+        self.analyzer.peaking_sensitivity = PEAKING_LEVELS[level]
+        # every few frames is enough for focusing by hand, the budget may skip more
+        self.analyzer.set_layer("peaking", colour in PEAKING_COLOURS,
+                                rate=float(self.settings.value("peaking_rate", 15)))
+        if colour not in PEAKING_COLOURS:
+            self.overlay.set_layer("peaking", None)
+            self.update_overlay()
+
+    def peaking_update(self, selected_text):
+        self.peaking = selected_text
+        self.settings.setValue("peaking", selected_text)
+        self.set_peaking(self.peaking, self.peaking_level)
+        self.show_toast(f"Focus peaking: {self.peaking}", duration=2000)
+
+    def peaking_level_update(self, selected_text):
+        self.peaking_level = selected_text
+        self.settings.setValue("peaking_level", selected_text)
+        self.set_peaking(self.peaking, self.peaking_level)
+        self.show_toast(f"Focus peaking sensitivity: {self.peaking_level}", duration=2000)
+
+    def set_zebra(self, level):
+        if level in ZEBRA_LEVELS:
+            self.analyzer.zebra_level = ZEBRA_LEVELS[level]
+        self.analyzer.set_layer("zebra", level in ZEBRA_LEVELS, rate=float(self.settings.value("zebra_rate", 10)))
+        if level not in ZEBRA_LEVELS:
+            self.overlay.set_layer("zebra", None)
+            self.update_overlay()
+
+    def zebra_update(self, selected_text):
+        self.zebra = selected_text
+        self.settings.setValue("zebra", selected_text)
+        self.set_zebra(self.zebra)
+        self.show_toast(f"Zebra: {self.zebra}", duration=2000)
+
+    def metering_update(self, selected_text):
+        self.metering = selected_text
+        self.settings.setValue("metering", selected_text)
+        self.aec.metering = METERING_MODES[selected_text]
+        self.aec.converged = False
+        self.show_toast(f"Metering: {self.metering}", duration=2000)
+
+    def ev_update(self, selected_text):
+        self.ev_compensation = selected_text
+        self.settings.setValue("ev_compensation", selected_text)
+        self.aec.ev = float(selected_text)
+        # a third of a stop is within the hold band, make it count
+        self.aec.converged = False
+        self.show_toast(f"Exposure compensation: {self.ev_compensation} EV", duration=2000)
+
+    def toggle_grid_overlay(self, state):
+        self.grid_overlay_enabled = state == Qt.Checked
+        # part of the preview's overlay, so it lines up with the picture rather than the window
+        self.overlay.set_grid(self.grid_overlay_enabled)
+        self.update_overlay()
+        self.show_toast(f"Grid Overlay {'enabled' if self.grid_overlay_enabled else 'disabled'}", duration=2000)
 
     def show_toast(self, message, duration=2000):
         toast = QLabel(message, self)
@@ -1354,6 +1644,7 @@ class MainWindow(QWidget, Ui_FotoPi):
 
 
 if __name__ == "__main__":
+    setup_logging()
     app = QApplication(sys.argv)
     window = MainWindow()
     # window.show()  # on for debugging (disable showFullScreen())
@@ -0,0 +1,215 @@
+"""Auto exposure convergence benchmark.
+
+Replays frame sequences through the ExposureController with a simulated
+sensor: every frame is re-exposed (in linear light) with the exposure the
+controller asked for, which takes effect `--latency` frames later as on
+the real pipeline. Reports, per sequence, metering mode and scene change:
+
+  settle       frames from the change until the metered error stays
+               within ExposureController.HOLD for the rest of the segment
+  overshoot    how far (EV) the exposure went past the target
+  reversals    times the exposure changed direction (hunting)
+  final        metered error (EV) on the last frame of the segment
+  update       controller time per metered frame (ms)
+
+Without --sequence it runs built in synthetic scenes (steps up and down,
+backlight, dusk, night). Recorded sequences are lores luma frames with the
+exposure they were taken at; record one on the Pi with the HQ camera
+(close FotoPi first), panning or changing the light while it runs:
+
+  python3 benchmarks/bench_aec.py
+  python3 benchmarks/bench_aec.py --record street.npz --frames 300 --exposure-us 10000 --gain 2
+  python3 benchmarks/bench_aec.py --sequence street.npz --latency 3
+"""
+import os, sys, time, argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_common import percentiles, write_report, print_table
+from resources.FotoPi_aec import ExposureController, METERING_MODES, linear_luma, encode_luma
+
+ISO_RANGE = (100, 6400)
+SHUTTER_RANGE = (1000, 1_000_000)
+# a middle grey scene at 1/30 s, ISO 400
+REFERENCE_TOTAL = 133_333
+LORES_SHAPE = (240, 320)
+
+
+def synthetic_scene(rng, shape=LORES_SHAPE):
+    """Relative radiance of a textured scene averaging middle grey at
+    REFERENCE_TOTAL: smooth lognormal blotches plus some fine detail."""
+    coarse = rng.normal(size=(shape[0] // 16 + 2, shape[1] // 16 + 2))
+    coarse = np.kron(coarse, np.ones((16, 16)))[:shape[0], :shape[1]]
+    scene = np.exp(0.8 * coarse + 0.2 * rng.normal(size=shape))
+    return (scene / scene.mean() * ExposureController.TARGET / REFERENCE_TOTAL).astype(np.float32)
+
+
+def synthetic_sequences(seed=1):
+    """name -> (radiance frames, indices of the scene changes)."""
+    rng = np.random.default_rng(seed)
+    scene = synthetic_scene(rng)
+    backlit = scene.copy()
+    # a window six stops brighter than the room, a quarter of the frame
+    backlit[:LORES_SHAPE[0] // 2, LORES_SHAPE[1] // 2:] *= 64
+    sequences = {
+        "step-up": ([scene] * 30 + [scene * 16] * 60, [0, 30]),
+        "step-down": ([scene * 16] * 30 + [scene] * 60, [0, 30]),
+        "big-step": ([scene / 64] * 40 + [scene * 64] * 60, [0, 40]),
+        "backlit": ([backlit] * 60, [0]),
+        # a tenth of a stop per frame, the controller has to track it
+        "dusk": ([scene * 2 ** (-i / 10) for i in range(80)] + [scene / 256] * 40, [0, 80]),
+        # darker than ISO 6400 at 1 s can fix: it has to pin at the limits, not hunt
+        "night": ([scene / 2 ** 17] * 60, [0]),
+    }
+    return sequences
+
+
+def load_sequence(path):
+    """A recorded sequence as radiance frames; clipped highlights stay
+    clipped, so their radiance is a lower bound."""
+    data = np.load(path)
+    totals = data["exposure_us"].astype(np.float64) * data["gain"]
+    frames = [linear_luma(luma) / total for luma, total in zip(data["luma"], totals)]
+    return frames, [0]
+
+
+def record(args):
+    from resources.FotoPi_analysis import lores_planes
+    from resources.FotoPi_engine import CaptureEngine, create_backend
+
+    engine = CaptureEngine(create_backend("picamera2"), args.folder or ".")
+    lumas, exposures, gains = [], [], []
+    try:
+        engine.configure()
+        engine.start({"AeEnable": False, "AnalogueGain": args.gain, "ExposureTime": args.exposure_us})
+        picam2 = engine.backend
+        for _ in range(args.frames):
+            request = picam2.capture_request()
+            try:
+                metadata = request.get_metadata()
+                luma, _ = lores_planes(request.make_buffer("lores"), request.config["lores"])
+            finally:
+                request.release()
+            lumas.append(luma.copy())
+            exposures.append(metadata["ExposureTime"])
+            gains.append(metadata["AnalogueGain"])
+    finally:
+        engine.close(timeout=30)
+    np.savez_compressed(args.record, luma=np.stack(lumas), exposure_us=np.array(exposures),
+                        gain=np.array(gains))
+    print(f"{len(lumas)} frames written to {args.record}")
+
+
+def replay(frames, changes, metering, args, rng):
+    """Run one sequence through the controller, returns the per-frame
+    metered error (EV), total exposures, update times and control changes."""
+    controller = ExposureController(ISO_RANGE, SHUTTER_RANGE, max_auto_shutter=args.max_auto_shutter,
+                                    metering=metering, ev=args.ev)
+    exposure_us, gain = controller.split(args.start_exposure_us * args.start_gain)
+    controller.reset(exposure_us, gain)
+    # controls waiting to take effect, (frame index, exposure, gain)
+    pending = []
+    errors, totals, updates = [], [], []
+    changed = 0
+    target = controller.TARGET * 2 ** args.ev
+    for index, radiance in enumerate(frames):
+        while pending and pending[0][0] <= index:
+            _, exposure_us, gain = pending.pop(0)
+        total = exposure_us * gain
+        linear = radiance * total
+        if args.noise:
+            linear = linear + rng.normal(scale=args.noise * np.sqrt(gain / 100), size=linear.shape)
+        luma = encode_luma(linear)
+        errors.append(float(np.log2(target / max(controller.meter(luma), 1e-4))))
+        totals.append(total)
+        if index % args.every:
+            continue
+        started = time.perf_counter()
+        controls = controller.update(luma, {"ExposureTime": int(exposure_us), "AnalogueGain": gain})
+        updates.append(time.perf_counter() - started)
+        if controls:
+            changed += 1
+            pending.append((index + args.latency, controls["ExposureTime"], controls["AnalogueGain"]))
+    return errors, totals, updates, changed
+
+
+def segment_stats(errors, totals, start, end):
+    hold = ExposureController.HOLD
+    settle = None
+    for i in range(end - 1, start - 1, -1):
+        if abs(errors[i]) > hold:
+            break
+        settle = i - start
+    initial = errors[start]
+    overshoot = max([-e if initial > 0 else e for e in errors[start:end]] + [0.0])
+    steps = [b / a for a, b in zip(totals[start:end], totals[start + 1:end]) if b != a]
+    reversals = sum(1 for a, b in zip(steps, steps[1:]) if (a > 1) != (b > 1))
+    return {
+        "initial_ev": round(initial, 2),
+        "settle_frames": settle,
+        "overshoot_ev": round(overshoot, 2),
+        "reversals": reversals,
+        "final_ev": round(errors[end - 1], 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FotoPi auto exposure benchmark")
+    parser.add_argument("--sequence", action="append", help="recorded .npz sequence (repeatable)")
+    parser.add_argument("--metering", nargs="+", default=list(METERING_MODES.values()),
+                        choices=list(METERING_MODES.values()))
+    parser.add_argument("--latency", type=int, default=2, help="frames until new controls take effect")
+    parser.add_argument("--every", type=int, default=1, help="meter every n-th frame")
+    parser.add_argument("--ev", type=float, default=0.0, help="exposure compensation")
+    parser.add_argument("--max-auto-shutter", type=int, default=33_333)
+    parser.add_argument("--start-exposure-us", type=int, default=33_333)
+    parser.add_argument("--start-gain", type=float, default=16.0)
+    parser.add_argument("--noise", type=float, default=0.002, help="read noise, linear full scale at ISO 100")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="record a sequence from the camera to this .npz instead")
+    parser.add_argument("--frames", type=int, default=300, help="frames to record")
+    parser.add_argument("--exposure-us", type=int, default=10_000, help="exposure to record at")
+    parser.add_argument("--gain", type=float, default=1.0, help="analogue gain to record at")
+    parser.add_argument("--folder", help="image folder for the engine while recording")
+    parser.add_argument("--output", default="bench_aec.json")
+    args = parser.parse_args(argv)
+
+    if args.record:
+        record(args)
+        return
+
+    if args.sequence:
+        sequences = {os.path.basename(path): load_sequence(path) for path in args.sequence}
+    else:
+        sequences = synthetic_sequences(args.seed)
+
+    rng = np.random.default_rng(args.seed)
+    results, rows, update_times = {}, [], []
+    for name, (frames, changes) in sequences.items():
+        results[name] = {}
+        for metering in args.metering:
+            errors, totals, updates, changed = replay(frames, changes, metering, args, rng)
+            update_times += updates
+            segments = []
+            for start, end in zip(changes, changes[1:] + [len(frames)]):
+                stats = segment_stats(errors, totals, start, end)
+                segments.append(stats)
+                rows.append({"sequence": name, "metering": metering, "frame": start,
+                             "error": stats["initial_ev"], "settle": stats["settle_frames"],
+                             "overshoot": stats["overshoot_ev"], "reversals": stats["reversals"],
+                             "final": stats["final_ev"]})
+            results[name][metering] = {"segments": segments, "control_changes": changed,
+                                       "update_ms": percentiles(updates)}
+    print_table(rows, ["sequence", "metering", "frame", "error", "settle", "overshoot", "reversals", "final"])
+    update_ms = percentiles(update_times)
+    print(f"update: p50 {update_ms.get('p50')} ms, p99 {update_ms.get('p99')} ms")
+    results["update_ms"] = update_ms
+
+    params = {k: v for k, v in vars(args).items() if k not in ("output", "record", "frames", "folder")}
+    write_report(args.output, "aec", params, results)
+
+
+if __name__ == "__main__":
+    main()
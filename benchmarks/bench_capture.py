@@ -0,0 +1,190 @@
+"""Capture latency benchmark.
+
+Measures, per output format (.jpg / .png / .dng / .dng+.jpg as chosen in
+the Output option):
+
+  shutter_to_ready  press until the frame is out of the camera and the
+                    capture button would be enabled again
+  shutter_to_file   press until the file (both files for RAW+JPEG) has been
+                    renamed into the image folder (encoded and fsync'ed)
+  inter_shot        time between presses when shooting as fast as the
+                    button allows
+  burst             sensor fps, drops and files/s for a fixed-length burst
+
+Run against the simulated camera on any machine, or on the Pi with the HQ
+camera attached (close FotoPi first):
+
+  python3 benchmarks/bench_capture.py --backend simulated
+  python3 benchmarks/bench_capture.py --backend simulated --still-preview
+  python3 benchmarks/bench_capture.py --backend picamera2 --folder /home/pi/bench
+"""
+import os, sys, time, shutil, argparse, tempfile, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_common import percentiles, write_report, print_table
+from resources.FotoPi_engine import CaptureEngine, SimulatedBackend, create_backend
+from resources.FotoPi_files import RAW_PLUS_JPEG, output_extensions
+
+FORMATS = (".jpg", ".png", ".dng", RAW_PLUS_JPEG)
+
+
+class WriteRecorder:
+    """on_written callback for the engine; remembers when each file landed."""
+
+    def __init__(self):
+        self.written = {}
+        self.cond = threading.Condition()
+
+    def __call__(self, filename, size=None, metadata=None):
+        with self.cond:
+            self.written[filename] = time.perf_counter()
+            self.cond.notify_all()
+
+    def wait_for(self, predicate, timeout):
+        with self.cond:
+            return self.cond.wait_for(predicate, timeout)
+
+
+def run_singles(engine, recorder, file_extension, shots, warmup, controls, timeout):
+    pressed = {}
+    shutter_to_ready = []
+    inter_shot = []
+    last_press = None
+    for i in range(warmup + shots):
+        captured = threading.Event()
+        t_press = time.perf_counter()
+        filenames = engine.capture(file_extension, controls, on_captured=lambda f: captured.set())
+        if not captured.wait(timeout):
+            raise RuntimeError(f"No frame within {timeout}s for {os.path.basename(filenames[0])}")
+        t_captured = time.perf_counter()
+        # MainWindow only re-enables the button while the writer queue has room
+        recorder.wait_for(lambda: engine.has_room(file_extension), timeout)
+        t_ready = time.perf_counter()
+        if i < warmup:
+            continue
+        pressed[tuple(filenames)] = t_press
+        shutter_to_ready.append(max(t_captured, t_ready) - t_press)
+        if last_press is not None:
+            inter_shot.append(t_press - last_press)
+        last_press = t_press
+
+    if not recorder.wait_for(lambda: all(f in recorder.written for files in pressed for f in files), timeout):
+        raise RuntimeError("Timed out waiting for the writer")
+    # until the last file of the capture is on disk
+    shutter_to_file = [max(recorder.written[f] for f in files) - t for files, t in pressed.items()]
+    return {
+        "shutter_to_ready_ms": percentiles(shutter_to_ready),
+        "shutter_to_file_ms": percentiles(shutter_to_file),
+        "inter_shot_ms": percentiles(inter_shot),
+    }
+
+
+def run_burst(engine, file_extension, frames, controls, timeout):
+    finished = threading.Event()
+    results = []
+
+    def on_finished(result):
+        results.append(result)
+        finished.set()
+
+    t0 = time.perf_counter()
+    engine.start_burst(file_extension, frames, controls, on_finished=on_finished)
+    if not finished.wait(timeout):
+        engine.stop_drive()
+        finished.wait()
+    engine.end_drive()
+    t_captured = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    while engine.writer.pending() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    t_flushed = time.perf_counter()
+
+    result = results[0]
+    return {
+        "frames": frames,
+        "captured": result.captured,
+        "queued": result.queued,
+        "dropped_sensor": result.dropped_sensor,
+        "dropped_queue": result.dropped_queue,
+        "sensor_fps": round(result.fps, 3),
+        "capture_s": round(t_captured - t0, 3),
+        "flush_s": round(t_flushed - t_captured, 3),
+        "files_per_s": round(result.queued * len(output_extensions(file_extension)) / max(t_flushed - t0, 1e-9), 3),
+        "error": str(result.error) if result.error is not None else None,
+    }
+
+
+def make_backend(args):
+    if args.backend == "simulated":
+        return SimulatedBackend(sensor_size=args.sensor_size, fps=args.fps, switch_latency=args.switch_latency)
+    return create_backend(args.backend)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FotoPi capture latency benchmark")
+    parser.add_argument("--backend", default="simulated", choices=("simulated", "picamera2"))
+    parser.add_argument("--formats", nargs="+", default=list(FORMATS), choices=FORMATS)
+    parser.add_argument("--shots", type=int, default=20, help="single shots per format")
+    parser.add_argument("--warmup", type=int, default=2, help="shots per format that are not counted")
+    parser.add_argument("--burst", type=int, default=25, help="burst length per format, 0 to skip")
+    parser.add_argument("--folder", help="image folder to write to (default: a temporary folder)")
+    parser.add_argument("--keep", action="store_true", help="keep the captured files")
+    parser.add_argument("--still-preview", action="store_true",
+                        help="stream at full resolution and capture without a mode switch")
+    parser.add_argument("--writer-threads", type=int, default=2)
+    parser.add_argument("--writer-queue", type=int, default=4)
+    parser.add_argument("--exposure-us", type=int, default=10_000)
+    parser.add_argument("--gain", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--sensor-size", type=int, nargs=2, default=(4056, 3040), help="simulated backend only")
+    parser.add_argument("--fps", type=float, default=10.0, help="simulated backend only")
+    parser.add_argument("--switch-latency", type=float, default=0.25, help="simulated backend only")
+    parser.add_argument("--output", default="bench_capture.json")
+    args = parser.parse_args(argv)
+
+    folder = args.folder or tempfile.mkdtemp(prefix="fotopi-bench-")
+    os.makedirs(folder, exist_ok=True)
+    controls = {"AeEnable": False, "AnalogueGain": args.gain, "ExposureTime": args.exposure_us}
+    recorder = WriteRecorder()
+    engine = CaptureEngine(make_backend(args), folder, writer_threads=args.writer_threads,
+                           writer_queue=args.writer_queue, on_written=recorder, still_preview=args.still_preview)
+    results = {}
+    try:
+        engine.configure()
+        engine.start(controls)
+        for file_extension in args.formats:
+            print(f"{file_extension}: {args.shots} single shots")
+            results[file_extension] = run_singles(engine, recorder, file_extension, args.shots, args.warmup,
+                                                  controls, args.timeout)
+            if args.burst:
+                print(f"{file_extension}: burst of {args.burst}")
+                results[file_extension]["burst"] = run_burst(engine, file_extension, args.burst, controls,
+                                                             args.timeout)
+    finally:
+        engine.close(timeout=args.timeout)
+        if not args.keep and not args.folder:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    rows = []
+    for file_extension, r in results.items():
+        burst = r.get("burst", {})
+        rows.append({
+            "format": file_extension,
+            "ready p50": r["shutter_to_ready_ms"]["p50"],
+            "file p50": r["shutter_to_file_ms"]["p50"],
+            "file p95": r["shutter_to_file_ms"]["p95"],
+            "inter p50": r["inter_shot_ms"].get("p50", ""),
+            "burst fps": burst.get("sensor_fps", ""),
+            "files/s": burst.get("files_per_s", ""),
+            "dropped": burst.get("dropped_sensor", 0) + burst.get("dropped_queue", 0) if burst else "",
+        })
+    print_table(rows, ["format", "ready p50", "file p50", "file p95", "inter p50", "burst fps", "files/s", "dropped"])
+
+    params = {k: v for k, v in vars(args).items() if k not in ("output", "keep")}
+    params["folder"] = args.folder
+    write_report(args.output, "capture", params, results)
+
+
+if __name__ == "__main__":
+    main()
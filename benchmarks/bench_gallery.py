@@ -0,0 +1,210 @@
+"""Gallery rendering benchmark.
+
+Fills a temporary image folder with 100, 1,000 and 10,000 synthetic 12MP
+captures (JPEG, every `--png-every`th one PNG) named like FotoPi names its
+files, then times MainWindow.show_gallery scrolled to the first, the
+middle and the last image on the offscreen Qt platform, until every tile
+on screen has its thumbnail, once with an empty thumbnail cache
+and once warm. Every folder size runs in its own process so the memory
+high-water marks don't bleed into each other.
+
+  python3 benchmarks/bench_gallery.py
+  python3 benchmarks/bench_gallery.py --counts 100 1000 --output gallery.json
+
+Files are hard links to a handful of encoded frames, so 10,000 images only
+cost the disk space of a few; pass --copy for real copies.
+"""
+import os, sys, json, time, shutil, argparse, tempfile, resource, subprocess
+from datetime import datetime, timedelta
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.bench_common import percentiles, write_report, print_table
+
+IMAGE_SIZE = (4056, 3040)
+VARIANTS = 4
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20, 1)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def make_sources(folder, size):
+    """Encode a few distinct 12MP frames once; everything else links to them."""
+    import numpy as np
+    from PyQt5.QtGui import QImage
+
+    sources = {}
+    w, h = size
+    y, x = np.indices((h, w), dtype=np.uint32)
+    for variant in range(VARIANTS):
+        rgb = np.empty((h, w, 4), dtype=np.uint8)
+        rgb[:, :, 0] = (x * (variant + 1) // 16) % 256
+        rgb[:, :, 1] = (y * (variant + 2) // 12) % 256
+        rgb[:, :, 2] = ((x + y) // (variant + 3)) % 256
+        rgb[:, :, 3] = 255
+        image = QImage(rgb.data, w, h, w * 4, QImage.Format_RGB32)
+        for ext, fmt in ((".jpg", "JPG"), (".png", "PNG")):
+            path = os.path.join(folder, f"source-{variant}{ext}")
+            image.save(path, fmt, 90 if fmt == "JPG" else -1)
+            sources[(variant, ext)] = path
+    return sources
+
+
+def fill_folder(folder, count, png_every, copy=False, size=IMAGE_SIZE):
+    from resources.FotoPi_files import format_filename
+
+    source_dir = os.path.join(folder, ".bench-sources")
+    os.makedirs(source_dir, exist_ok=True)
+    sources = make_sources(source_dir, size)
+    start = datetime(2025, 1, 1, 9, 0)
+    for number in range(1, count + 1):
+        ext = ".png" if png_every and number % png_every == 0 else ".jpg"
+        when = start + timedelta(minutes=number)
+        target = os.path.join(folder, format_filename(number, when, ext))
+        source = sources[(number % VARIANTS, ext)]
+        if copy:
+            shutil.copyfile(source, target)
+        else:
+            try:
+                os.link(source, target)
+            except OSError:
+                shutil.copyfile(source, target)
+
+
+def run_folder(folder, pages, repeats, timeout):
+    """Runs inside the child process: time show_gallery on `folder`."""
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    os.environ["FOTOPI_BACKEND"] = "simulated"
+    os.chdir(REPO_ROOT)
+    from PyQt5.QtCore import QSettings, QEventLoop
+    from PyQt5.QtWidgets import QApplication
+
+    app = QApplication([sys.argv[0]])
+    # keep the benchmark away from the real FotoPi settings
+    QSettings.setPath(QSettings.NativeFormat, QSettings.UserScope, os.path.join(folder, ".bench-settings"))
+    QSettings("FotoPi", "FotoPi").setValue("image_folder", folder)
+
+    import FotoPi
+    from resources.FotoPi_gallery import GALLERY_FORMATS
+    t0 = time.perf_counter()
+    window = FotoPi.MainWindow()
+    window.resize(1920, 1080)
+    window.show()
+    app.processEvents()
+    # includes indexing the folder into the (new) catalog
+    results = {"startup_s": round(time.perf_counter() - t0, 3), "rss_baseline_mb": rss_mb()}
+
+    total = window.catalog.count(formats=GALLERY_FORMATS)
+    rows = {"first": 0, "middle": total // 2, "last": max(0, total - 1)}
+
+    def show_page(row):
+        t0 = time.perf_counter()
+        window.show_gallery(row)
+        app.processEvents()
+        t_shown = time.perf_counter()
+        # done once every tile on screen has its thumbnail
+        panel = window.gallery_panel
+        ready = lambda: all(panel.model.is_ready(r) for r in panel.visible_rows())
+        deadline = time.monotonic() + timeout
+        while not ready() and time.monotonic() < deadline:
+            app.processEvents(QEventLoop.AllEvents, 20)
+        t_loaded = time.perf_counter()
+        ok = ready()
+        panel.close_gallery()
+        app.processEvents()
+        return t_shown - t0, t_loaded - t0, ok
+
+    for cache in ("cold", "warm"):
+        for name in pages:
+            row = rows[name]
+            shown, complete = [], []
+            if cache == "warm":
+                # earlier cold runs wiped the cache, render the page once untimed
+                show_page(row)
+            for _ in range(repeats):
+                if cache == "cold":
+                    shutil.rmtree(window.thumbnails.cache_dir, ignore_errors=True)
+                    window.thumbnails = FotoPi.ThumbnailCache(folder, window.thumb_cache_mb * 1024 * 1024)
+                    window.gallery_loader.cache = window.thumbnails
+                t_shown, t_loaded, ok = show_page(row)
+                if not ok:
+                    raise RuntimeError(f"Row {row} did not finish loading within {timeout}s")
+                shown.append(t_shown)
+                complete.append(t_loaded)
+            results[f"{cache}_{name}"] = {
+                "row": row,
+                "shown_ms": percentiles(shown),
+                "loaded_ms": percentiles(complete),
+                "rss_mb": rss_mb(),
+                "rss_peak_mb": peak_rss_mb(),
+            }
+
+    results["images"] = total
+    results["rss_peak_mb"] = peak_rss_mb()
+    window.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="FotoPi gallery rendering benchmark")
+    parser.add_argument("--counts", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--pages", nargs="+", default=["first", "middle", "last"],
+                        choices=("first", "middle", "last"))
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per page")
+    parser.add_argument("--png-every", type=int, default=10, help="every n-th image is a PNG, 0 for none")
+    parser.add_argument("--size", type=int, nargs=2, default=IMAGE_SIZE, help="synthetic image size")
+    parser.add_argument("--copy", action="store_true", help="copy instead of hard linking the images")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--keep", action="store_true", help="keep the generated folders")
+    parser.add_argument("--output", default="bench_gallery.json")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        results = run_folder(args.child, args.pages, args.repeats, args.timeout)
+        print(json.dumps(results))
+        return
+
+    results = {}
+    rows = []
+    for count in args.counts:
+        folder = tempfile.mkdtemp(prefix=f"fotopi-gallery-{count}-")
+        try:
+            print(f"{count} images: generating")
+            t0 = time.perf_counter()
+            fill_folder(folder, count, args.png_every, args.copy, tuple(args.size))
+            print(f"{count} images: generated in {time.perf_counter() - t0:.1f}s, running show_gallery")
+            child = [sys.executable, os.path.abspath(__file__), "--child", folder, "--repeats", str(args.repeats),
+                     "--timeout", str(args.timeout), "--pages", *args.pages]
+            proc = subprocess.run(child, stdout=subprocess.PIPE, text=True)
+            # the JSON is the last line, anything before it is noise from Qt / FotoPi
+            lines = proc.stdout.strip().splitlines()
+            if not lines or not lines[-1].startswith("{"):
+                raise RuntimeError(f"Benchmark process for {count} images failed with exit code {proc.returncode}")
+            results[str(count)] = json.loads(lines[-1])
+        finally:
+            if not args.keep:
+                shutil.rmtree(folder, ignore_errors=True)
+        r = results[str(count)]
+        for key, value in r.items():
+            if isinstance(value, dict):
+                rows.append({"images": count, "case": key, "row": value["row"],
+                             "shown p50": value["shown_ms"]["p50"], "loaded p50": value["loaded_ms"]["p50"],
+                             "loaded max": value["loaded_ms"]["max"], "rss peak MB": value["rss_peak_mb"]})
+
+    print_table(rows, ["images", "case", "row", "shown p50", "loaded p50", "loaded max", "rss peak MB"])
+    params = {k: v for k, v in vars(args).items() if k not in ("output", "keep", "child")}
+    write_report(args.output, "gallery", params, results)
+
+
+if __name__ == "__main__":
+    main()
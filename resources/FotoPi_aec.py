@@ -0,0 +1,144 @@
+import math
+
+import numpy as np
+
+METERING_MODES = {"Matrix": "matrix", "Centre": "centre", "Spot": "spot"}
+# exposure compensation in third stops
+EV_STEPS = ["-2", "-1.7", "-1.3", "-1", "-0.7", "-0.3", "0", "+0.3", "+0.7", "+1", "+1.3", "+1.7", "+2"]
+# sRGB-ish display gamma of the lores stream, undone before averaging
+_LINEAR = ((np.arange(256) / 255.0) ** 2.2).astype(np.float32)
+
+
+def linear_luma(luma):
+    return _LINEAR[luma]
+
+
+def encode_luma(linear):
+    """Inverse of linear_luma, for simulating exposure changes on recorded frames."""
+    return np.rint(np.clip(linear, 0.0, 1.0) ** (1 / 2.2) * 255).astype(np.uint8)
+
+
+class ExposureController:
+    """Software auto exposure on lores luma frames. Drives ExposureTime and
+    AnalogueGain (with AeEnable off) within `iso_range` and
+    `shutter_range` (µs): the shutter opens up to `max_auto_shutter` first,
+    then the gain goes up, then the remaining slower shutter speeds.
+
+    Every update meters the frame (matrix, centre-weighted or spot), in
+    linear light, against middle grey shifted by `ev` and moves the
+    exposure by DAMPING of the error, at most MAX_STEP EV. The step is taken
+    from the exposure the frame was actually taken with (its metadata), and
+    frames still in flight from before a change (up to MAX_WAIT of them)
+    are skipped rather than stepping again on a stale picture, so with the
+    damping below 1 it converges geometrically, in a bounded number of
+    updates, without overshoot. Once within DEADBAND it holds until the
+    error exceeds HOLD, so noise doesn't make it hunt."""
+
+    TARGET = 0.18
+    DEADBAND = 1 / 6
+    HOLD = 1 / 3
+    DAMPING = 0.85
+    MAX_STEP = 2.0
+    # frames to wait for the last controls to show up in the metadata; the sensor rounds
+    # exposure times to whole lines and gains to register steps, hence the tolerance
+    MAX_WAIT = 6
+    MATCH_TOLERANCE = 0.05
+    # matrix metering zones (rows, columns); a zone counts for at most this many times the median zone
+    ZONES = (6, 8)
+    ZONE_CLAMP = 4.0
+    # spot metering: share of the frame area
+    SPOT_AREA = 0.03
+
+    def __init__(self, iso_range=(100, 6400), shutter_range=(1000, 1_000_000), max_auto_shutter=33_333,
+                 metering="matrix", ev=0.0):
+        self.min_gain, self.max_gain = iso_range[0] / 100, iso_range[1] / 100
+        self.min_exposure, self.max_exposure = shutter_range
+        self.max_auto_shutter = min(max(max_auto_shutter, self.min_exposure), self.max_exposure)
+        self.metering = metering
+        self.ev = ev
+        self.exposure_us = self.max_auto_shutter
+        self.gain = self.min_gain
+        self.error = 0.0
+        self.converged = False
+        self._waiting = 0
+        self._weights = {}
+
+    def reset(self, exposure_us, gain):
+        self.exposure_us, self.gain = exposure_us, gain
+        self.converged = False
+        self._waiting = 0
+
+    def _applied(self, exposure, gain):
+        return (abs(exposure - self.exposure_us) <= self.MATCH_TOLERANCE * self.exposure_us
+                and abs(gain - self.gain) <= self.MATCH_TOLERANCE * self.gain)
+
+    def split(self, total):
+        """ExposureTime (µs) and AnalogueGain for a total exposure
+        (µs x gain), following the exposure program."""
+        total = min(max(total, self.min_exposure * self.min_gain), self.max_exposure * self.max_gain)
+        exposure = min(max(total / self.min_gain, self.min_exposure), self.max_auto_shutter)
+        gain = min(max(total / exposure, self.min_gain), self.max_gain)
+        exposure = min(max(total / gain, self.min_exposure), self.max_exposure)
+        return exposure, gain
+
+    def _centre_weights(self, shape):
+        key = ("centre", shape)
+        weights = self._weights.get(key)
+        if weights is None:
+            y, x = np.indices(shape, dtype=np.float32)
+            cy, cx = (shape[0] - 1) / 2, (shape[1] - 1) / 2
+            # falls to about a third at the frame edges
+            sigma = 0.35 * math.hypot(shape[0], shape[1]) / 2
+            weights = np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / (2 * sigma ** 2))
+            weights /= weights.sum()
+            self._weights[key] = weights
+        return weights
+
+    def _spot_mask(self, shape):
+        key = ("spot", shape)
+        mask = self._weights.get(key)
+        if mask is None:
+            y, x = np.indices(shape)
+            radius = math.sqrt(self.SPOT_AREA * shape[0] * shape[1] / math.pi)
+            mask = (y - (shape[0] - 1) / 2) ** 2 + (x - (shape[1] - 1) / 2) ** 2 <= radius ** 2
+            self._weights[key] = mask
+        return mask
+
+    def meter(self, luma):
+        """Weighted mean of the frame in linear light, 0..1."""
+        linear = linear_luma(luma)
+        if self.metering == "spot":
+            return float(linear[self._spot_mask(luma.shape)].mean())
+        if self.metering == "centre":
+            return float((linear * self._centre_weights(luma.shape)).sum())
+        rows, columns = self.ZONES
+        h, w = luma.shape[0] // rows * rows, luma.shape[1] // columns * columns
+        zones = linear[:h, :w].reshape(rows, h // rows, columns, w // columns).mean(axis=(1, 3))
+        # a bright window or the sun doesn't get to darken the whole picture
+        zones = np.minimum(zones, self.ZONE_CLAMP * max(float(np.median(zones)), 1e-4))
+        return float(zones.mean())
+
+    def update(self, luma, metadata=None):
+        """Meter a frame; returns the controls to set, or None to keep the
+        current ones."""
+        exposure = (metadata or {}).get("ExposureTime") or self.exposure_us
+        gain = (metadata or {}).get("AnalogueGain") or self.gain
+        if self._waiting and not self._applied(exposure, gain):
+            # taken before the last change took effect
+            self._waiting -= 1
+            return None
+        self._waiting = 0
+        measured = max(self.meter(luma), 1e-4)
+        self.error = math.log2(self.TARGET * 2 ** self.ev / measured)
+        if abs(self.error) <= (self.HOLD if self.converged else self.DEADBAND):
+            self.converged = True
+            return None
+        self.converged = False
+        step = max(-self.MAX_STEP, min(self.MAX_STEP, self.DAMPING * self.error))
+        exposure_us, gain = self.split(exposure * gain * 2 ** step)
+        if abs(exposure_us - self.exposure_us) < 0.01 * self.exposure_us and abs(gain - self.gain) < 0.01 * self.gain:
+            # pinned at a limit, or already asked for
+            return None
+        self.exposure_us, self.gain = exposure_us, gain
+        self._waiting = self.MAX_WAIT if metadata else 0
+        return {"AeEnable": False, "ExposureTime": int(exposure_us), "AnalogueGain": gain}
@@ -0,0 +1,300 @@
+import time, threading, logging
+
+import numpy as np
+from PyQt5.QtCore import Qt, QRect
+from PyQt5.QtGui import QImage, QPainter, QColor, QFont
+
+HISTOGRAM_BINS = 64
+HISTOGRAM_SIZE = (256, 96)
+HISTOGRAM_TEXT_HEIGHT = 26
+# 8 bit levels counted as blown highlights / crushed shadows
+HIGHLIGHT_LEVEL = 250
+SHADOW_LEVEL = 5
+# clipping above this percentage is shown in red
+CLIP_WARNING = 1.0
+
+PEAKING_COLOURS = {
+    "Red": (255, 40, 40),
+    "Green": (40, 255, 40),
+    "Yellow": (255, 230, 0),
+    "Blue": (40, 120, 255),
+    "White": (255, 255, 255),
+}
+PEAKING_LEVELS = {"Low": 0.3, "Medium": 0.5, "High": 0.7}
+# Sobel |gx| + |gy| below this is sensor noise, even in a flat, featureless frame
+PEAKING_MIN_EDGE = 60
+
+# luma levels in percent of full scale
+ZEBRA_LEVELS = {"90%": 90, "95%": 95, "100%": 100}
+# stripe period in overlay pixels
+ZEBRA_PERIOD = 8
+_zebra_patterns = {}
+
+
+def _yuv420_planes(buffer, config):
+    if not (config.get("format") or "").startswith("YUV420"):
+        raise ValueError(f"Unsupported lores format {config.get('format')}")
+    width, height = config["size"]
+    stride = config["stride"]
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    chroma_size = stride // 2 * height // 2
+    y = data[:stride * height].reshape(height, stride)[:, :width]
+    u = data[stride * height:stride * height + chroma_size].reshape(height // 2, stride // 2)[:, :width // 2]
+    v = data[stride * height + chroma_size:stride * height + 2 * chroma_size] \
+        .reshape(height // 2, stride // 2)[:, :width // 2]
+    return y, u, v
+
+
+def lores_luma(buffer, config, max_width=640):
+    y = _yuv420_planes(buffer, config)[0]
+    step = max(1, y.shape[1] // max_width)
+    return y[::step, ::step]
+
+
+def lores_planes(buffer, config, max_width=320):
+    """Luma (h, w) and RGB (h/2, w/2, 3) uint8 arrays of a YUV420 lores
+    buffer, subsampled to at most about `max_width` pixels across (in the
+    still preview the lores stream is the full size display stream)."""
+    y, u, v = _yuv420_planes(buffer, config)
+    step = max(1, y.shape[1] // max_width)
+    luma = y[::step, ::step]
+    # full range BT.601, at chroma resolution
+    yc = y[::2 * step, ::2 * step].astype(np.float32)
+    cb = u[::step, ::step].astype(np.float32) - 128
+    cr = v[::step, ::step].astype(np.float32) - 128
+    h, w = min(yc.shape[0], cb.shape[0]), min(yc.shape[1], cb.shape[1])
+    yc, cb, cr = yc[:h, :w], cb[:h, :w], cr[:h, :w]
+    rgb = np.stack([yc + 1.402 * cr, yc - 0.344136 * cb - 0.714136 * cr, yc + 1.772 * cb], axis=2)
+    return luma, np.clip(rgb, 0, 255).astype(np.uint8)
+
+
+class Histogram:
+    """Per channel bin counts as fractions of the pixels, and the share of
+    clipped highlights (any channel) and shadows (luma) in percent."""
+
+    def __init__(self, red, green, blue, luma, highlights, shadows):
+        self.red = red
+        self.green = green
+        self.blue = blue
+        self.luma = luma
+        self.highlights = highlights
+        self.shadows = shadows
+
+    def __repr__(self):
+        return f"Histogram(highlights={self.highlights:.1f}%, shadows={self.shadows:.1f}%)"
+
+
+def histogram(luma, rgb, bins=HISTOGRAM_BINS):
+    shift = 8 - (int(bins).bit_length() - 1)
+    n_rgb = rgb.shape[0] * rgb.shape[1]
+    channels = [np.bincount((rgb[:, :, c] >> shift).ravel(), minlength=bins) / n_rgb for c in range(3)]
+    luma_counts = np.bincount((luma >> shift).ravel(), minlength=bins) / luma.size
+    highlights = 100.0 * np.count_nonzero(rgb.max(axis=2) >= HIGHLIGHT_LEVEL) / n_rgb
+    shadows = 100.0 * np.count_nonzero(luma <= SHADOW_LEVEL) / luma.size
+    return Histogram(*channels, luma_counts, highlights, shadows)
+
+
+def render_histogram(hist, size=HISTOGRAM_SIZE):
+    """The histogram as an RGBA panel for the overlay: additive R, G and B
+    areas (white where all three overlap), the luma curve on top and the
+    clipping percentages underneath."""
+    width, height = size
+    panel = np.zeros((height + HISTOGRAM_TEXT_HEIGHT, width, 4), dtype=np.uint8)
+    panel[:, :, 3] = 140
+    bins = len(hist.luma)
+    columns = np.arange(width) * bins // width
+    # scaled without the end bins, so a clipped spike doesn't flatten the rest
+    peak = max(max(c[1:-1].max() for c in (hist.red, hist.green, hist.blue, hist.luma)), 1e-6)
+    rows = np.arange(height)[:, None]
+    plot = panel[:height]
+    for channel, counts in enumerate((hist.red, hist.green, hist.blue)):
+        tops = height - np.minimum(counts[columns] / peak, 1.0) * height
+        mask = rows >= tops[None, :]
+        plot[:, :, channel][mask] = 230
+        plot[:, :, 3][mask] = 210
+    luma_tops = (height - np.minimum(hist.luma[columns] / peak, 1.0) * height).astype(int).clip(0, height - 1)
+    plot[luma_tops, np.arange(width)] = (255, 255, 255, 255)
+
+    image = QImage(panel.data, width, panel.shape[0], width * 4, QImage.Format_RGBA8888)
+    painter = QPainter(image)
+    font = QFont("Arial")
+    font.setBold(True)
+    font.setPixelSize(HISTOGRAM_TEXT_HEIGHT - 6)
+    painter.setFont(font)
+    text_rect = QRect(0, height, width, HISTOGRAM_TEXT_HEIGHT)
+    for value, label, align in ((hist.shadows, "▼", Qt.AlignLeft), (hist.highlights, "▲", Qt.AlignRight)):
+        painter.setPen(QColor(255, 70, 70) if value > CLIP_WARNING else QColor(255, 255, 255))
+        painter.drawText(text_rect.adjusted(6, 0, -6, 0), align | Qt.AlignVCenter, f"{label} {value:.1f}%")
+    painter.end()
+    # QImage painted on its own copy of the array
+    bits = image.constBits()
+    bits.setsize(image.byteCount())
+    return np.frombuffer(bits, dtype=np.uint8).reshape(panel.shape).copy()
+
+
+def zebra_pattern(size, period=ZEBRA_PERIOD):
+    """Diagonal black / white stripes covering an overlay of `size`,
+    created once per size; a frame's zebra is just this copied in where the
+    mask is set."""
+    key = (tuple(size), period)
+    pattern = _zebra_patterns.get(key)
+    if pattern is None:
+        width, height = size
+        y, x = np.indices((height, width))
+        white = (x + y) // (period // 2) % 2 == 0
+        pattern = np.empty((height, width, 4), dtype=np.uint8)
+        pattern[white] = (255, 255, 255, 170)
+        pattern[~white] = (0, 0, 0, 170)
+        _zebra_patterns[key] = pattern
+    return pattern
+
+
+def edge_magnitude(luma):
+    """Sobel |gx| + |gy| of a uint8 image, one pixel smaller on every side."""
+    l = luma.astype(np.int16)
+    # separable: smooth across, difference along
+    smooth = l[:-2] + 2 * l[1:-1] + l[2:]
+    gx = smooth[:, 2:] - smooth[:, :-2]
+    diff = l[2:] - l[:-2]
+    gy = diff[:, :-2] + 2 * diff[:, 1:-1] + diff[:, 2:]
+    return np.abs(gx) + np.abs(gy)
+
+
+def peaking_mask(luma, sensitivity):
+    """In-focus edges: the pixels whose edge magnitude is within
+    `sensitivity` of the strongest edge in the frame."""
+    magnitude = edge_magnitude(luma)
+    threshold = max(int(magnitude.max() * (1.0 - sensitivity)), PEAKING_MIN_EDGE)
+    mask = np.zeros(luma.shape, dtype=bool)
+    mask[1:-1, 1:-1] = magnitude >= threshold
+    return mask
+
+
+class LiveAnalyzer(threading.Thread):
+    """Live view analyses (histogram, focus peaking, zebra, auto exposure) on the lores stream,
+    on their own thread. submit() is the camera's post callback: it only
+    copies the small lores buffer, and only when a layer is due (each has
+    its own rate per second) and the analyses stay within `budget`, the
+    share of one core they may use; frames in between are skipped, so the
+    camera and the GL preview keep the sensor rate. Only the newest frame
+    is kept.
+
+    on_result({layer: array}) is invoked from this thread, with the layers
+    computed from that frame: RGBA panels, except for zebra, which is a
+    boolean mask to blend zebra_pattern() through. Full frame layers
+    (peaking, zebra) come at `overlay_size`. The "aec" layer meters the
+    frame with `aec` (an ExposureController) and, when the exposure should
+    change, its result is the controls to set instead of an image."""
+
+    def __init__(self, rate=5.0, budget=0.25, overlay_size=(720, 540), on_result=None):
+        super().__init__(name="FotoPi-analysis", daemon=True)
+        self.rate = rate
+        self.budget = budget
+        self.overlay_size = tuple(overlay_size)
+        self.on_result = on_result
+        self.layers = set()
+        self.rates = {}
+        self.last_histogram = None
+        self.peaking_colour = PEAKING_COLOURS["Red"]
+        self.peaking_sensitivity = PEAKING_LEVELS["Medium"]
+        self.zebra_level = ZEBRA_LEVELS["95%"]
+        self.aec = None
+        self.skipped = 0
+        self._cond = threading.Condition()
+        self._frame = None
+        self._due = {}
+        self._hold_until = 0.0
+        self._resize = {}
+        self._running = True
+
+    def set_layer(self, name, enabled, rate=None):
+        if enabled:
+            self.rates[name] = rate or self.rates.get(name) or self.rate
+            self.layers.add(name)
+        else:
+            self.layers.discard(name)
+
+    def submit(self, request):
+        now = time.monotonic()
+        due = {name for name in self.layers if now >= self._due.get(name, 0.0)}
+        if not due:
+            return
+        if now < self._hold_until:
+            self.skipped += 1
+            return
+        config = request.config.get("lores")
+        if not config:
+            # still mode, between a mode switch and back
+            return
+        for name in due:
+            self._due[name] = now + 1.0 / self.rates[name]
+        buffer = request.make_buffer("lores")
+        # the exposure this frame was actually taken with, which lags the controls by a few frames
+        metadata = request.get_metadata() if "aec" in due else None
+        with self._cond:
+            if self._frame is not None:
+                # not picked up yet, its layers are still owed
+                due |= self._frame[2]
+            self._frame = (buffer, dict(config), due, metadata)
+            self._cond.notify()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def _resize_index(self, shape):
+        index = self._resize.get(shape)
+        if index is None:
+            width, height = self.overlay_size
+            index = (np.arange(height) * shape[0] // height)[:, None], np.arange(width) * shape[1] // width
+            self._resize[shape] = index
+        return index
+
+    def render_peaking(self, mask):
+        rows, columns = self._resize_index(mask.shape)
+        width, height = self.overlay_size
+        layer = np.zeros((height, width, 4), dtype=np.uint8)
+        layer[mask[rows, columns]] = (*self.peaking_colour, 255)
+        return layer
+
+    def analyse(self, buffer, config, due=None, metadata=None):
+        due = self.layers if due is None else due & self.layers
+        layers = {}
+        if due & {"histogram", "zebra", "aec"}:
+            luma, rgb = lores_planes(buffer, config)
+        if "aec" in due and self.aec is not None:
+            controls = self.aec.update(luma, metadata)
+            if controls:
+                layers["aec"] = controls
+        if "histogram" in due:
+            self.last_histogram = histogram(luma, rgb)
+            layers["histogram"] = render_histogram(self.last_histogram)
+        if "zebra" in due:
+            # compared at 320 across, only the mask is scaled up
+            rows, columns = self._resize_index(luma.shape)
+            layers["zebra"] = (luma >= round(self.zebra_level * 255 / 100))[rows, columns]
+        if "peaking" in due:
+            mask = peaking_mask(lores_luma(buffer, config), self.peaking_sensitivity)
+            layers["peaking"] = self.render_peaking(mask)
+        return layers
+
+    def run(self):
+        while True:
+            with self._cond:
+                while self._running and self._frame is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                frame, self._frame = self._frame, None
+            started = time.monotonic()
+            try:
+                layers = self.analyse(*frame)
+            except Exception as e:
+                logging.error(f"Live analysis failed: {e}")
+                continue
+            finally:
+                # e.g. 20 ms of work at a budget of 0.25 means no new frame for 80 ms
+                self._hold_until = started + (time.monotonic() - started) / self.budget
+            if self.on_result is not None:
+                self.on_result(layers)
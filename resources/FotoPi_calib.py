@@ -0,0 +1,192 @@
+import os, json, time, threading, logging
+
+import numpy as np
+
+from resources.FotoPi_stack import raw_frame, raw_bits, bayer_order, black_level
+
+INDEX_FILE = "index.json"
+# a flat corner darker than this fraction of the mean is left alone rather than amplified into noise
+MAX_FLAT_GAIN = 4.0
+
+
+def exposure_key(metadata):
+    """(ISO, exposure time in µs, sensor temperature in °C or None) of a
+    capture. Digital gain is applied after the raw readout, so only the
+    analogue gain counts."""
+    iso = int(round(float(metadata.get("AnalogueGain", 1.0)) * 100))
+    temperature = metadata.get("SensorTemperature")
+    return iso, int(metadata.get("ExposureTime", 0)), None if temperature is None else float(temperature)
+
+
+class CalibrationLibrary:
+    """Master darks and flats for raw captures, kept in `root` as .npy
+    files (float32, sensor units) with a small JSON index.
+
+    Darks are keyed by ISO, exposure time and sensor temperature; a capture
+    uses the dark with the same ISO, an exposure within EXPOSURE_TOLERANCE
+    and the closest temperature within TEMPERATURE_TOLERANCE. Flats are
+    stored as per-pixel gains (the flat normalised per Bayer channel and
+    inverted). Nothing ties a flat to the lens and aperture it was taken
+    with, so flats are only applied with `apply_flat`, and then the newest
+    flat of the right size applies to every capture. Masters are
+    memory-mapped once and shared by all writer threads, so a shot only
+    pays for the array math."""
+
+    EXPOSURE_TOLERANCE = 0.1
+    TEMPERATURE_TOLERANCE = 5.0
+
+    def __init__(self, root, apply_flat=False):
+        self.root = root
+        self.apply_flat = apply_flat
+        self._lock = threading.Lock()
+        self._arrays = {}
+        self.entries = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.root, INDEX_FILE)) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logging.error(f"Could not read the calibration index in {self.root}: {e}")
+            return []
+        return [e for e in entries if os.path.exists(os.path.join(self.root, e["file"]))]
+
+    def _save_index(self):
+        path = os.path.join(self.root, INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def _array(self, entry):
+        with self._lock:
+            array = self._arrays.get(entry["file"])
+            if array is None:
+                # pages come in from the SD card as the math touches them, and stay in the page cache
+                array = np.load(os.path.join(self.root, entry["file"]), mmap_mode="r")
+                self._arrays[entry["file"]] = array
+            return array
+
+    def _add(self, entry, array, replaces):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, entry["file"])
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, np.ascontiguousarray(array, dtype=np.float32))
+        os.replace(path + ".tmp", path)
+        with self._lock:
+            old = [e for e in self.entries if replaces(e)]
+            self.entries = [e for e in self.entries if not replaces(e)] + [entry]
+            self._save_index()
+            for e in old:
+                self._arrays.pop(e["file"], None)
+        for e in old:
+            try:
+                os.remove(os.path.join(self.root, e["file"]))
+            except OSError as err:
+                logging.error(f"Could not remove a replaced calibration master: {err}")
+        return path
+
+    def _entry(self, kind, stacked, metadata, config, frames):
+        iso, exposure_us, temperature = exposure_key(metadata)
+        h, w = stacked.shape
+        name = f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}-iso{iso}-{exposure_us}us.npy"
+        return {"kind": kind, "file": name, "size": [w, h], "bits": raw_bits(config), "iso": iso,
+                "exposure_us": exposure_us, "temperature": temperature, "frames": frames,
+                "created": time.time()}
+
+    def add_dark(self, stacked, metadata, config, frames):
+        """Store a stacked dark (in sensor units) as the master for its ISO,
+        exposure time and temperature. Returns the file it was saved to."""
+        entry = self._entry("dark", stacked, metadata, config, frames)
+
+        def same_settings(e):
+            return (e["kind"] == "dark" and e["size"] == entry["size"] and e["iso"] == entry["iso"]
+                    and e["exposure_us"] == entry["exposure_us"]
+                    and (e["temperature"] is None or entry["temperature"] is None
+                         or round(e["temperature"]) == round(entry["temperature"])))
+
+        return self._add(entry, stacked, same_settings)
+
+    def add_flat(self, stacked, metadata, config, frames):
+        """Store a stacked flat as the master flat for its frame size, dark
+        (or black level) subtracted and turned into per-pixel gains."""
+        entry = self._entry("flat", stacked, metadata, config, frames)
+        bits = entry["bits"]
+        dark = self.dark_for(metadata, stacked.shape, bits)
+        signal = stacked - (dark if dark is not None else black_level(metadata, bits))
+        gain = np.empty(stacked.shape, dtype=np.float32)
+        for dy in (0, 1):
+            for dx in (0, 1):
+                plane = signal[dy::2, dx::2]
+                mean = float(plane.mean())
+                if mean < 0.05 * ((1 << bits) - 1):
+                    raise ValueError("The flat is too dark, expose it to about half the histogram")
+                gain[dy::2, dx::2] = mean / np.maximum(plane, mean / MAX_FLAT_GAIN)
+        return self._add(entry, gain, lambda e: e["kind"] == "flat" and e["size"] == entry["size"])
+
+    def find_dark(self, metadata, shape):
+        iso, exposure_us, temperature = exposure_key(metadata)
+        size = [shape[1], shape[0]]
+        best, best_score = None, None
+        for e in self.entries:
+            if e["kind"] != "dark" or e["size"] != size or e["iso"] != iso:
+                continue
+            exposure_error = abs(e["exposure_us"] - exposure_us) / max(exposure_us, 1)
+            if exposure_error > self.EXPOSURE_TOLERANCE:
+                continue
+            temperature_error = 0.0
+            if temperature is not None and e["temperature"] is not None:
+                temperature_error = abs(e["temperature"] - temperature)
+                if temperature_error > self.TEMPERATURE_TOLERANCE:
+                    continue
+            score = (temperature_error, exposure_error)
+            if best is None or score < best_score:
+                best, best_score = e, score
+        return best
+
+    def find_flat(self, shape):
+        size = [shape[1], shape[0]]
+        flats = [e for e in self.entries if e["kind"] == "flat" and e["size"] == size]
+        return max(flats, key=lambda e: e["created"]) if flats else None
+
+    def dark_for(self, metadata, shape, bits):
+        """The matching master dark in the units of `bits` bit frames, or None."""
+        entry = self.find_dark(metadata, shape)
+        if entry is None:
+            return None
+        dark = self._array(entry)
+        return dark if entry["bits"] == bits else dark * np.float32(2.0 ** (bits - entry["bits"]))
+
+    def correct(self, frame, metadata, bits):
+        """`frame` (sensor units) dark subtracted and flat corrected, as
+        float32 with the black level kept, or None if there is no master for
+        it."""
+        dark = self.dark_for(metadata, frame.shape, bits)
+        flat = self.find_flat(frame.shape) if self.apply_flat else None
+        if dark is None and flat is None:
+            return None
+        black = np.float32(black_level(metadata, bits))
+        out = frame.astype(np.float32)
+        if dark is not None:
+            out -= dark
+        else:
+            out -= black
+        if flat is not None:
+            out *= self._array(flat)
+        out += black
+        return np.clip(out, 0, (1 << bits) - 1, out=out)
+
+    def apply(self, buffer, metadata, config):
+        """The raw buffer of a capture calibrated with the matching masters,
+        as an unpacked 16 bit container buffer and the config to go with it.
+        The buffer and config are returned unchanged when nothing matches."""
+        frame = raw_frame(buffer, config)
+        bits = raw_bits(config)
+        out = self.correct(frame, metadata, bits)
+        if out is None:
+            return buffer, config
+        raw = np.rint(out, out=out).astype(np.uint16)
+        h, w = raw.shape
+        return raw.view(np.uint8).reshape(-1), {**config, "format": f"S{bayer_order(config)}{bits}",
+                                                  "size": (w, h), "stride": w * 2}
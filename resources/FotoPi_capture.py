@@ -0,0 +1,575 @@
+import os, time, queue, threading, logging
+from collections import deque
+
+import numpy as np
+
+from resources.FotoPi_files import output_extensions
+from resources.FotoPi_dng import write_tiff
+from resources.FotoPi_stack import make_stacker, raw_frame, raw_bits, bayer_order, black_level, load_dark, \
+    calibrate, to_raw16, to_rgb16
+
+INCOMING_DIR = os.path.join(".fotopi", "incoming")
+
+
+class WriteJob:
+    """A captured frame that has been copied out of the camera's request
+    buffer and is waiting to be encoded and written to `filename`."""
+
+    def __init__(self, filename, stream, buffer, metadata, config):
+        self.filename = filename
+        self.stream = stream
+        self.buffer = buffer
+        self.metadata = metadata
+        self.config = config
+        # already dark / flat corrected, the writer leaves it alone
+        self.calibrated = False
+
+    @classmethod
+    def from_request(cls, request, filename, stream):
+        # copies the buffer, the request can be released right after this
+        return cls(filename, stream, request.make_buffer(stream), request.get_metadata(),
+                   dict(request.config[stream]))
+
+
+def stream_for(filename):
+    return "raw" if filename.lower().endswith(".dng") else "main"
+
+
+def write_jobs(request, filenames):
+    """One WriteJob per output file of a capture, all copied out of the
+    same request, so RAW+JPEG comes from a single sensor readout."""
+    return [WriteJob.from_request(request, filename, stream_for(filename)) for filename in filenames]
+
+
+class ImageWriter:
+    """Encode + fsync stage behind a bounded queue. Capture code only has to
+    copy the sensor frame out of the request buffer and submit() it; the
+    JPEG/PNG/DNG encode and the write to the SD card run on `workers`
+    threads. Files are written into a hidden incoming folder and renamed
+    into place once they are on disk, so the gallery never sees half a file.
+    With a `calibration` library, raw captures that have matching master
+    darks / flats are corrected on the writer threads before they are saved.
+
+    on_written(filename, size, metadata) and on_failed(filename, error) are
+    invoked from the writer threads; metadata is the frame's own."""
+
+    def __init__(self, helpers, sequence, workers=2, max_queue=4, on_written=None, on_failed=None,
+                 calibration=None):
+        self.helpers = helpers
+        self.sequence = sequence
+        self.calibration = calibration
+        self.on_written = on_written
+        self.on_failed = on_failed
+        self.max_queue = max_queue
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        # producers put under this, so submit_all sees a room check hold until it has queued
+        self._submit_lock = threading.Lock()
+        self._in_flight = 0
+        self.written = 0
+        self.failed = 0
+        self._threads = [threading.Thread(target=self._run, name=f"FotoPi-writer-{i}", daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, job, block=True, timeout=None):
+        with self._submit_lock:
+            try:
+                self._queue.put(job, block=block, timeout=timeout)
+            except queue.Full:
+                return False
+        with self._lock:
+            self._in_flight += 1
+        return True
+
+    def submit_all(self, jobs):
+        """Queue all of `jobs` (the files of one frame) without blocking,
+        or none of them if there isn't room for every one."""
+        with self._submit_lock:
+            if not self.has_room(len(jobs)):
+                return False
+            # the writer threads only ever make more room
+            for job in jobs:
+                self._queue.put_nowait(job)
+        with self._lock:
+            self._in_flight += len(jobs)
+        return True
+
+    def has_room(self, count=1):
+        return self._queue.qsize() + count <= self.max_queue
+
+    def pending(self):
+        with self._lock:
+            return self._in_flight
+
+    def close(self, timeout=None):
+        """Write everything still queued, then stop the threads. Returns the
+        number of jobs that did not make it to disk within `timeout`."""
+        for _ in self._threads:
+            self._queue.put(None)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return self.pending()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self.write(job)
+                with self._lock:
+                    self.written += 1
+                if self.on_written is not None:
+                    self.on_written(job.filename, job.config.get("size"), job.metadata)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                logging.error(f"Failed to write {os.path.basename(job.filename)}: {e}")
+                if self.on_failed is not None:
+                    self.on_failed(job.filename, e)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+
+    def write(self, job):
+        folder, name = os.path.split(job.filename)
+        incoming = os.path.join(folder, INCOMING_DIR)
+        os.makedirs(incoming, exist_ok=True)
+        # same extension, so picamera2 picks the right encoder
+        tmp = os.path.join(incoming, name)
+        if job.stream == "raw":
+            buffer, config = job.buffer, job.config
+            if self.calibration is not None and not job.calibrated:
+                buffer, config = self.calibration.apply(buffer, job.metadata, config)
+            self.helpers.save_dng(buffer, job.metadata, config, tmp)
+        elif job.stream == "rgb16":
+            write_tiff(tmp, job.buffer)
+        else:
+            self.helpers.save(self.helpers.make_image(job.buffer, job.config), job.metadata, tmp)
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, job.filename)
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.sequence.note_written(job.filename)
+
+
+class BurstResult:
+    def __init__(self):
+        self.captured = 0
+        self.queued = 0
+        self.dropped_sensor = 0
+        self.dropped_queue = 0
+        self.duration = 0.0
+        self.fps = 0.0
+        self.error = None
+
+    @property
+    def dropped(self):
+        return self.dropped_sensor + self.dropped_queue
+
+    def __repr__(self):
+        return (f"BurstResult(captured={self.captured}, queued={self.queued}, fps={self.fps:.2f}, "
+                f"dropped_sensor={self.dropped_sensor}, dropped_queue={self.dropped_queue})")
+
+
+class BurstCapture(threading.Thread):
+    """Continuous shooting: switches to the still configuration once, pulls
+    frames back to back at the sensor rate and hands copies of the buffers
+    to the ImageWriter, so the camera never waits on JPEG encoding or the
+    SD card. Frames that arrive while the writer queue is full are dropped
+    and counted. `frames=0` runs until stop() is called. With no
+    `still_config` the frames come straight from the running configuration.
+
+    on_finished is invoked from this thread."""
+
+    def __init__(self, picam2, still_config, restore_config, sequence, writer, file_extension, frames=0,
+                 on_finished=None):
+        super().__init__(name="FotoPi-burst", daemon=True)
+        self.picam2 = picam2
+        self.still_config = still_config
+        self.restore_config = restore_config
+        self.sequence = sequence
+        self.writer = writer
+        self.file_extension = file_extension
+        self.extensions = output_extensions(file_extension)
+        self.frames = frames
+        self.on_finished = on_finished
+        self.result = BurstResult()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _count_sensor_drops(self, metadata, last_ts):
+        ts = metadata.get("SensorTimestamp")
+        frame_ns = metadata.get("FrameDuration", 0) * 1000
+        if last_ts is not None and ts is not None and frame_ns > 0:
+            missed = round((ts - last_ts) / frame_ns) - 1
+            if missed > 0:
+                self.result.dropped_sensor += missed
+        return ts
+
+    def run(self):
+        first_ts = last_ts = None
+        t0 = time.monotonic()
+        try:
+            if self.still_config is not None:
+                self.picam2.switch_mode(self.still_config)
+            while not self._stop_event.is_set():
+                if self.frames and self.result.captured >= self.frames:
+                    break
+                request = self.picam2.capture_request()
+                try:
+                    metadata = request.get_metadata()
+                    jobs = []
+                    # don't pay for the copy if there is nowhere to put it
+                    if self.writer.has_room(len(self.extensions)):
+                        jobs = write_jobs(request, self.sequence.next_filenames(self.extensions))
+                finally:
+                    # give the buffer back to the camera straight away
+                    request.release()
+                self.result.captured += 1
+                last_ts = self._count_sensor_drops(metadata, last_ts)
+                if first_ts is None:
+                    first_ts = last_ts
+                # a RAW+JPEG pair is queued whole or dropped whole
+                if jobs and self.writer.submit_all(jobs):
+                    self.result.queued += 1
+                else:
+                    self.result.dropped_queue += 1
+        except Exception as e:
+            logging.error(f"Burst capture failed: {e}")
+            self.result.error = e
+        finally:
+            try:
+                if self.restore_config is not None:
+                    self.picam2.switch_mode(self.restore_config)
+            except Exception as e:
+                logging.error(f"Could not restore preview mode after burst: {e}")
+
+        if first_ts is not None and last_ts is not None and last_ts > first_ts:
+            self.result.duration = (last_ts - first_ts) / 1e9
+            self.result.fps = (self.result.captured - 1) / self.result.duration
+        else:
+            self.result.duration = time.monotonic() - t0
+        logging.info(f"Burst finished: {self.result}")
+        if self.on_finished is not None:
+            self.on_finished(self.result)
+
+
+class Overrun:
+    def __init__(self, frame, busy, skipped):
+        self.frame = frame
+        self.busy = busy
+        self.skipped = skipped
+
+    def __repr__(self):
+        return f"Overrun(frame={self.frame}, busy={self.busy:.3f}s, skipped={self.skipped})"
+
+
+class IntervalResult:
+    def __init__(self):
+        self.captured = 0
+        self.overruns = []
+        self.max_late = 0.0
+        self.error = None
+
+    @property
+    def skipped(self):
+        return sum(o.skipped for o in self.overruns)
+
+    def __repr__(self):
+        return (f"IntervalResult(captured={self.captured}, overruns={len(self.overruns)}, "
+                f"skipped={self.skipped}, max_late={self.max_late * 1000:.1f}ms)")
+
+
+class IntervalCapture(threading.Thread):
+    """Timelapse / interval shooting on a fixed grid of monotonic deadlines
+    (start + k * interval), so timing errors never accumulate. If a shot,
+    including waiting for room in the writer queue, runs past the next
+    deadline, the missed slots are skipped and recorded as an Overrun
+    instead of shifting the rest of the series.
+
+    `make_config()` is called before every shot so the current ISO and
+    shutter settings are used; if it returns None the shot is taken from
+    the running configuration. on_finished is invoked from this thread."""
+
+    def __init__(self, picam2, make_config, sequence, writer, file_extension, interval, frames=0, stop_at=None,
+                 on_finished=None):
+        super().__init__(name="FotoPi-interval", daemon=True)
+        self.picam2 = picam2
+        self.make_config = make_config
+        self.sequence = sequence
+        self.writer = writer
+        self.file_extension = file_extension
+        self.extensions = output_extensions(file_extension)
+        self.interval = interval
+        self.frames = frames
+        self.stop_at = stop_at
+        self.on_finished = on_finished
+        self.result = IntervalResult()
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _finished(self):
+        if self.frames and self.result.captured >= self.frames:
+            return True
+        return self.stop_at is not None and time.time() >= self.stop_at
+
+    def run(self):
+        start = time.monotonic()
+        slot = 0
+        try:
+            while not self._finished():
+                deadline = start + slot * self.interval
+                # stop_at can pass while waiting for the slot
+                if self._stop_event.wait(max(0.0, deadline - time.monotonic())) or self._finished():
+                    break
+                fired = time.monotonic()
+                self.result.max_late = max(self.result.max_late, fired - deadline)
+
+                config = self.make_config()
+                if config is None:
+                    request = self.picam2.capture_request()
+                else:
+                    request = self.picam2.switch_mode_and_capture_request(config)
+                try:
+                    jobs = write_jobs(request, self.sequence.next_filenames(self.extensions))
+                finally:
+                    request.release()
+                # blocks while the SD card is behind, which then shows up as an overrun
+                for job in jobs:
+                    self.writer.submit(job)
+                self.result.captured += 1
+
+                done = time.monotonic()
+                slot += 1
+                next_deadline = start + slot * self.interval
+                if done > next_deadline:
+                    skipped = int((done - next_deadline) // self.interval) + 1
+                    overrun = Overrun(self.result.captured, done - fired, skipped)
+                    self.result.overruns.append(overrun)
+                    logging.warning(f"Interval overrun: {overrun}, interval {self.interval}s")
+                    slot += skipped
+        except Exception as e:
+            logging.error(f"Interval capture failed: {e}")
+            self.result.error = e
+        logging.info(f"Interval finished: {self.result}")
+        if self.on_finished is not None:
+            self.on_finished(self.result)
+
+
+class StackResult:
+    def __init__(self, method):
+        self.method = method
+        # "dark" / "flat" for a calibration master
+        self.master = None
+        self.captured = 0
+        self.rejected = 0
+        self.duration = 0.0
+        self.filename = None
+        self.error = None
+
+    def __repr__(self):
+        return (f"StackResult(method={self.method}, captured={self.captured}, rejected={self.rejected}, "
+                f"duration={self.duration:.1f}s, filename={self.filename})")
+
+
+class StackCapture(threading.Thread):
+    """Multi-frame stacking for low noise at high ISO: `frames` raw frames
+    go through a streaming accumulator (see FotoPi_stack), so only the
+    accumulator and the current frame are in memory, never the series.
+    The result is dark frame subtracted, with the DNG at `dark_path` or
+    else the matching masters of the `calibration` library, and queued
+    for the writer as a 16 bit DNG or, with `output` ".tif", as a half
+    resolution 16 bit RGB TIFF. Stopping early stacks what was captured.
+
+    on_finished is invoked from this thread."""
+
+    def __init__(self, picam2, still_config, restore_config, sequence, writer, frames, method="sigma-clip",
+                 output=".dng", dark_path=None, calibration=None, on_finished=None):
+        super().__init__(name="FotoPi-stack", daemon=True)
+        self.picam2 = picam2
+        self.still_config = still_config
+        self.restore_config = restore_config
+        self.sequence = sequence
+        self.writer = writer
+        self.frames = frames
+        self.method = method
+        self.output = output
+        self.dark_path = dark_path
+        self.calibration = calibration
+        self.on_finished = on_finished
+        self.result = StackResult(method)
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _save(self, stacked, metadata, config):
+        bits = raw_bits(config)
+        white = (1 << bits) - 1
+        black = black_level(metadata, bits)
+        dark = load_dark(self.dark_path, bits) if self.dark_path else None
+        if dark is not None and dark.shape != stacked.shape:
+            raise ValueError(f"Dark frame is {dark.shape[::-1]}, the frames are {stacked.shape[::-1]}")
+        if dark is None and self.calibration is not None:
+            corrected = self.calibration.correct(stacked, metadata, bits)
+            if corrected is not None:
+                stacked = corrected
+        stacked = calibrate(stacked, dark, black, white)
+        filename = self.sequence.next_filename(self.output)
+        if self.output == ".tif":
+            rgb = to_rgb16(stacked, bayer_order(config), black, white)
+            job = WriteJob(filename, "rgb16", rgb, metadata, {"size": (rgb.shape[1], rgb.shape[0])})
+        else:
+            raw = to_raw16(stacked, bits)
+            h, w = raw.shape
+            raw_config = {"format": f"S{bayer_order(config)}16", "size": (w, h), "stride": w * 2}
+            job = WriteJob(filename, "raw", raw.view(np.uint8).reshape(-1), metadata, raw_config)
+        job.calibrated = True
+        self.writer.submit(job)
+        return filename
+
+    def run(self):
+        t0 = time.monotonic()
+        stacker = make_stacker(self.method)
+        first = None
+        try:
+            if self.still_config is not None:
+                self.picam2.switch_mode(self.still_config)
+            while self.result.captured < self.frames and not self._stop_event.is_set():
+                request = self.picam2.capture_request()
+                try:
+                    config = dict(request.config["raw"])
+                    frame = raw_frame(request.make_buffer("raw"), config)
+                    if first is None:
+                        first = (request.get_metadata(), config)
+                finally:
+                    request.release()
+                # the camera exposes the next frame meanwhile
+                stacker.add(frame)
+                self.result.captured += 1
+        except Exception as e:
+            logging.error(f"Stack capture failed: {e}")
+            self.result.error = e
+        finally:
+            try:
+                if self.restore_config is not None:
+                    self.picam2.switch_mode(self.restore_config)
+            except Exception as e:
+                logging.error(f"Could not restore preview mode after stacking: {e}")
+
+        if first is not None:
+            try:
+                self.result.filename = self._save(stacker.result(), *first)
+            except Exception as e:
+                logging.error(f"Could not save the stacked image: {e}")
+                self.result.error = e
+        self.result.rejected = getattr(stacker, "rejected", 0)
+        self.result.duration = time.monotonic() - t0
+        logging.info(f"Stack finished: {self.result}")
+        if self.on_finished is not None:
+            self.on_finished(self.result)
+
+
+class MasterCapture(StackCapture):
+    """Stacks a master dark (`kind` "dark": lens capped, at the ISO and
+    shutter speed it is meant for) or a master flat ("flat": an evenly lit,
+    unfocused target) into a CalibrationLibrary instead of a photo."""
+
+    def __init__(self, picam2, still_config, restore_config, library, kind, frames, method="sigma-clip",
+                 on_finished=None):
+        super().__init__(picam2, still_config, restore_config, None, None, frames, method=method,
+                         on_finished=on_finished)
+        self.name = "FotoPi-master"
+        self.library = library
+        self.kind = kind
+        self.result.master = kind
+
+    def _save(self, stacked, metadata, config):
+        add = self.library.add_dark if self.kind == "dark" else self.library.add_flat
+        return add(stacked, metadata, config, self.result.captured)
+
+
+class PreCaptureRing(threading.Thread):
+    """Zero shutter lag: pulls every frame of the running (full resolution)
+    configuration and keeps the last `frames` requests, releasing the oldest
+    one as each new frame arrives. The frames stay in the camera's own
+    buffers, so the camera needs `frames` buffers on top of the ones the
+    preview uses; nothing is copied until a frame is committed.
+
+    take() picks the frame that was being exposed at a given moment (the
+    shutter press), or the whole pre-roll up to it."""
+
+    def __init__(self, picam2, frames):
+        super().__init__(name="FotoPi-precapture", daemon=True)
+        self.picam2 = picam2
+        self.frames = frames
+        self.error = None
+        self._ring = deque()
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def stop(self, timeout=5.0):
+        # the thread notices within one frame, the camera has to keep running until then
+        self._stop_event.set()
+        self.join(timeout)
+
+    def run(self):
+        try:
+            while not self._stop_event.is_set():
+                request = self.picam2.capture_request()
+                with self._cond:
+                    self._ring.append((request.get_metadata(), request))
+                    while len(self._ring) > self.frames:
+                        self._ring.popleft()[1].release()
+                    self._cond.notify_all()
+        except Exception as e:
+            logging.error(f"Pre-capture stopped: {e}")
+            self.error = e
+        finally:
+            with self._cond:
+                while self._ring:
+                    self._ring.popleft()[1].release()
+                self._cond.notify_all()
+
+    @staticmethod
+    def _exposure_start(metadata):
+        return metadata.get("SensorTimestamp", 0)
+
+    def _arrived(self, at_ns):
+        # the frame exposed at `at_ns` (or a later one) is in the ring
+        metadata = self._ring[-1][0]
+        return self._exposure_start(metadata) + metadata.get("FrameDuration", 0) * 1000 >= at_ns
+
+    def take(self, copy, at_ns=None, pre_roll=False, timeout=2.0):
+        """Returns [copy(request)] for the frame whose exposure started last
+        before `at_ns` (SensorTimestamp, CLOCK_MONOTONIC; None for the newest
+        frame), or for every frame up to it with `pre_roll`. `copy` runs
+        while the ring holds the request, it must not keep a reference."""
+        with self._cond:
+            self._cond.wait_for(lambda: not self.is_alive()
+                                or (self._ring and (at_ns is None or self._arrived(at_ns))), timeout)
+            if not self._ring:
+                raise RuntimeError("No frames in the pre-capture ring")
+            entries = list(self._ring)
+            if at_ns is not None:
+                before = [entry for entry in entries if self._exposure_start(entry[0]) <= at_ns]
+                # pressed before the oldest frame we still have: that one is the closest
+                entries = before or entries[:1]
+            if not pre_roll:
+                entries = entries[-1:]
+            return [copy(request) for metadata, request in entries]
@@ -0,0 +1,150 @@
+import os, sqlite3, time, logging
+
+from resources.FotoPi_files import SUPPORTED_EXTENSIONS, parse_sequence
+
+CATALOG_FILE = os.path.join(".fotopi", "catalog.sqlite3")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    filename      TEXT PRIMARY KEY,
+    sequence      INTEGER,
+    captured_at   REAL,
+    format        TEXT,
+    width         INTEGER,
+    height        INTEGER,
+    iso           TEXT,
+    shutter       TEXT,
+    exposure_us   INTEGER,
+    awb           TEXT,
+    saturation    REAL,
+    contrast      REAL,
+    sharpness     REAL,
+    brightness    REAL,
+    size_bytes    INTEGER,
+    mtime_ns      INTEGER
+);
+CREATE INDEX IF NOT EXISTS images_by_sequence ON images (sequence DESC, filename DESC);
+CREATE INDEX IF NOT EXISTS images_by_format ON images (format, sequence DESC, filename DESC);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+CAPTURE_FIELDS = ("iso", "shutter", "exposure_us", "awb", "saturation", "contrast", "sharpness", "brightness")
+
+
+class ImageCatalog:
+    """SQLite index of the images in one output folder. Captures are added
+    with their exposure settings as they are saved; reconcile() picks up
+    files that were copied in or deleted outside of FotoPi. Only used from
+    the GUI thread."""
+
+    def __init__(self, image_folder):
+        self.image_folder = image_folder
+        path = os.path.join(image_folder, CATALOG_FILE)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def add(self, path, width=None, height=None, captured_at=None, **controls):
+        filename = os.path.basename(path)
+        try:
+            st = os.stat(path)
+            size_bytes, mtime_ns = st.st_size, st.st_mtime_ns
+        except OSError:
+            size_bytes, mtime_ns = None, None
+        row = {
+            "filename": filename,
+            "sequence": parse_sequence(filename),
+            "captured_at": captured_at or time.time(),
+            "format": os.path.splitext(filename)[1].lower(),
+            "width": width,
+            "height": height,
+            "size_bytes": size_bytes,
+            "mtime_ns": mtime_ns,
+        }
+        for field in CAPTURE_FIELDS:
+            row[field] = controls.get(field)
+        columns = ", ".join(row)
+        placeholders = ", ".join(f":{c}" for c in row)
+        self.db.execute(f"INSERT OR REPLACE INTO images ({columns}) VALUES ({placeholders})", row)
+        self.db.commit()
+
+    def remove(self, filename):
+        self.db.execute("DELETE FROM images WHERE filename = ?", (os.path.basename(filename),))
+        self.db.commit()
+
+    def count(self, formats=None):
+        where, args = self._format_filter(formats)
+        return self.db.execute(f"SELECT COUNT(*) FROM images {where}", args).fetchone()[0]
+
+    def page(self, offset, limit, formats=None):
+        """Filenames of one gallery page, newest first."""
+        where, args = self._format_filter(formats)
+        rows = self.db.execute(
+            f"SELECT filename FROM images {where} ORDER BY sequence DESC, filename DESC LIMIT ? OFFSET ?",
+            args + [limit, offset])
+        return [r["filename"] for r in rows]
+
+    def get(self, filename):
+        row = self.db.execute("SELECT * FROM images WHERE filename = ?", (os.path.basename(filename),)).fetchone()
+        return dict(row) if row is not None else None
+
+    @staticmethod
+    def _format_filter(formats):
+        if not formats:
+            return "", []
+        return f"WHERE format IN ({', '.join('?' * len(formats))})", list(formats)
+
+    def _folder_mtime(self):
+        try:
+            return str(os.stat(self.image_folder).st_mtime_ns)
+        except OSError:
+            return None
+
+    def reconcile(self, force=False, probe=None):
+        """Sync the index with the folder. Cheap no-op unless the folder
+        changed since the last pass; `probe(path)` may return (w, h) for
+        files that were added outside FotoPi."""
+        stamp = self._folder_mtime()
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'folder_mtime'").fetchone()
+        if not force and row is not None and row[0] == stamp:
+            return 0, 0
+
+        on_disk = {}
+        with os.scandir(self.image_folder) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                    on_disk[entry.name] = entry
+        known = {r[0] for r in self.db.execute("SELECT filename FROM images")}
+
+        removed = known - on_disk.keys()
+        added = on_disk.keys() - known
+        self.db.executemany("DELETE FROM images WHERE filename = ?", [(f,) for f in removed])
+        for filename in added:
+            entry = on_disk[filename]
+            st = entry.stat()
+            width = height = None
+            if probe is not None:
+                try:
+                    width, height = probe(entry.path) or (None, None)
+                except Exception as e:
+                    logging.error("Could not probe %s: %s", entry.path, e)
+            self.db.execute(
+                "INSERT OR REPLACE INTO images (filename, sequence, captured_at, format, width, height, "
+                "size_bytes, mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (filename, parse_sequence(filename), st.st_mtime, os.path.splitext(filename)[1].lower(),
+                 width, height, st.st_size, st.st_mtime_ns))
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('folder_mtime', ?)", (stamp,))
+        self.db.commit()
+        if added or removed:
+            logging.info("Catalog reconciled: %d added, %d removed", len(added), len(removed))
+        return len(added), len(removed)
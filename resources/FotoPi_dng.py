@@ -0,0 +1,343 @@
+import os, mmap, struct, logging
+import numpy as np
+
+# TIFF field types -> (struct code, size)
+FIELD_TYPES = {1: ("B", 1), 2: ("s", 1), 3: ("H", 2), 4: ("I", 4), 5: ("II", 8), 6: ("b", 1), 7: ("B", 1),
+               8: ("h", 2), 9: ("i", 4), 10: ("ii", 8), 11: ("f", 4), 12: ("d", 8), 13: ("I", 4)}
+
+NEW_SUBFILE_TYPE = 254
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+PHOTOMETRIC = 262
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+ROWS_PER_STRIP = 278
+STRIP_BYTE_COUNTS = 279
+TILE_WIDTH = 322
+TILE_LENGTH = 323
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+SUB_IFDS = 330
+JPEG_OFFSET = 513
+JPEG_LENGTH = 514
+CFA_REPEAT_PATTERN_DIM = 33421
+CFA_PATTERN = 33422
+BLACK_LEVEL = 50714
+WHITE_LEVEL = 50717
+AS_SHOT_NEUTRAL = 50728
+X_RESOLUTION = 282
+Y_RESOLUTION = 283
+RESOLUTION_UNIT = 296
+
+PHOTOMETRIC_RGB = 2
+PHOTOMETRIC_YCBCR = 6
+PHOTOMETRIC_CFA = 32803
+
+# stop walking malformed files instead of looping over them
+MAX_IFDS = 32
+
+
+class DngError(Exception):
+    pass
+
+
+class Preview:
+    """What read_preview() found: either `jpeg` bytes or an `rgb` uint8 array
+    of shape (h, w, 3), plus the size of the full raw image."""
+
+    def __init__(self, source_size, jpeg=None, rgb=None):
+        self.source_size = source_size
+        self.jpeg = jpeg
+        self.rgb = rgb
+
+
+class TiffReader:
+    """Just enough TIFF to find the images in a DNG. The file is memory
+    mapped, only the IFDs and the bytes that are actually needed are read."""
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise DngError(f"{os.path.basename(path)} is empty")
+        order = self.mm[:4]
+        if order == b"II*\0":
+            self.endian = "<"
+        elif order == b"MM\0*":
+            self.endian = ">"
+        else:
+            self.close()
+            raise DngError(f"{os.path.basename(path)} is not a TIFF/DNG file")
+        self.ifds = self._read_ifds(self._unpack("I", 4)[0])
+
+    def close(self):
+        self.mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _unpack(self, fmt, offset):
+        try:
+            return struct.unpack_from(self.endian + fmt, self.mm, offset)
+        except struct.error:
+            raise DngError(f"Truncated TIFF structure at offset {offset}")
+
+    def _read_ifds(self, first):
+        ifds = []
+        queue = [first]
+        seen = set()
+        while queue and len(ifds) < MAX_IFDS:
+            offset = queue.pop(0)
+            if not offset or offset in seen or offset >= len(self.mm):
+                continue
+            seen.add(offset)
+            ifd, next_offset = self._read_ifd(offset)
+            ifds.append(ifd)
+            queue.extend(ifd.get(SUB_IFDS, ()))
+            queue.append(next_offset)
+        return ifds
+
+    def _read_ifd(self, offset):
+        count = self._unpack("H", offset)[0]
+        ifd = {}
+        for i in range(count):
+            tag, field_type, n, value_offset = self._unpack("HHI4s", offset + 2 + i * 12)
+            if field_type not in FIELD_TYPES:
+                continue
+            code, size = FIELD_TYPES[field_type]
+            if size * n <= 4:
+                data_offset = offset + 2 + i * 12 + 8
+            else:
+                data_offset = self._unpack("I", offset + 2 + i * 12 + 8)[0]
+            if field_type == 2:
+                ifd[tag] = bytes(self.mm[data_offset:data_offset + n])
+            elif field_type in (5, 10):
+                values = self._unpack(code[0] * (2 * n), data_offset)
+                ifd[tag] = tuple(values[j] / values[j + 1] if values[j + 1] else 0.0 for j in range(0, 2 * n, 2))
+            else:
+                ifd[tag] = self._unpack(code * n, data_offset)
+        next_offset = self._unpack("I", offset + 2 + count * 12)[0]
+        return ifd, next_offset
+
+    def read(self, offset, length):
+        if offset + length > len(self.mm):
+            raise DngError("Image data runs past the end of the file")
+        return self.mm[offset:offset + length]
+
+
+def _first(ifd, tag, default=None):
+    values = ifd.get(tag)
+    return values[0] if values else default
+
+
+def _size(ifd):
+    return _first(ifd, IMAGE_WIDTH, 0), _first(ifd, IMAGE_LENGTH, 0)
+
+
+def _raw_ifd(ifds):
+    raws = [ifd for ifd in ifds if _first(ifd, PHOTOMETRIC) == PHOTOMETRIC_CFA]
+    if not raws:
+        return None
+    return max(raws, key=lambda ifd: _size(ifd)[0] * _size(ifd)[1])
+
+
+def _preview_ifds(ifds):
+    previews = []
+    for ifd in ifds:
+        if JPEG_OFFSET in ifd and JPEG_LENGTH in ifd:
+            previews.append(ifd)
+        elif _first(ifd, PHOTOMETRIC) in (PHOTOMETRIC_RGB, PHOTOMETRIC_YCBCR) and STRIP_OFFSETS in ifd:
+            previews.append(ifd)
+    return previews
+
+
+def _strips(reader, ifd):
+    offsets = ifd.get(STRIP_OFFSETS, ())
+    counts = ifd.get(STRIP_BYTE_COUNTS, ())
+    return b"".join(reader.read(o, c) for o, c in zip(offsets, counts))
+
+
+def _embedded(reader, ifd):
+    """Returns (jpeg bytes, rgb array), one of them None, or (None, None) for
+    encodings we don't handle."""
+    if JPEG_OFFSET in ifd and JPEG_LENGTH in ifd:
+        return reader.read(_first(ifd, JPEG_OFFSET), _first(ifd, JPEG_LENGTH)), None
+    compression = _first(ifd, COMPRESSION, 1)
+    if compression in (6, 7):
+        return _strips(reader, ifd), None
+    bits = ifd.get(BITS_PER_SAMPLE, (8,))
+    samples = _first(ifd, SAMPLES_PER_PIXEL, 1)
+    if compression == 1 and _first(ifd, PHOTOMETRIC) == PHOTOMETRIC_RGB and samples >= 3 and bits[0] == 8:
+        w, h = _size(ifd)
+        data = np.frombuffer(_strips(reader, ifd), dtype=np.uint8, count=w * h * samples)
+        return None, np.ascontiguousarray(data.reshape(h, w, samples)[:, :, :3])
+    return None, None
+
+
+def _row_layout(ifd):
+    """(offsets, rows per block) of an image stored in strips, or in tiles
+    that span the full width (which is how PiDNG writes its single tile)."""
+    w, h = _size(ifd)
+    if STRIP_OFFSETS in ifd:
+        return ifd[STRIP_OFFSETS], _first(ifd, ROWS_PER_STRIP, h) or h
+    if TILE_OFFSETS in ifd and _first(ifd, TILE_WIDTH, 0) >= w:
+        return ifd[TILE_OFFSETS], _first(ifd, TILE_LENGTH, h) or h
+    raise DngError("Tiled raw data is not supported")
+
+
+def _cfa_rows(reader, ifd, rows):
+    """Reads the given rows of an uncompressed CFA image as uint16."""
+    w, h = _size(ifd)
+    bits = _first(ifd, BITS_PER_SAMPLE, 16)
+    offsets, rows_per_strip = _row_layout(ifd)
+    # a full-width tile is padded to the tile width
+    row_bytes = (max(w, _first(ifd, TILE_WIDTH, 0)) * bits + 7) // 8
+    out = np.empty((len(rows), w), dtype=np.uint16)
+    for i, row in enumerate(rows):
+        strip, within = divmod(row, rows_per_strip)
+        data = np.frombuffer(reader.read(offsets[strip] + within * row_bytes, row_bytes), dtype=np.uint8)
+        if bits == 16:
+            out[i] = data.view(reader.endian + "u2")[:w]
+        elif bits == 8:
+            out[i] = data[:w]
+        elif bits == 12:
+            # packed MSB first, two samples in three bytes
+            triples = np.pad(data, (0, -len(data) % 3)).reshape(-1, 3).astype(np.uint16)
+            pairs = np.empty((len(triples), 2), dtype=np.uint16)
+            pairs[:, 0] = (triples[:, 0] << 4) | (triples[:, 1] >> 4)
+            pairs[:, 1] = ((triples[:, 1] & 0x0F) << 8) | triples[:, 2]
+            out[i] = pairs.reshape(-1)[:w]
+        else:
+            raise DngError(f"Unsupported raw bit depth {bits}")
+    return out
+
+
+def _cfa_preview(reader, ifd, max_size):
+    """Cheap preview of the raw image: every `step`th 2x2 Bayer block becomes
+    one RGB pixel, so only the rows that are needed are read and unpacked."""
+    if _first(ifd, COMPRESSION, 1) != 1:
+        raise DngError("Compressed raw data without an embedded preview")
+    if tuple(ifd.get(CFA_REPEAT_PATTERN_DIM, (2, 2))) != (2, 2):
+        raise DngError("Only 2x2 CFA patterns are supported")
+    w, h = _size(ifd)
+    step = max(1, min((w // 2) // max_size[0], (h // 2) // max_size[1]))
+    block_rows = range(0, h - 1, 2 * step)
+    rows = [r + d for r in block_rows for d in (0, 1)]
+    data = _cfa_rows(reader, ifd, rows).reshape(len(block_rows), 2, w)
+    cols = np.arange(0, w - 1, 2 * step)
+    pattern = ifd.get(CFA_PATTERN, (0, 1, 1, 2))
+    channels = np.zeros((len(block_rows), len(cols), 3), dtype=np.float32)
+    counts = [0, 0, 0]
+    for position, colour in enumerate(pattern[:4]):
+        dy, dx = divmod(position, 2)
+        channels[:, :, colour] += data[:, dy, cols + dx]
+        counts[colour] += 1
+    for colour in range(3):
+        channels[:, :, colour] /= max(counts[colour], 1)
+
+    bits = _first(ifd, BITS_PER_SAMPLE, 16)
+    white = _first(ifd, WHITE_LEVEL, (1 << bits) - 1)
+    black_levels = ifd.get(BLACK_LEVEL, (0,))
+    black = sum(black_levels) / len(black_levels)
+    channels = (channels - black) / max(white - black, 1)
+    neutral = ifd.get(AS_SHOT_NEUTRAL)
+    if neutral and len(neutral) == 3 and all(neutral):
+        channels *= np.array([neutral[1] / n for n in neutral], dtype=np.float32)
+    # plain gamma, good enough to recognise the shot
+    np.clip(channels, 0.0, 1.0, out=channels)
+    return np.ascontiguousarray((channels ** (1 / 2.2) * 255).astype(np.uint8))
+
+
+def read_cfa(path):
+    """The whole raw CFA image of an uncompressed DNG as a uint16 array, and
+    its bit depth. For dark frames, not for previews."""
+    with TiffReader(path) as reader:
+        raw = _raw_ifd(reader.ifds)
+        if raw is None:
+            raise DngError(f"No raw image in {os.path.basename(path)}")
+        if _first(raw, COMPRESSION, 1) != 1:
+            raise DngError(f"Compressed raw data in {os.path.basename(path)}")
+        return _cfa_rows(reader, raw, range(_size(raw)[1])), _first(raw, BITS_PER_SAMPLE, 16)
+
+
+def raw_size(path):
+    with TiffReader(path) as reader:
+        ifd = _raw_ifd(reader.ifds)
+        return _size(ifd) if ifd is not None else None
+
+
+def read_preview(path, max_size):
+    """Best preview of a DNG for showing at `max_size`: the largest embedded
+    preview if it is at least half that size, otherwise one made by
+    subsampling the raw CFA data. Never demosaics the full raw image."""
+    with TiffReader(path) as reader:
+        raw = _raw_ifd(reader.ifds)
+        source_size = _size(raw) if raw is not None else None
+        previews = sorted(_preview_ifds(reader.ifds), key=lambda ifd: _size(ifd)[0], reverse=True)
+        fallback = None
+        for ifd in previews:
+            jpeg, rgb = _embedded(reader, ifd)
+            if jpeg is None and rgb is None:
+                continue
+            preview = Preview(source_size or _size(ifd), jpeg=jpeg, rgb=rgb)
+            if 2 * max(_size(ifd)) >= max(max_size) or raw is None:
+                return preview
+            fallback = fallback or preview
+        if raw is not None:
+            try:
+                return Preview(source_size, rgb=_cfa_preview(reader, raw, max_size))
+            except DngError as e:
+                if fallback is None:
+                    raise
+                logging.info("Using small embedded preview of %s: %s", path, e)
+        if fallback is not None:
+            return fallback
+    raise DngError(f"No preview or raw image found in {os.path.basename(path)}")
+
+
+def write_tiff(path, rgb):
+    """Writes a (h, w, 3) uint16 array as an uncompressed 16 bit RGB TIFF."""
+    h, w = rgb.shape[:2]
+    data = np.ascontiguousarray(rgb, dtype="<u2").tobytes()
+    # header, IFD, then the out-of-line values and the image
+    entries = [
+        (IMAGE_WIDTH, 4, 1, w),
+        (IMAGE_LENGTH, 4, 1, h),
+        (BITS_PER_SAMPLE, 3, 3, None),
+        (COMPRESSION, 3, 1, 1),
+        (PHOTOMETRIC, 3, 1, PHOTOMETRIC_RGB),
+        (STRIP_OFFSETS, 4, 1, None),
+        (SAMPLES_PER_PIXEL, 3, 1, 3),
+        (ROWS_PER_STRIP, 4, 1, h),
+        (STRIP_BYTE_COUNTS, 4, 1, len(data)),
+        (X_RESOLUTION, 5, 1, None),
+        (Y_RESOLUTION, 5, 1, None),
+        (RESOLUTION_UNIT, 3, 1, 2),
+    ]
+    ifd_size = 2 + 12 * len(entries) + 4
+    bits_offset = 8 + ifd_size
+    resolution_offset = bits_offset + 6
+    data_offset = resolution_offset + 8
+    out_of_line = {BITS_PER_SAMPLE: bits_offset, STRIP_OFFSETS: data_offset,
+                   X_RESOLUTION: resolution_offset, Y_RESOLUTION: resolution_offset}
+    with open(path, "wb") as f:
+        f.write(b"II*\0" + struct.pack("<I", 8))
+        f.write(struct.pack("<H", len(entries)))
+        for tag, field_type, count, value in entries:
+            value = out_of_line.get(tag, value)
+            if field_type == 3 and count == 1:
+                f.write(struct.pack("<HHIHH", tag, field_type, count, value, 0))
+            else:
+                f.write(struct.pack("<HHII", tag, field_type, count, value))
+        f.write(struct.pack("<I", 0))
+        f.write(struct.pack("<3H", 16, 16, 16))
+        f.write(struct.pack("<II", 72, 1))
+        f.write(data)
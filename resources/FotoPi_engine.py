@@ -0,0 +1,728 @@
+import os, time, threading, logging
+from abc import ABC, abstractmethod
+import numpy as np
+
+from resources.FotoPi_files import SequenceAllocator, output_extensions
+from resources.FotoPi_capture import ImageWriter, BurstCapture, IntervalCapture, PreCaptureRing, StackCapture, \
+    MasterCapture, write_jobs
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+def frame_bytes(config):
+    """Memory of one request's buffers (main, lores and raw) for `config`.
+    Uses the stride when the configuration has been aligned with one,
+    otherwise estimates it from the pixel format."""
+    total = 0
+    for name in ("main", "lores", "raw"):
+        stream = config.get(name)
+        if not stream:
+            continue
+        width, height = stream["size"]
+        fmt = stream.get("format") or ""
+        stride = stream.get("stride")
+        if not stride:
+            if fmt.endswith("_CSI2P"):
+                # packed raw, e.g. SRGGB12_CSI2P
+                stride = width * int("".join(c for c in fmt if c.isdigit())) // 8
+            elif fmt.startswith(("S", "R", "B", "G")) and fmt[-2:].isdigit():
+                stride = width * 2
+            else:
+                stride = width * SimulatedBackend.BYTES_PER_PIXEL.get(fmt, 4)
+        total += stride * height * 3 // 2 if fmt.startswith(("YUV420", "YVU420")) else stride * height
+    return total
+
+
+class CameraBackend(ABC):
+    """The part of the Picamera2 API that FotoPi drives. CaptureEngine and
+    MainWindow only talk to the camera through these methods, so anything
+    implementing them (real camera or simulation) can be plugged in."""
+
+    name = "backend"
+
+    @property
+    @abstractmethod
+    def helpers(self):
+        """save(), save_dng() and make_image() for the writer."""
+
+    @property
+    @abstractmethod
+    def camera_config(self):
+        """The configuration the camera is running with."""
+
+    @property
+    @abstractmethod
+    def camera_controls(self):
+        """name -> (min, max, default) of the controls the camera takes."""
+
+    @property
+    @abstractmethod
+    def sensor_resolution(self):
+        """Full sensor size, (width, height)."""
+
+    @abstractmethod
+    def create_preview_configuration(self, main={}, **kwargs):
+        """A preview configuration, as Picamera2 makes it."""
+
+    @abstractmethod
+    def create_still_configuration(self, main={}, **kwargs):
+        """A still configuration, as Picamera2 makes it."""
+
+    @abstractmethod
+    def align_configuration(self, config):
+        """Round the stream sizes in `config` to what the hardware takes."""
+
+    @abstractmethod
+    def configure(self, config):
+        """Configure the stopped camera."""
+
+    @abstractmethod
+    def start(self):
+        """Start streaming."""
+
+    @abstractmethod
+    def stop(self):
+        """Stop streaming."""
+
+    @abstractmethod
+    def close(self):
+        """Release the camera."""
+
+    @abstractmethod
+    def set_controls(self, controls):
+        """Apply controls to the coming frames."""
+
+    @abstractmethod
+    def switch_mode(self, config):
+        """Reconfigure the running camera."""
+
+    @abstractmethod
+    def capture_request(self, signal_function=None):
+        """The next request; with signal_function, a job for wait() instead."""
+
+    @abstractmethod
+    def switch_mode_and_capture_request(self, config, signal_function=None):
+        """Switch to `config` for one request, then switch back."""
+
+    @abstractmethod
+    def wait(self, job):
+        """The result of a job, raising what it raised."""
+
+    @abstractmethod
+    def set_post_callback(self, callback):
+        """callback(request) for every frame the camera delivers, on the
+        camera's thread, before the request goes back. None removes it."""
+
+
+class Picamera2Backend(CameraBackend):
+    name = "picamera2"
+
+    def __init__(self, camera_num=0):
+        from picamera2 import Picamera2
+        self.picam2 = Picamera2(camera_num)
+
+    @property
+    def helpers(self):
+        return self.picam2.helpers
+
+    @property
+    def camera_config(self):
+        return self.picam2.camera_config
+
+    @property
+    def camera_controls(self):
+        return self.picam2.camera_controls
+
+    @property
+    def sensor_resolution(self):
+        return self.picam2.sensor_resolution
+
+    def create_preview_configuration(self, main={}, **kwargs):
+        return self.picam2.create_preview_configuration(main=main, **kwargs)
+
+    def create_still_configuration(self, main={}, **kwargs):
+        return self.picam2.create_still_configuration(main=main, **kwargs)
+
+    def align_configuration(self, config):
+        self.picam2.align_configuration(config)
+        return config
+
+    def configure(self, config):
+        self.picam2.configure(config)
+
+    def start(self):
+        self.picam2.start()
+
+    def stop(self):
+        self.picam2.stop()
+
+    def close(self):
+        self.picam2.close()
+
+    def set_controls(self, controls):
+        self.picam2.set_controls(controls)
+
+    def switch_mode(self, config):
+        return self.picam2.switch_mode(config)
+
+    def capture_request(self, signal_function=None):
+        return self.picam2.capture_request(signal_function=signal_function)
+
+    def switch_mode_and_capture_request(self, config, signal_function=None):
+        return self.picam2.switch_mode_and_capture_request(config, signal_function=signal_function)
+
+    def wait(self, job):
+        return self.picam2.wait(job)
+
+    def set_post_callback(self, callback):
+        self.picam2.post_callback = callback
+
+
+class SimulatedRequest:
+    def __init__(self, buffers, metadata, config):
+        self._buffers = buffers
+        self._metadata = metadata
+        self.config = config
+
+    def make_buffer(self, name):
+        return self._buffers[name].copy()
+
+    def get_metadata(self):
+        return dict(self._metadata)
+
+    def release(self):
+        self._buffers = None
+
+
+class SimulatedJob:
+    def __init__(self, function):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._function = function
+
+    def run(self, signal_function):
+        try:
+            self._result = self._function()
+        except Exception as e:
+            self._error = e
+        self._done.set()
+        if signal_function is not None:
+            signal_function(self)
+
+    def get_result(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class SimulatedHelpers:
+    """Encoders for simulated frames. Uses Pillow when it is installed;
+    otherwise the raw buffer is written out, which still exercises the
+    writer queue and the SD card."""
+
+    def make_image(self, buffer, config):
+        w, h = config["size"]
+        channels = SimulatedBackend.BYTES_PER_PIXEL.get(config["format"], 3)
+        array = buffer.reshape(h, config["stride"] // channels, channels)[:, :w, :3]
+        return Image.fromarray(array) if Image is not None else array
+
+    def save(self, img, metadata, file_output, format=None):
+        if Image is not None and not isinstance(img, np.ndarray):
+            img.save(file_output, format=format)
+        else:
+            with open(file_output, "wb") as f:
+                f.write(np.ascontiguousarray(img).tobytes())
+
+    def save_dng(self, buffer, metadata, config, file_output):
+        with open(file_output, "wb") as f:
+            f.write(buffer.tobytes())
+
+
+class SimulatedBackend(CameraBackend):
+    """Synthetic camera for benchmarks and development without an HQ camera.
+    Frames are delivered on a fixed sensor clock (`fps`, or slower if the
+    exposure is longer), mode switches cost `switch_latency` seconds, and
+    consumers that fall behind see gaps in SensorTimestamp, just like on
+    the real camera. While running, a post callback sees every frame on the
+    sensor clock, as the Qt preview loop would deliver them."""
+
+    name = "simulated"
+    BYTES_PER_PIXEL = {"XBGR8888": 4, "XRGB8888": 4, "BGR888": 3, "RGB888": 3, "SRGGB12": 2, "YUV420": 1}
+
+    def __init__(self, sensor_size=(4056, 3040), fps=10.0, switch_latency=0.25, sensor_temperature=35.0):
+        self._sensor_size = tuple(sensor_size)
+        self.fps = fps
+        self.switch_latency = switch_latency
+        self.sensor_temperature = sensor_temperature
+        self._helpers = SimulatedHelpers()
+        self._config = None
+        self._controls = {"AeEnable": False, "AnalogueGain": 1.0, "ExposureTime": 33_333}
+        self._frames = {}
+        self._lock = threading.Lock()
+        self._t0 = time.monotonic_ns()
+        self._last_frame = -1
+        self._post_callback = None
+        self._preview_thread = None
+        self.running = False
+
+    @property
+    def helpers(self):
+        return self._helpers
+
+    @property
+    def camera_config(self):
+        return self._config
+
+    @property
+    def camera_controls(self):
+        return {"AnalogueGain": (1.0, 22.26, 1.0), "ExposureTime": (31, 667_234_896, None)}
+
+    @property
+    def sensor_resolution(self):
+        return self._sensor_size
+
+    def _stream(self, size, fmt):
+        size = tuple(size)
+        bpp = self.BYTES_PER_PIXEL.get(fmt, 3)
+        stride = (size[0] + 31) // 32 * 32 * bpp
+        return {"size": size, "format": fmt, "stride": stride}
+
+    def _configuration(self, main, main_size, main_format, raw, lores, controls, buffer_count, **kwargs):
+        config = {
+            "main": self._stream(main.get("size", main_size), main.get("format", main_format)),
+            "raw": self._stream((raw or {}).get("size", self._sensor_size), "SRGGB12"),
+            "lores": self._stream(lores["size"], "YUV420") if lores else None,
+            "controls": dict(controls or {}),
+            "buffer_count": buffer_count,
+        }
+        config.update(kwargs)
+        return config
+
+    def create_preview_configuration(self, main={}, raw=None, lores=None, controls=None, buffer_count=4, **kwargs):
+        return self._configuration(main, (640, 480), "XBGR8888", raw, lores, controls, buffer_count, **kwargs)
+
+    def create_still_configuration(self, main={}, raw=None, lores=None, controls=None, buffer_count=1, **kwargs):
+        return self._configuration(main, self._sensor_size, "BGR888", raw, lores, controls, buffer_count, **kwargs)
+
+    def align_configuration(self, config):
+        for name in ("main", "raw", "lores"):
+            stream = config.get(name)
+            if stream:
+                stream.update(self._stream((stream["size"][0] & ~1, stream["size"][1] & ~1), stream["format"]))
+        return config
+
+    def configure(self, config):
+        main, lores = config["main"], config.get("lores")
+        if lores and (lores["size"][0] > main["size"][0] or lores["size"][1] > main["size"][1]):
+            raise ValueError(f"lores stream {lores['size']} is larger than the main stream {main['size']}")
+        self._config = config
+        self._controls.update(config.get("controls", {}))
+
+    def start(self):
+        self.running = True
+        if self._preview_thread is None or not self._preview_thread.is_alive():
+            self._preview_thread = threading.Thread(target=self._preview_loop, name="FotoPi-simulated-preview",
+                                                    daemon=True)
+            self._preview_thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        self.running = False
+
+    def set_controls(self, controls):
+        with self._lock:
+            self._controls.update(controls)
+
+    def switch_mode(self, config):
+        time.sleep(self.switch_latency)
+        self.configure(config)
+        return config
+
+    def _frame_duration_ns(self):
+        exposure_ns = int(self._controls.get("ExposureTime", 0)) * 1000
+        return max(exposure_ns, int(1e9 / self.fps))
+
+    def _frame(self, stream):
+        key = (stream["size"], stream["format"], stream["stride"])
+        frame = self._frames.get(key)
+        if frame is None:
+            w, h = stream["size"]
+            width = stream["stride"] // self.BYTES_PER_PIXEL.get(stream["format"], 1)
+            if stream["format"] == "YUV420":
+                h = h * 3 // 2
+            y, x = np.indices((h, width), dtype=np.uint32)
+            if stream["format"] == "SRGGB12":
+                frame = ((x * 7 + y * 3) % 4096).astype(np.uint16)
+            else:
+                channels = self.BYTES_PER_PIXEL.get(stream["format"], 1)
+                frame = np.repeat(((x + y) % 256).astype(np.uint8)[:, :, None], channels, axis=2)
+            frame = frame.reshape(-1).view(np.uint8)
+            self._frames[key] = frame
+        return frame
+
+    def _run_job(self, function, signal_function):
+        job = SimulatedJob(function)
+        if signal_function is None:
+            job.run(None)
+            return job.get_result()
+        threading.Thread(target=job.run, args=(signal_function,), daemon=True).start()
+        return job
+
+    def _request(self, timestamp, duration, controls):
+        config = self._config
+        buffers = {name: self._frame(stream) for name, stream in config.items()
+                   if name in ("main", "raw", "lores") and stream}
+        metadata = {
+            "SensorTimestamp": timestamp,
+            "FrameDuration": duration // 1000,
+            "ExposureTime": int(controls.get("ExposureTime", 0)),
+            "AnalogueGain": float(controls.get("AnalogueGain", 1.0)),
+            "SensorTemperature": self.sensor_temperature,
+        }
+        return SimulatedRequest(buffers, metadata, dict(config))
+
+    def set_post_callback(self, callback):
+        self._post_callback = callback
+
+    def _preview_loop(self):
+        # doesn't take frames away from capture_request, both see the same sensor clock
+        index = -1
+        while self.running:
+            with self._lock:
+                duration = self._frame_duration_ns()
+                index = max(index + 1, -(-(time.monotonic_ns() - self._t0) // duration))
+                controls = dict(self._controls)
+            timestamp = self._t0 + index * duration
+            time.sleep(max(0, timestamp - time.monotonic_ns()) / 1e9)
+            callback = self._post_callback
+            if callback is not None and self.running and self._config is not None:
+                try:
+                    callback(self._request(timestamp, duration, controls))
+                except Exception as e:
+                    logging.error(f"Post callback failed: {e}")
+
+    def capture_request(self, signal_function=None):
+        if signal_function is not None:
+            return self._run_job(self.capture_request, signal_function)
+        with self._lock:
+            duration = self._frame_duration_ns()
+            now = time.monotonic_ns()
+            # next frame boundary on the sensor clock; slow callers miss frames
+            index = max(self._last_frame + 1, -(-(now - self._t0) // duration))
+            self._last_frame = index
+            timestamp = self._t0 + index * duration
+            controls = dict(self._controls)
+        delay = (timestamp - time.monotonic_ns()) / 1e9
+        if delay > 0:
+            time.sleep(delay)
+        return self._request(timestamp, duration, controls)
+
+    def switch_mode_and_capture_request(self, config, signal_function=None):
+        previous = self._config
+
+        def capture():
+            self.switch_mode(config)
+            try:
+                return self.capture_request()
+            finally:
+                self.switch_mode(previous)
+
+        return self._run_job(capture, signal_function)
+
+    def wait(self, job):
+        return job.get_result()
+
+
+class CaptureEngine:
+    """Everything that turns a shutter press into files on disk, without any
+    Qt or display code: filename allocation, still configurations, single,
+    burst and interval capture, and the background writer. MainWindow is one
+    user of it, the benchmarks another.
+
+    The still configurations are created and validated once in configure()
+    and only get the current controls merged in per shot. With
+    `still_preview` the camera streams at full sensor resolution all the
+    time (the display shows the lores stream), so a shot is just the next
+    frame instead of a mode switch there and back.
+
+    With a `calibration` library (FotoPi_calib), raw captures and stacks
+    are dark / flat corrected by the writer, and start_master() adds new
+    masters to it.
+
+    Callbacks may be invoked from worker threads."""
+
+    # frames in flight in the still preview mode, kept low as every one is a full resolution buffer
+    STILL_PREVIEW_BUFFERS = 3
+    # buffers the camera and the preview need besides the ones the pre-capture ring holds on to
+    PRE_CAPTURE_SPARE_BUFFERS = 2
+    # lores stream of the normal preview, for the live view analyses (histogram, focus peaking)
+    LORES_SIZE = (640, 480)
+
+    def __init__(self, backend, image_folder, writer_threads=2, writer_queue=4, on_written=None, on_failed=None,
+                 preview_size=(1440, 1080), still_preview=False, calibration=None):
+        self.backend = backend
+        self.image_folder = image_folder
+        self.calibration = calibration
+        self.sequence = SequenceAllocator(image_folder)
+        self.writer = ImageWriter(backend.helpers, self.sequence, workers=writer_threads, max_queue=writer_queue,
+                                  on_written=on_written, on_failed=on_failed, calibration=calibration)
+        self.preview_size = tuple(preview_size)
+        self.still_preview = still_preview
+        self.preview_config = None
+        self.still_configs = {}
+        self.drive_job = None
+        self.pre_capture = None
+
+    def _preview_configuration(self, still_preview):
+        if not still_preview:
+            return self.backend.create_preview_configuration(main={"size": self.preview_size},
+                                                             lores={"size": self.LORES_SIZE})
+        sensor = tuple(self.backend.sensor_resolution)
+        return self.backend.create_preview_configuration(main={"size": sensor, "format": "BGR888"},
+                                                         lores={"size": self.preview_size},
+                                                         raw={"size": sensor}, display="lores",
+                                                         buffer_count=self.STILL_PREVIEW_BUFFERS)
+
+    def _validated(self, config):
+        self.backend.align_configuration(config)
+        # raises here, at startup, rather than on the first shutter press
+        self.backend.configure(config)
+        return config
+
+    def configure(self):
+        """Create and validate the still configurations (main, raw, each for
+        single shots and bursts), then configure the preview."""
+        self.still_configs = {}
+        for stream in ("main", "raw"):
+            for buffer_count in (1, 3):
+                config = self.backend.create_still_configuration(**{stream: {}}, buffer_count=buffer_count)
+                self.still_configs[(stream, buffer_count)] = self._validated(config)
+        self.preview_config = self._validated(self._preview_configuration(self.still_preview))
+
+    def start(self, controls=None):
+        if controls:
+            self.backend.set_controls(controls)
+        self.backend.start()
+
+    def busy(self):
+        """Whether a drive is running or captures are still being written."""
+        return (self.drive_job is not None and self.drive_job.is_alive()) or self.writer.pending() > 0
+
+    def set_folder(self, image_folder):
+        # drives and queued writes hold on to the old folder's sequence
+        if self.busy():
+            raise RuntimeError("Captures are still being taken or written")
+        self.image_folder = image_folder
+        self.sequence = SequenceAllocator(image_folder)
+        self.writer.sequence = self.sequence
+
+    def has_room(self, file_extension):
+        """Whether the writer can take every file of one more capture."""
+        return self.writer.has_room(len(output_extensions(file_extension)))
+
+    def set_still_preview(self, enabled):
+        """Switch the running camera between the normal preview and the
+        full resolution still preview. Stops a running burst / interval."""
+        if enabled == self.still_preview:
+            return
+        self.stop_drive()
+        self.end_drive()
+        # the pre-capture ring keeps its own full resolution configuration
+        if self.pre_capture is None:
+            self._reconfigure(self._preview_configuration(enabled))
+        self.still_preview = enabled
+
+    def _reconfigure(self, config):
+        self.backend.align_configuration(config)
+        # stop/configure/start rather than switch_mode, which would wait on the Qt preview from the GUI thread
+        self.backend.stop()
+        self.backend.configure(config)
+        self.backend.start()
+        self.preview_config = config
+
+    def start_pre_capture(self, frames, max_memory_mb=None):
+        """Zero shutter lag: stream at full resolution and keep the last
+        `frames` frames in a PreCaptureRing, fewer if the camera buffers for
+        them would not fit into `max_memory_mb`. Returns the ring length."""
+        config = self._preview_configuration(True)
+        if max_memory_mb:
+            fit = max_memory_mb * 2 ** 20 // frame_bytes(config) - self.PRE_CAPTURE_SPARE_BUFFERS
+            frames = min(frames, fit)
+        if frames < 1:
+            raise ValueError(f"Not a single full resolution frame fits into {max_memory_mb} MB")
+        config["buffer_count"] = frames + self.PRE_CAPTURE_SPARE_BUFFERS
+        self.stop_drive()
+        self.end_drive()
+        self._stop_ring()
+        self._reconfigure(config)
+        self.pre_capture = PreCaptureRing(self.backend, frames)
+        self.pre_capture.start()
+        logging.info(f"Pre-capture ring of {frames} frames, {frame_bytes(config) // 2 ** 20} MB each")
+        return frames
+
+    def _stop_ring(self):
+        ring, self.pre_capture = self.pre_capture, None
+        if ring is not None:
+            ring.stop()
+        return ring is not None
+
+    def stop_pre_capture(self):
+        if self._stop_ring():
+            self._reconfigure(self._preview_configuration(self.still_preview))
+
+    def _commit(self, copy, at_ns, pre_roll, on_captured, on_failed=None):
+        ring = self.pre_capture
+
+        def commit():
+            try:
+                batches = ring.take(copy, at_ns, pre_roll)
+            except Exception as e:
+                logging.error(f"Pre-capture commit failed: {e}")
+                if on_failed is not None:
+                    on_failed(None, e)
+                return
+            for jobs in batches:
+                for job in jobs:
+                    self.writer.submit(job)
+            if on_captured is not None:
+                on_captured(batches[-1][0].filename)
+
+        threading.Thread(target=commit, name="FotoPi-precapture-commit", daemon=True).start()
+
+    def commit_pre_capture(self, file_extension, at_ns=None, pre_roll=False, on_captured=None, on_failed=None):
+        """Write the frame from the pre-capture ring that was being exposed at
+        `at_ns` (time.monotonic_ns() of the shutter press, None for the
+        newest), or with `pre_roll` every frame up to it. Each frame gets its
+        own sequence number. on_captured(filename) runs with the first file of
+        the last frame, from a worker thread; if no frame could be taken,
+        on_failed(None, error) runs instead."""
+        extensions = output_extensions(file_extension)
+        self._commit(lambda request: write_jobs(request, self.sequence.next_filenames(extensions)),
+                     at_ns, pre_roll, on_captured, on_failed)
+
+    def still_configuration(self, file_extension, controls=None, buffer_count=1):
+        """The cached still configuration for `file_extension`, with
+        `controls` merged in. None in the still preview mode, where the
+        running configuration is used."""
+        if self.still_preview:
+            return None
+        # the raw still mode has a full resolution main stream as well, for RAW+JPEG
+        stream = "raw" if ".dng" in output_extensions(file_extension) else "main"
+        cached = self.still_configs[(stream, buffer_count)]
+        config = dict(cached)
+        config["controls"] = {**cached.get("controls", {}), **(controls or {})}
+        return config
+
+    def capture(self, file_extension, controls=None, on_captured=None, on_failed=None):
+        """Single still: switch to the still mode (or, in the still preview
+        mode, take the next frame), grab one request and queue it for
+        writing. Returns the filenames (two for RAW+JPEG) right away;
+        on_captured(filename) runs with the first of them once the frame has
+        been copied out of the camera, or on_failed(filename, error) if it
+        could not be.
+
+        Every file of the capture is a separate job for the writer, so the
+        JPEG encode and the DNG write of RAW+JPEG run on two writer threads
+        side by side."""
+        filenames = self.sequence.next_filenames(output_extensions(file_extension))
+        if self.pre_capture is not None:
+            # the ring is already pulling every frame, take the newest from it
+            self._commit(lambda request: write_jobs(request, filenames), None, False, on_captured, on_failed)
+            return filenames
+
+        def captured(job):
+            try:
+                request = self.backend.wait(job)
+                try:
+                    jobs = write_jobs(request, filenames)
+                finally:
+                    request.release()
+            except Exception as e:
+                logging.error(f"Capture of {os.path.basename(filenames[0])} failed: {e}")
+                if on_failed is not None:
+                    on_failed(filenames[0], e)
+                return
+            for write_job in jobs:
+                self.writer.submit(write_job)
+            if on_captured is not None:
+                on_captured(filenames[0])
+
+        config = self.still_configuration(file_extension, controls)
+        if config is None:
+            self.backend.capture_request(signal_function=captured)
+        else:
+            self.backend.switch_mode_and_capture_request(config, signal_function=captured)
+        return filenames
+
+    def start_burst(self, file_extension, frames, controls=None, on_finished=None):
+        # in the still preview mode there is no mode to switch to, nor back from
+        cfg = self.still_configuration(file_extension, controls, buffer_count=3)
+        restore = self.preview_config if cfg is not None else None
+        self.drive_job = BurstCapture(self.backend, cfg, restore, self.sequence, self.writer,
+                                      file_extension, frames=frames, on_finished=on_finished)
+        self.drive_job.start()
+        return self.drive_job
+
+    def start_interval(self, file_extension, interval, frames=0, stop_at=None, controls_fn=None, on_finished=None):
+        make_config = lambda: self.still_configuration(file_extension, controls_fn() if controls_fn else None)
+        self.drive_job = IntervalCapture(self.backend, make_config, self.sequence, self.writer, file_extension,
+                                         interval, frames=frames, stop_at=stop_at, on_finished=on_finished)
+        self.drive_job.start()
+        return self.drive_job
+
+    def start_stack(self, frames, method="sigma-clip", output=".dng", dark_path=None, controls=None,
+                    on_finished=None):
+        cfg = self.still_configuration(".dng", controls, buffer_count=3)
+        restore = self.preview_config if cfg is not None else None
+        self.drive_job = StackCapture(self.backend, cfg, restore, self.sequence, self.writer, frames,
+                                      method=method, output=output, dark_path=dark_path,
+                                      calibration=self.calibration, on_finished=on_finished)
+        self.drive_job.start()
+        return self.drive_job
+
+    def start_master(self, kind, frames, method="sigma-clip", controls=None, on_finished=None):
+        """Capture a master dark or flat (`kind`) for the calibration library,
+        at the given exposure `controls`."""
+        if self.calibration is None:
+            raise ValueError("No calibration library")
+        cfg = self.still_configuration(".dng", controls, buffer_count=3)
+        restore = self.preview_config if cfg is not None else None
+        self.drive_job = MasterCapture(self.backend, cfg, restore, self.calibration, kind, frames, method=method,
+                                       on_finished=on_finished)
+        self.drive_job.start()
+        return self.drive_job
+
+    def stop_drive(self):
+        if self.drive_job is not None:
+            self.drive_job.stop()
+
+    def end_drive(self):
+        if self.drive_job is not None:
+            self.drive_job.join()
+            self.drive_job = None
+
+    def close(self, timeout=30):
+        """Stop any drive job, flush the writer and close the camera. Returns
+        the number of captures that were not written within `timeout`."""
+        self._stop_ring()
+        self.stop_drive()
+        self.end_drive()
+        unwritten = self.writer.close(timeout=timeout)
+        if unwritten:
+            logging.error(f"{unwritten} captures were still not written at shutdown")
+        self.backend.close()
+        return unwritten
+
+
+def create_backend(name=None):
+    name = name or os.environ.get("FOTOPI_BACKEND", "picamera2")
+    if name == "simulated":
+        return SimulatedBackend()
+    return Picamera2Backend()
@@ -0,0 +1,108 @@
+import os, threading
+from datetime import datetime
+
+# capture files are named NNN-dd-mm-YYYY-HH-MM.ext
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.dng', '.tif')
+# output format that saves the raw frame and a JPEG of the same exposure
+RAW_PLUS_JPEG = '.dng+.jpg'
+
+
+def output_extensions(file_extension):
+    """The files one capture in the given output format produces. The JPEG
+    comes first so the quick-look copy is encoded before the DNG."""
+    if file_extension == RAW_PLUS_JPEG:
+        return ('.jpg', '.dng')
+    return (file_extension,)
+
+
+def parse_sequence(filename):
+    head = os.path.basename(filename).split("-", 1)[0]
+    return int(head) if head.isdigit() else None
+
+
+def format_filename(number, when, file_extension):
+    return f"{number:03d}-{when.strftime('%d-%m-%Y-%H-%M')}{file_extension}"
+
+
+def caption_for(filename):
+    base_name = os.path.splitext(os.path.basename(filename))[0]
+    parts = base_name.split("-")
+    if len(parts) >= 6:
+        num = parts[0]
+        time_str = f"{parts[4]}:{parts[5]}"
+        date_str = f"{parts[1]}.{parts[2]}.{parts[3]}"
+        return f"{num} | {time_str} | {date_str}"
+    return base_name
+
+
+class SequenceAllocator:
+    """Hands out capture sequence numbers without listing the folder on
+    every shutter press. The folder is scanned once; after that a stat() of
+    the folder tells whether anything else touched it, and only then is it
+    rescanned. Files we wrote ourselves are reported via note_written()."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._last = 0
+        self._stamp = None
+        with self._lock:
+            self._rescan()
+
+    def _folder_stamp(self):
+        try:
+            st = os.stat(self.folder)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_ino
+
+    def _rescan(self):
+        os.makedirs(self.folder, exist_ok=True)
+        highest = 0
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if not entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                    continue
+                number = parse_sequence(entry.name)
+                if number is not None and number > highest:
+                    highest = number
+        # never hand out a number twice, even if files were deleted meanwhile
+        self._last = max(self._last, highest)
+        self._stamp = self._folder_stamp()
+
+    def rescan(self):
+        with self._lock:
+            self._rescan()
+
+    def next_filename(self, file_extension, when=None):
+        return self.next_filenames((file_extension,), when)[0]
+
+    def next_filenames(self, file_extensions, when=None):
+        """One filename per extension, all with the same sequence number."""
+        when = when or datetime.now()
+        with self._lock:
+            if self._folder_stamp() != self._stamp:
+                self._rescan()
+            while True:
+                self._last += 1
+                paths = [os.path.join(self.folder, format_filename(self._last, when, ext)) for ext in file_extensions]
+                if not any(os.path.exists(path) for path in paths):
+                    return paths
+
+    def note_written(self, path):
+        """`path` was just renamed into the folder. The rename stamps the
+        folder's mtime and the file's ctime alike, so only when the two
+        match is the folder change ours alone; otherwise something else
+        touched the folder too and the next allocation rescans it."""
+        with self._lock:
+            number = parse_sequence(path)
+            if number is not None and number > self._last:
+                self._last = number
+            stamp = self._folder_stamp()
+            try:
+                renamed_ns = os.stat(path).st_ctime_ns
+            except OSError:
+                return
+            if stamp is not None and self._stamp is not None and stamp[1] == self._stamp[1] \
+                    and stamp[0] == renamed_ns:
+                self._stamp = stamp
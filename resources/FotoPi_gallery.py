@@ -0,0 +1,423 @@
+import os
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QSize, QRect, QPoint, QModelIndex, QAbstractListModel, pyqtSignal
+from PyQt5.QtGui import QIcon, QPixmap, QColor, QFont
+from PyQt5.QtWidgets import (QWidget, QLabel, QPushButton, QVBoxLayout, QHBoxLayout, QListView, QStyledItemDelegate,
+                             QAbstractItemView, QAbstractSlider, QScroller, QFrame)
+
+from resources.FotoPi_files import caption_for
+
+GALLERY_FORMATS = ('.jpg', '.jpeg', '.png', '.dng')
+TILE_SIZE = QSize(400, 286)
+GRID_SIZE = QSize(510, 310)
+# filenames are fetched from the catalog in chunks of this many rows
+CHUNK_ROWS = 256
+
+
+NAV_BUTTON_STYLE = """
+    QPushButton {
+        background-color: rgb(21, 29, 38);
+        color: white;
+        padding: 10px;
+        border: none;
+        border-radius: 5px;
+    }
+    QPushButton:hover {
+        background-color: #466180;
+    }
+"""
+
+CLOSE_BUTTON_STYLE = """
+    QPushButton {
+        background-color: #f44336;
+        color: white;
+        padding: 10px;
+        border: none;
+        border-radius: 5px;
+    }
+    QPushButton:hover {
+        background-color: #da190b;
+    }
+"""
+
+
+SCROLLBAR_STYLE = """
+    QScrollBar:vertical {
+        background: rgb(21, 29, 38);
+        width: 40px;
+        border-radius: 5px;
+    }
+    QScrollBar::handle:vertical {
+        background: #466180;
+        min-height: 80px;
+        border-radius: 5px;
+    }
+    QScrollBar::add-line:vertical, QScrollBar::sub-line:vertical {
+        height: 0px;
+    }
+"""
+
+
+class GalleryModel(QAbstractListModel):
+    """All gallery images of the catalog, newest first. Nothing is loaded up
+    front: filenames are read from the catalog in chunks when a row is first
+    asked for, and a thumbnail is only requested from the GalleryLoader once
+    the view paints that row. The last `max_pixmaps` thumbnails are kept."""
+
+    PathRole = Qt.UserRole + 1
+    FailedRole = Qt.UserRole + 2
+
+    def __init__(self, loader, max_pixmaps=48):
+        super().__init__()
+        self.loader = loader
+        self.max_pixmaps = max_pixmaps
+        self.catalog = None
+        self.folder = None
+        self._count = 0
+        self._chunks = {}
+        self._pixmaps = OrderedDict()
+        self._failed = set()
+        self.loader.loaded.connect(self.thumbnail_loaded)
+
+    def set_source(self, catalog, folder):
+        self.beginResetModel()
+        self.loader.cancel()
+        self.catalog = catalog
+        self.folder = folder
+        self._count = catalog.count(formats=GALLERY_FORMATS)
+        self._chunks.clear()
+        self._pixmaps.clear()
+        self._failed.clear()
+        self.endResetModel()
+
+    def clear(self):
+        self.beginResetModel()
+        self.loader.cancel()
+        self._count = 0
+        self._chunks.clear()
+        self._pixmaps.clear()
+        self._failed.clear()
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._count
+
+    def path(self, row):
+        chunk = row // CHUNK_ROWS
+        names = self._chunks.get(chunk)
+        if names is None:
+            names = self.catalog.page(chunk * CHUNK_ROWS, CHUNK_ROWS, formats=GALLERY_FORMATS)
+            self._chunks[chunk] = names
+        offset = row % CHUNK_ROWS
+        return os.path.join(self.folder, names[offset]) if offset < len(names) else None
+
+    def is_ready(self, row):
+        return row in self._pixmaps or row in self._failed
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= self._count:
+            return None
+        row = index.row()
+        if role == self.PathRole:
+            return self.path(row)
+        if role == self.FailedRole:
+            return row in self._failed
+        if role == Qt.DecorationRole:
+            pixmap = self._pixmaps.get(row)
+            if pixmap is not None:
+                self._pixmaps.move_to_end(row)
+                return pixmap
+            path = self.path(row)
+            if path is not None and row not in self._failed:
+                self.loader.request(row, path)
+        return None
+
+    def thumbnail_loaded(self, generation, row, image):
+        if generation != self.loader.generation or row >= self._count:
+            return
+        if image.isNull():
+            self._failed.add(row)
+        else:
+            self._pixmaps[row] = QPixmap.fromImage(image)
+            while len(self._pixmaps) > self.max_pixmaps:
+                self._pixmaps.popitem(last=False)
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.DecorationRole])
+
+
+class GalleryDelegate(QStyledItemDelegate):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.font = QFont()
+        self.font.setPixelSize(32)
+
+    def sizeHint(self, option, index):
+        return GRID_SIZE
+
+    def paint(self, painter, option, index):
+        tile = QRect(0, 0, TILE_SIZE.width(), TILE_SIZE.height())
+        tile.moveCenter(option.rect.center())
+        pixmap = index.data(Qt.DecorationRole)
+        if pixmap is None:
+            painter.fillRect(tile, QColor(21, 29, 38))
+            painter.setPen(QColor("#466180"))
+            painter.setFont(self.font)
+            painter.drawText(tile, Qt.AlignCenter, "?" if index.data(GalleryModel.FailedRole) else "...")
+            return
+        target = QRect(0, 0, 0, 0)
+        target.setSize(pixmap.size().scaled(TILE_SIZE, Qt.KeepAspectRatio))
+        target.moveCenter(tile.center())
+        painter.drawPixmap(target, pixmap)
+
+
+class GalleryView(QListView):
+    """Grid of thumbnails that only materialises the rows on screen
+    (uniform item sizes, so jumping anywhere with the scrollbar is cheap)
+    and scrolls kinetically when dragged with a finger."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setViewMode(QListView.ListMode)
+        self.setFlow(QListView.LeftToRight)
+        self.setWrapping(True)
+        self.setResizeMode(QListView.Adjust)
+        self.setMovement(QListView.Static)
+        self.setUniformItemSizes(True)
+        self.setGridSize(GRID_SIZE)
+        self.setItemDelegate(GalleryDelegate(self))
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(Qt.ScrollBarAlwaysOn)
+        self.verticalScrollBar().setStyleSheet(SCROLLBAR_STYLE)
+        self.setFrameShape(QFrame.NoFrame)
+        self.setCursor(Qt.PointingHandCursor)
+        QScroller.grabGesture(self.viewport(), QScroller.LeftMouseButtonGesture)
+
+    def visible_rows(self):
+        model = self.model()
+        if model is None or model.rowCount() == 0:
+            return []
+        area = self.viewport().rect()
+        first = self.indexAt(area.topLeft() + QPoint(1, 1))
+        row = first.row() if first.isValid() else 0
+        rows = []
+        while row < model.rowCount() and self.visualRect(model.index(row)).intersects(area):
+            rows.append(row)
+            row += 1
+        return rows
+
+    def scroll_page(self, direction):
+        action = QAbstractSlider.SliderPageStepAdd if direction > 0 else QAbstractSlider.SliderPageStepSub
+        self.verticalScrollBar().triggerAction(action)
+
+
+class SwipeLabel(QLabel):
+    """Image area of the fullscreen viewer; a horizontal drag emits
+    swiped(+1) for the next (older) image and swiped(-1) for the previous."""
+
+    swiped = pyqtSignal(int)
+
+    SWIPE_DISTANCE = 80
+
+    def __init__(self):
+        super().__init__()
+        self._press_x = None
+
+    def mousePressEvent(self, event):
+        self._press_x = event.x()
+
+    def mouseReleaseEvent(self, event):
+        if self._press_x is None:
+            return
+        dx = event.x() - self._press_x
+        self._press_x = None
+        if abs(dx) >= self.SWIPE_DISTANCE:
+            self.swiped.emit(1 if dx < 0 else -1)
+
+
+class GalleryPanel(QWidget):
+    """The gallery overlay. Built once and reused; the grid is a GalleryView
+    over a GalleryModel, so a folder with thousands of images costs no more
+    to open or scroll than one with nine. Tapping a tile opens the
+    fullscreen viewer, which shows screen-sized decodes from the
+    PreviewLoader and prefetches the neighbours for swiping."""
+
+    closed = pyqtSignal()
+
+    MAX_PREVIEWS = 5
+
+    def __init__(self, parent, loader, previews, button_font):
+        super().__init__(parent)
+        self.loader = loader
+        self.previews = previews
+        self.viewer_row = None
+        self._previews = OrderedDict()
+        self.previews.loaded.connect(self.preview_loaded)
+
+        self.setStyleSheet("""
+            background-color: rgb(34, 47, 62);
+            border-radius: 15px;
+        """)
+        self.setFixedSize(1620, 1080)
+        self.setLayoutDirection(Qt.LeftToRight)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(10, 5, 10, 5)
+
+        self.model = GalleryModel(loader)
+        self.grid_widget = GalleryView()
+        self.grid_widget.setModel(self.model)
+        self.grid_widget.clicked.connect(self.show_fullscreen_image)
+
+        self.fullscreen_widget = QWidget()
+        fullscreen_layout = QVBoxLayout()
+        fullscreen_layout.setContentsMargins(5, 15, 5, 5)
+        fullscreen_layout.setSpacing(10)
+        self.fullscreen_image = SwipeLabel()
+        self.fullscreen_image.setAlignment(Qt.AlignCenter)
+        self.fullscreen_image.setStyleSheet("color: #466180; font-size: 32px;")
+        self.fullscreen_image.swiped.connect(self.show_neighbour)
+        self.fullscreen_name_label = QLabel()
+        self.fullscreen_name_label.setAlignment(Qt.AlignCenter)
+        self.fullscreen_name_label.setStyleSheet("color: white; font-size: 32px; font-weight: bold;")
+        fullscreen_layout.addWidget(self.fullscreen_name_label)
+        fullscreen_layout.addWidget(self.fullscreen_image)
+        self.fullscreen_widget.setLayout(fullscreen_layout)
+        self.fullscreen_widget.hide()
+
+        nav_layout = QHBoxLayout()
+        nav_layout.setAlignment(Qt.AlignCenter)
+        nav_layout.setContentsMargins(35, 10, 35, 35)
+        nav_layout.setSpacing(125)
+
+        self.prev_button = self._nav_button("resources/icons/left.png")
+        self.prev_button.clicked.connect(self.show_previous_page)
+        nav_layout.addWidget(self.prev_button)
+
+        self.back_close_button = QPushButton("Close")
+        self.back_close_button.setFont(button_font)
+        self.back_close_button.setStyleSheet(CLOSE_BUTTON_STYLE)
+        self.back_close_button.setFixedSize(184, 73)
+        self.back_close_button.clicked.connect(self.back_or_close)
+        nav_layout.addWidget(self.back_close_button)
+
+        self.next_button = self._nav_button("resources/icons/right.png")
+        self.next_button.clicked.connect(self.show_next_page)
+        nav_layout.addWidget(self.next_button)
+
+        layout.addWidget(self.grid_widget)
+        layout.addWidget(self.fullscreen_widget)
+        layout.addLayout(nav_layout)
+        self.setLayout(layout)
+        self.move((1920 - self.width()) // 2, (1080 - self.height()) // 2)
+        self.hide()
+
+    @staticmethod
+    def _nav_button(icon_path):
+        icon = QIcon()
+        icon.addFile(icon_path, QSize(), QIcon.Normal, QIcon.Off)
+        button = QPushButton("")
+        button.setIcon(icon)
+        button.setIconSize(QSize(127, 73))
+        button.setStyleSheet(NAV_BUTTON_STYLE)
+        button.setFixedSize(184, 85)
+        return button
+
+    def open(self, catalog, folder, row=0):
+        self.model.set_source(catalog, folder)
+        self.show_grid()
+        self.show()
+        self.raise_()
+        self.scroll_to(row)
+
+    def scroll_to(self, row):
+        if self.model.rowCount():
+            row = max(0, min(row, self.model.rowCount() - 1))
+            self.grid_widget.scrollTo(self.model.index(row), QAbstractItemView.PositionAtTop)
+
+    def visible_rows(self):
+        return self.grid_widget.visible_rows()
+
+    def show_previous_page(self):
+        if self.fullscreen_widget.isVisible():
+            self.show_neighbour(-1)
+        else:
+            self.grid_widget.scroll_page(-1)
+
+    def show_next_page(self):
+        if self.fullscreen_widget.isVisible():
+            self.show_neighbour(1)
+        else:
+            self.grid_widget.scroll_page(1)
+
+    def show_fullscreen_image(self, index):
+        self.show_image(index.row())
+
+    def show_neighbour(self, step):
+        if self.viewer_row is not None and 0 <= self.viewer_row + step < self.model.rowCount():
+            self.show_image(self.viewer_row + step)
+
+    def show_image(self, row):
+        path = self.model.path(row)
+        if path is None:
+            return
+        self.viewer_row = row
+        self.grid_widget.hide()
+        self.fullscreen_widget.show()
+        self.fullscreen_name_label.setText(caption_for(path))
+        self.back_close_button.setText("Back")
+        pixmap = self._previews.get(path)
+        if pixmap is not None:
+            self._previews.move_to_end(path)
+            self.fullscreen_image.setPixmap(pixmap)
+        else:
+            self.fullscreen_image.clear()
+            self.fullscreen_image.setText("...")
+            self.previews.request(path, priority=2)
+        # swiping on should not have to wait for the decoder
+        for neighbour in (row + 1, row - 1):
+            if 0 <= neighbour < self.model.rowCount():
+                neighbour_path = self.model.path(neighbour)
+                if neighbour_path is not None and neighbour_path not in self._previews:
+                    self.previews.request(neighbour_path, priority=1)
+
+    def preview_loaded(self, path, image):
+        showing = self.viewer_row is not None and self.model.path(self.viewer_row) == path
+        if image.isNull():
+            if showing:
+                self.fullscreen_image.setText("?")
+            return
+        pixmap = QPixmap.fromImage(image)
+        self._previews[path] = pixmap
+        while len(self._previews) > self.MAX_PREVIEWS:
+            self._previews.popitem(last=False)
+        if showing:
+            self.fullscreen_image.setPixmap(pixmap)
+
+    def show_grid(self):
+        if self.viewer_row is not None:
+            # land on the image that was open in the viewer
+            self.grid_widget.scrollTo(self.model.index(self.viewer_row))
+        self.viewer_row = None
+        self.fullscreen_widget.hide()
+        self.fullscreen_image.clear()
+        self.grid_widget.show()
+        self.back_close_button.setText("Close")
+
+    def back_or_close(self):
+        if self.fullscreen_widget.isVisible():
+            self.show_grid()
+        else:
+            self.close_gallery()
+
+    def close_gallery(self):
+        # drops the cached pixmaps too, the disk cache makes reopening cheap
+        self.previews.cancel()
+        self._previews.clear()
+        self.viewer_row = None
+        self.model.clear()
+        self.hide()
+        self.closed.emit()
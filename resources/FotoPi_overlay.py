@@ -0,0 +1,107 @@
+import numpy as np
+
+from resources.FotoPi_analysis import zebra_pattern
+
+GRID_COLOUR = (255, 255, 255, 255)
+# the grid splits the picture into GRID_DIVISIONS x GRID_DIVISIONS fields
+GRID_DIVISIONS = 4
+DIM_COLOUR = (0, 0, 0, 100)
+
+
+class OverlayCompositor:
+    """The one RGBA overlay the preview draws over the live view, stretched
+    over the picture (not the window), built from: peaking at the bottom,
+    zebra blended over it, the grid, the histogram panel on top. While
+    dimmed (a settings panel is open) it is a plain translucent black.
+
+    The composite is cached and only rebuilt when a layer changes; the
+    full frame layers (peaking, zebra, grid) are kept as a base of their
+    own, so a new histogram only costs a copy and a paste. `changed` tells
+    whether the preview needs the overlay pushed again."""
+
+    def __init__(self, size=(720, 540), margin=12):
+        self.size = tuple(size)
+        self.margin = margin
+        self.grid = False
+        self.dimmed = False
+        self.changed = True
+        self._layers = {}
+        self._base = None
+        self._overlay = None
+        self._grid_mask = None
+        self._dim = None
+
+    @property
+    def layers(self):
+        return set(self._layers)
+
+    def set_layer(self, name, layer):
+        """Replace a layer (None removes it)."""
+        if layer is None:
+            if self._layers.pop(name, None) is None:
+                return
+        else:
+            self._layers[name] = layer
+        if name != "histogram":
+            self._base = None
+        self._overlay = None
+        self.changed = True
+
+    def keep_layers(self, names):
+        for name in self.layers - set(names):
+            self.set_layer(name, None)
+
+    def set_grid(self, enabled):
+        if enabled != self.grid:
+            self.grid = enabled
+            self._base = self._overlay = None
+            self.changed = True
+
+    def set_dimmed(self, dimmed):
+        if dimmed != self.dimmed:
+            self.dimmed = dimmed
+            self.changed = True
+
+    def _grid(self):
+        if self._grid_mask is None:
+            width, height = self.size
+            mask = np.zeros((height, width), dtype=bool)
+            for i in range(1, GRID_DIVISIONS):
+                mask[i * height // GRID_DIVISIONS, :] = True
+                mask[:, i * width // GRID_DIVISIONS] = True
+            self._grid_mask = mask
+        return self._grid_mask
+
+    def _render_base(self):
+        width, height = self.size
+        peaking = self._layers.get("peaking")
+        base = peaking.copy() if peaking is not None else np.zeros((height, width, 4), dtype=np.uint8)
+        zebra = self._layers.get("zebra")
+        if zebra is not None:
+            np.copyto(base, zebra_pattern(self.size), where=zebra[:, :, None])
+        if self.grid:
+            base[self._grid()] = GRID_COLOUR
+        return base
+
+    def render(self):
+        """The overlay to show, or None for no overlay."""
+        self.changed = False
+        if self.dimmed:
+            if self._dim is None:
+                # stretched like everything else, a few pixels are enough
+                self._dim = np.full((3, 4, 4), DIM_COLOUR, dtype=np.uint8)
+            return self._dim
+        if not self._layers and not self.grid:
+            return None
+        if self._overlay is None:
+            if self._base is None:
+                self._base = self._render_base()
+            panel = self._layers.get("histogram")
+            if panel is None:
+                self._overlay = self._base
+            else:
+                overlay = self._base.copy()
+                h, w = panel.shape[:2]
+                overlay[-h - self.margin:-self.margin, self.margin:self.margin + w] = panel
+                self._overlay = overlay
+        return self._overlay
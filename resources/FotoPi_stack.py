@@ -0,0 +1,193 @@
+import numpy as np
+
+from resources.FotoPi_dng import read_cfa
+
+METHODS = ("mean", "median", "sigma-clip")
+
+
+def raw_bits(config):
+    fmt = config.get("format") or ""
+    digits = "".join(c for c in fmt.split("_")[0] if c.isdigit())
+    return int(digits) if digits else 16
+
+
+def bayer_order(config):
+    """'RGGB', 'BGGR', ... from a raw stream format like SRGGB12_CSI2P."""
+    fmt = (config.get("format") or "SRGGB").split("_")[0].lstrip("S")
+    order = "".join(c for c in fmt if not c.isdigit())
+    return order if order in ("RGGB", "BGGR", "GRBG", "GBRG") else "RGGB"
+
+
+def black_level(metadata, bits):
+    """Mean sensor black level in `bits` bit units; SensorBlackLevels are
+    reported in 16 bit units."""
+    levels = metadata.get("SensorBlackLevels")
+    return sum(levels) / len(levels) / (1 << (16 - bits)) if levels else 0.0
+
+
+def raw_frame(buffer, config):
+    """The raw stream buffer of a request as a (height, width) uint16 array
+    of sensor values. Handles the CSI-2 packed formats (10 and 12 bit) and
+    the unpacked 16 bit container formats."""
+    width, height = config["size"]
+    stride = config["stride"]
+    bits = raw_bits(config)
+    rows = np.frombuffer(buffer, dtype=np.uint8, count=stride * height).reshape(height, stride)
+    if not (config.get("format") or "").endswith("_CSI2P"):
+        return rows.view("<u2")[:, :width]
+    if bits == 12:
+        # two pixels in three bytes, the low nibbles of both in the third
+        packed = rows[:, :width * 3 // 2].reshape(height, -1, 3).astype(np.uint16)
+        frame = np.empty((height, packed.shape[1], 2), dtype=np.uint16)
+        frame[:, :, 0] = (packed[:, :, 0] << 4) | (packed[:, :, 2] & 0x0F)
+        frame[:, :, 1] = (packed[:, :, 1] << 4) | (packed[:, :, 2] >> 4)
+        return frame.reshape(height, -1)[:, :width]
+    if bits == 10:
+        # four pixels in five bytes, the low two bits of all of them in the fifth
+        packed = rows[:, :width * 5 // 4].reshape(height, -1, 5).astype(np.uint16)
+        frame = np.empty((height, packed.shape[1], 4), dtype=np.uint16)
+        for i in range(4):
+            frame[:, :, i] = (packed[:, :, i] << 2) | ((packed[:, :, 4] >> (2 * i)) & 0x03)
+        return frame.reshape(height, -1)[:, :width]
+    raise ValueError(f"Unsupported packed raw format {config.get('format')}")
+
+
+class MeanStack:
+    """Running sum in uint32, exact for up to 65536 frames of 16 bit data."""
+
+    def __init__(self):
+        self.count = 0
+        self._sum = None
+
+    def add(self, frame):
+        if self._sum is None:
+            self._sum = np.zeros(frame.shape, dtype=np.uint32)
+        np.add(self._sum, frame, out=self._sum)
+        self.count += 1
+
+    def result(self):
+        return self._sum.astype(np.float32) / self.count
+
+
+class SigmaClipStack:
+    """Streaming kappa-sigma clipping: per pixel running mean and variance
+    (Welford). After `warmup` frames, values further than `kappa` standard
+    deviations from the running mean (satellites, planes, cosmic rays) are
+    left out of that pixel's mean."""
+
+    # one DN, so a pixel that happened to read the same value a few times isn't frozen
+    MIN_SIGMA = 1.0
+
+    def __init__(self, kappa=2.5, warmup=3):
+        self.kappa = kappa
+        self.warmup = warmup
+        self.count = 0
+        self.rejected = 0
+        self._n = self._mean = self._m2 = None
+
+    def add(self, frame):
+        x = frame.astype(np.float32)
+        if self._mean is None:
+            self._n = np.zeros(frame.shape, dtype=np.uint16)
+            self._mean = np.zeros(frame.shape, dtype=np.float32)
+            self._m2 = np.zeros(frame.shape, dtype=np.float32)
+        delta = x - self._mean
+        if self.count >= self.warmup:
+            sigma = np.sqrt(self._m2 / np.maximum(self._n - 1, 1))
+            accept = np.abs(delta) <= self.kappa * np.maximum(sigma, self.MIN_SIGMA)
+            self.rejected += int(accept.size - np.count_nonzero(accept))
+            delta *= accept
+            self._n += accept
+        else:
+            self._n += 1
+        self._mean += delta / np.maximum(self._n, 1)
+        # rejected pixels have delta 0 and leave m2 alone
+        self._m2 += delta * (x - self._mean)
+        self.count += 1
+
+    def result(self):
+        return self._mean
+
+
+def _median(frames):
+    stack = np.stack(frames)
+    k = len(frames) // 2
+    if len(frames) % 2:
+        return np.partition(stack, k, axis=0)[k]
+    part = np.partition(stack, (k - 1, k), axis=0)
+    return (part[k - 1].astype(np.float32) + part[k]) / 2
+
+
+class MedianStack:
+    """Remedian: the median of every `chunk` frames goes one level up, the
+    median of `chunk` of those one further, and so on, so at most `chunk`
+    frames per level are held. Exact for up to `chunk` frames, a close
+    approximation of the median beyond that."""
+
+    def __init__(self, chunk=5):
+        self.chunk = chunk
+        self.count = 0
+        self._levels = [[]]
+
+    def add(self, frame):
+        self._levels[0].append(frame.copy())
+        self.count += 1
+        for level, frames in enumerate(self._levels):
+            if len(frames) < self.chunk:
+                break
+            if level + 1 == len(self._levels):
+                self._levels.append([])
+            self._levels[level + 1].append(_median(frames))
+            frames.clear()
+
+    def result(self):
+        carry = None
+        for frames in self._levels:
+            items = frames + ([carry] if carry is not None else [])
+            if items:
+                carry = _median(items)
+        return np.asarray(carry, dtype=np.float32)
+
+
+def make_stacker(method, **kwargs):
+    if method == "mean":
+        return MeanStack()
+    if method == "median":
+        return MedianStack(**kwargs)
+    if method == "sigma-clip":
+        return SigmaClipStack(**kwargs)
+    raise ValueError(f"Unknown stacking method {method}")
+
+
+def load_dark(path, bits):
+    """A master dark (DNG) in the units of `bits` bit frames."""
+    cfa, dark_bits = read_cfa(path)
+    return cfa.astype(np.float32) * 2.0 ** (bits - dark_bits)
+
+
+def calibrate(stacked, dark=None, pedestal=0.0, white=None):
+    """Subtract the dark frame from the stacked result. Every method
+    commutes with subtracting a per-pixel constant, so this is done once
+    instead of per frame. The black level (`pedestal`) is added back so
+    the DNG BlackLevel still applies."""
+    result = stacked - dark + pedestal if dark is not None else stacked
+    return np.clip(result, 0, white if white is not None else np.inf)
+
+
+def to_raw16(stacked, bits):
+    """Stacked result (in sensor units) as 16 bit raw, keeping the extra
+    precision that averaging gave us."""
+    return np.clip(np.rint(stacked * (1 << (16 - bits))), 0, 65535).astype(np.uint16)
+
+
+def to_rgb16(stacked, order, black, white):
+    """Half resolution linear RGB, one pixel per 2x2 Bayer block (the two
+    greens averaged), scaled from [black, white] to the full 16 bit range."""
+    h, w = stacked.shape[0] // 2 * 2, stacked.shape[1] // 2 * 2
+    planes = {}
+    for position, colour in enumerate(order):
+        dy, dx = divmod(position, 2)
+        planes.setdefault(colour, []).append(stacked[dy:h:2, dx:w:2])
+    rgb = np.stack([sum(planes[c]) / len(planes[c]) for c in "RGB"], axis=2)
+    rgb = (rgb - black) * (65535 / max(white - black, 1))
+    return np.clip(np.rint(rgb), 0, 65535).astype(np.uint16)
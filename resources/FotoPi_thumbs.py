@@ -0,0 +1,457 @@
+import os, hashlib, threading, logging
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QRect, QSize, QObject, QRunnable, QThreadPool, pyqtSignal
+from PyQt5.QtGui import QImage, QImageReader, QPainter, QColor, QFont
+
+from resources.FotoPi_files import caption_for
+from resources import FotoPi_dng
+
+THUMB_SIZE = (400, 286)
+PREVIEW_SIZE = (1200, 960)
+CACHE_DIR = os.path.join(".fotopi", "thumbnails")
+
+
+def draw_caption(image, text, source_height):
+    # same look as the old full-size caption, scaled down to the thumbnail
+    scale = image.height() / max(source_height, 1)
+    font_size = max(1, int(image.height() * 0.085))
+    padding = 15 * scale
+    rec_height = int(font_size + 8 * padding)
+    text_rect = QRect(0, image.height() - rec_height, image.width(), rec_height)
+
+    font = QFont('Arial')
+    font.setBold(True)
+    font.setPixelSize(font_size)
+
+    painter = QPainter(image)
+    painter.setFont(font)
+    painter.setBrush(QColor(0, 0, 0, 127))
+    painter.drawRect(text_rect)
+    painter.setPen(QColor(255, 255, 255))
+    painter.drawText(text_rect, Qt.AlignHCenter | Qt.AlignBottom, text)
+    painter.end()
+
+
+def probe_size(path):
+    if path.lower().endswith('.dng'):
+        try:
+            return FotoPi_dng.raw_size(path)
+        except (OSError, FotoPi_dng.DngError):
+            return None
+    size = QImageReader(path).size()
+    return (size.width(), size.height()) if size.isValid() else None
+
+
+def decode_dng(path, size):
+    """Decode a DNG through its embedded preview (or subsampled raw data),
+    never through a full demosaic."""
+    try:
+        preview = FotoPi_dng.read_preview(path, size)
+    except (OSError, FotoPi_dng.DngError) as e:
+        logging.error("Could not decode %s: %s", path, e)
+        return QImage(), QSize()
+    if preview.jpeg is not None:
+        image = QImage.fromData(preview.jpeg)
+    else:
+        h, w = preview.rgb.shape[:2]
+        image = QImage(preview.rgb.data, w, h, 3 * w, QImage.Format_RGB888).copy()
+    source_size = QSize(*preview.source_size) if preview.source_size else image.size()
+    if image.isNull():
+        logging.error("Could not decode the preview of %s", path)
+    elif image.width() > size[0] or image.height() > size[1]:
+        image = image.scaled(size[0], size[1], Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    return image, source_size
+
+
+def decode_scaled(path, size):
+    """Decode an image straight to (at most) `size`, using the decoder's own
+    downscaling where available (libjpeg DCT scaling for .jpg)."""
+    if path.lower().endswith('.dng'):
+        return decode_dng(path, size)
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    source_size = reader.size()
+    if source_size.isValid():
+        target = source_size.scaled(QSize(*size), Qt.KeepAspectRatio)
+        if target.width() < source_size.width():
+            reader.setScaledSize(target)
+    image = reader.read()
+    if image.isNull():
+        logging.error("Could not decode %s: %s", path, reader.errorString())
+        return QImage(), source_size
+    if image.width() > size[0] or image.height() > size[1]:
+        image = image.scaled(size[0], size[1], Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    return image, source_size
+
+
+class ThumbnailCache:
+    """Pre-rendered gallery thumbnails stored in a hidden folder next to the
+    images. Entries are keyed on path + mtime + size of the original, so an
+    edited or replaced file simply misses, and the folder is kept below
+    `max_bytes` by evicting the least recently used entries."""
+
+    def __init__(self, image_folder, max_bytes=64 * 1024 * 1024):
+        self.image_folder = image_folder
+        self.cache_dir = os.path.join(image_folder, CACHE_DIR)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if not entry.name.endswith(".jpg"):
+                    continue
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name, st.st_size))
+        # file mtime doubles as "last used", see _touch()
+        for _, name, size in sorted(entries):
+            self._entries[name] = size
+            self._total_bytes += size
+
+    def key(self, path, size=THUMB_SIZE, caption=True):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        raw = f"{os.path.abspath(path)}|{st.st_mtime_ns}|{st.st_size}|{size[0]}x{size[1]}|{int(caption)}"
+        return hashlib.sha1(raw.encode()).hexdigest() + ".jpg"
+
+    def _touch(self, name):
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        try:
+            os.utime(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+    def get(self, path, size=THUMB_SIZE, caption=True):
+        name = self.key(path, size, caption)
+        if name is None or name not in self._entries:
+            return QImage()
+        image = QImage(os.path.join(self.cache_dir, name))
+        if image.isNull():
+            self._forget(name)
+            return image
+        self._touch(name)
+        return image
+
+    def thumbnail(self, path, size=THUMB_SIZE, caption=True):
+        image = self.get(path, size, caption)
+        if not image.isNull():
+            return image
+        image, source_size = decode_scaled(path, size)
+        if image.isNull():
+            return image
+        if caption:
+            image = image.convertToFormat(QImage.Format_RGB32)
+            draw_caption(image, caption_for(path), source_size.height() or image.height())
+        self.put(path, image, size, caption)
+        return image
+
+    def put(self, path, image, size=THUMB_SIZE, caption=True):
+        name = self.key(path, size, caption)
+        if name is None:
+            return
+        target = os.path.join(self.cache_dir, name)
+        tmp = f"{target}.{threading.get_ident()}.tmp"
+        if not image.save(tmp, "JPG", 85):
+            logging.error("Could not write thumbnail for %s", path)
+            return
+        os.replace(tmp, target)
+        nbytes = os.path.getsize(target)
+        with self._lock:
+            self._total_bytes += nbytes - self._entries.pop(name, 0)
+            self._entries[name] = nbytes
+        self._evict()
+
+    def _forget(self, name):
+        with self._lock:
+            self._total_bytes -= self._entries.pop(name, 0)
+        try:
+            os.remove(os.path.join(self.cache_dir, name))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._total_bytes <= self.max_bytes or len(self._entries) <= 1:
+                    return
+                name, nbytes = self._entries.popitem(last=False)
+                self._total_bytes -= nbytes
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def total_bytes(self):
+        return self._total_bytes
+
+
+def retire_job(pool, job, retired):
+    """Take a queued job (a QRunnable with autoDelete off) back from `pool`.
+    If a pool thread has already dequeued it, the pool still holds the raw
+    pointer, so the job goes into `retired` to keep it alive until its
+    run() has finished and it takes itself out again. Call with the lock
+    that guards `retired` held."""
+    if not pool.tryTake(job):
+        retired.add(job)
+
+
+class ThumbnailJob(QRunnable):
+    def __init__(self, workers, path, sizes):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.workers = workers
+        self.path = path
+        self.sizes = sizes
+
+    def run(self):
+        try:
+            if not self.workers._begin(self):
+                return
+            try:
+                for size, caption in self.sizes:
+                    self.workers.cache.thumbnail(self.path, size, caption)
+            except Exception as e:
+                logging.error("Thumbnail job for %s failed: %s", self.path, e)
+            finally:
+                self.workers._end(self)
+        finally:
+            self.workers._release(self)
+
+
+class ThumbnailWorkers(QObject):
+    """Bounded background pool that renders thumbnail and preview sizes for
+    freshly captured images, so the gallery is warm before it is opened.
+    Newer submissions run first; when more than `max_pending` jobs are
+    queued the oldest ones are dropped (the gallery renders them on demand)."""
+
+    ready = pyqtSignal(str)
+
+    DEFAULT_SIZES = ((THUMB_SIZE, True), (PREVIEW_SIZE, False))
+
+    def __init__(self, cache, max_threads=2, max_pending=32):
+        super().__init__()
+        self.cache = cache
+        self.max_pending = max_pending
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._running = set()
+        # dropped jobs a pool thread had already dequeued, kept alive until they have run
+        self._retired = set()
+        self._priority = 0
+        self._closed = False
+
+    def submit(self, path, sizes=DEFAULT_SIZES):
+        with self._lock:
+            if self._closed or path in self._pending or path in self._running:
+                return False
+            while len(self._pending) >= self.max_pending:
+                old_path, old_job = self._pending.popitem(last=False)
+                retire_job(self.pool, old_job, self._retired)
+                logging.info("Thumbnail queue full, dropped %s", old_path)
+            # newest capture gets the highest priority
+            self._priority += 1
+            job = ThumbnailJob(self, path, sizes)
+            self._pending[path] = job
+            priority = self._priority
+        self.pool.start(job, priority)
+        return True
+
+    def _begin(self, job):
+        with self._lock:
+            if self._pending.get(job.path) is not job:
+                return False
+            del self._pending[job.path]
+            self._running.add(job.path)
+            return True
+
+    def _end(self, job):
+        with self._lock:
+            self._running.discard(job.path)
+        self.ready.emit(job.path)
+
+    def _release(self, job):
+        with self._lock:
+            self._retired.discard(job)
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending) + len(self._running)
+
+    def shutdown(self, timeout_ms=3000):
+        """Stop accepting work, drop everything still queued and wait for
+        running jobs. Returns (dropped, unfinished)."""
+        with self._lock:
+            self._closed = True
+            dropped = len(self._pending)
+            for job in self._pending.values():
+                retire_job(self.pool, job, self._retired)
+            self._pending.clear()
+        self.pool.waitForDone(timeout_ms)
+        with self._lock:
+            unfinished = len(self._running)
+        return dropped, unfinished
+
+
+class GalleryLoadJob(QRunnable):
+    def __init__(self, loader, generation, index, path):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.loader = loader
+        self.generation = generation
+        self.index = index
+        self.path = path
+
+    def run(self):
+        try:
+            if not self.loader._begin(self):
+                return
+            try:
+                image = self.loader.cache.thumbnail(self.path)
+            except Exception as e:
+                logging.error("Gallery load of %s failed: %s", self.path, e)
+                image = QImage()
+            if self.loader.generation == self.generation:
+                self.loader.loaded.emit(self.generation, self.index, image)
+        finally:
+            self.loader._release(self)
+
+
+class GalleryLoader(QObject):
+    """Decodes gallery thumbnails in the background and reports each one as
+    soon as it is ready. The view requests rows as they scroll into sight;
+    the most recent requests run first and, once more than `max_pending`
+    are queued, the oldest (long scrolled past) are dropped. cancel()
+    invalidates everything still queued."""
+
+    loaded = pyqtSignal(int, int, QImage)
+
+    def __init__(self, cache, max_threads=2, max_pending=48):
+        super().__init__()
+        self.cache = cache
+        self.max_pending = max_pending
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._retired = set()
+        self._priority = 0
+
+    def request(self, index, path):
+        with self._lock:
+            if index in self._pending:
+                return
+            while len(self._pending) >= self.max_pending:
+                _, old_job = self._pending.popitem(last=False)
+                retire_job(self.pool, old_job, self._retired)
+            self._priority += 1
+            job = GalleryLoadJob(self, self.generation, index, path)
+            self._pending[index] = job
+            priority = self._priority
+        self.pool.start(job, priority)
+
+    def load(self, paths):
+        self.cancel()
+        # requested last runs first, so the top-left tile comes first
+        for index in reversed(range(len(paths))):
+            self.request(index, paths[index])
+        return self.generation
+
+    def _begin(self, job):
+        with self._lock:
+            if job.generation != self.generation or self._pending.get(job.index) is not job:
+                return False
+            del self._pending[job.index]
+            return True
+
+    def _release(self, job):
+        with self._lock:
+            self._retired.discard(job)
+
+    def cancel(self):
+        with self._lock:
+            self.generation += 1
+            for job in self._pending.values():
+                retire_job(self.pool, job, self._retired)
+            self._pending.clear()
+
+
+class PreviewJob(QRunnable):
+    def __init__(self, loader, path, priority):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.loader = loader
+        self.path = path
+        self.priority = priority
+
+    def run(self):
+        try:
+            if not self.loader._begin(self):
+                return
+            try:
+                image = self.loader.cache.thumbnail(self.path, PREVIEW_SIZE, caption=False)
+            except Exception as e:
+                logging.error("Preview load of %s failed: %s", self.path, e)
+                image = QImage()
+            self.loader.loaded.emit(self.path, image)
+        finally:
+            self.loader._release(self)
+
+
+class PreviewLoader(QObject):
+    """Screen-sized decodes for the fullscreen viewer, through the same disk
+    cache as the thumbnails (ThumbnailWorkers already renders this size for
+    new captures). The image being looked at is requested with a higher
+    priority than its neighbours, which are prefetched."""
+
+    loaded = pyqtSignal(str, QImage)
+
+    def __init__(self, cache, max_threads=2):
+        super().__init__()
+        self.cache = cache
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(max_threads)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._retired = set()
+
+    def request(self, path, priority=0):
+        with self._lock:
+            queued = self._pending.get(path)
+            if queued is not None:
+                # a prefetched neighbour that is now being looked at moves up the queue; one a
+                # pool thread has already dequeued stays in _pending, which keeps it alive
+                if queued.priority >= priority or not self.pool.tryTake(queued):
+                    return
+            job = PreviewJob(self, path, priority)
+            self._pending[path] = job
+        self.pool.start(job, priority)
+
+    def _begin(self, job):
+        with self._lock:
+            if self._pending.get(job.path) is not job:
+                return False
+            del self._pending[job.path]
+            return True
+
+    def _release(self, job):
+        with self._lock:
+            self._retired.discard(job)
+
+    def cancel(self):
+        with self._lock:
+            for job in self._pending.values():
+                retire_job(self.pool, job, self._retired)
+            self._pending.clear()